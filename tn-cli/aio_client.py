@@ -0,0 +1,290 @@
+"""Alternative tn-cli runtime built on asyncio and grpc.aio.
+
+Input, response dispatch and timeouts run as coroutines on a single event loop instead
+of the stdin and generator threads used by client.run. File transfers block on files, so
+they run in the default executor of the loop instead of a thread per transfer.
+Requires Python 3.7 or newer."""
+
+from __future__ import print_function
+
+import asyncio
+import os
+import random
+import stat
+import sys
+
+import grpc
+from grpc import aio
+
+from tinode_grpc import pbx
+
+import commands
+import tn_globals
+from stats import timed
+from tn_globals import printerr, stdoutln
+from client import (EXIT_COMMANDS, BACKOFF, MAX_BACKOFF, RECONNECT_ERRORS, LoopState, hello_messages,
+    resume_messages, fail_in_flight, prepare_message, ready_input, take_input, wait_timeout,
+    pop_from_output_queue, handle_server_msg, open_channel, write_stats, message_sent)
+from recorder import start_recording, stop_recording
+from uploader import wait_uploads, upload_dir, UploadStream, large_file_receive
+from input_handler import LineJoiner
+
+# Event which is set when the state of input, output or outstanding requests changes.
+Changed = None
+
+# File transfers in progress.
+Transfers = set()
+
+
+def queue_input(cmd):
+    tn_globals.InputQueue.append(cmd)
+    tn_globals.wakeup()
+
+
+# Asynchronous generator of lines read from stdin.
+async def input_lines():
+    if tn_globals.IsInteractive:
+        while True:
+            try:
+                line = await tn_globals.Prompt.prompt_async()
+                yield line
+            except EOFError:
+                # Ctrl+D.
+                return
+    elif stat.S_ISREG(os.fstat(sys.stdin.fileno()).st_mode):
+        # Regular files cannot be polled by the event loop, but reading them does not block either.
+        for line in sys.stdin:
+            yield line
+            await asyncio.sleep(0)
+    else:
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            yield line.decode('utf-8')
+
+
+# Read possibly multiline input from stdin and queue it for processing.
+async def read_input():
+    joiner = LineJoiner()
+    try:
+        async for line in input_lines():
+            cmd = joiner.add(line)
+            if cmd is None:
+                continue
+            queue_input(cmd)
+            # Stop processing input
+            if cmd in EXIT_COMMANDS:
+                return
+    except Exception as ex:
+        printerr("Exception in stdin", ex)
+
+    queue_input('exit')
+
+
+# Convert queued input to protobuf messages and write them to the stream.
+async def send_messages(call, scheme, secret, args, state):
+    if state.calls == 0:
+        hello = hello_messages(state.next_id(), scheme, secret, args)
+        state.next_id()
+    else:
+        hello = resume_messages(state, scheme, secret, args)
+
+    for msg in hello:
+        message_sent(msg)
+        await call.write(msg)
+
+    print_prompt = True
+
+    while True:
+        index = ready_input()
+        if index is not None:
+            id = state.next_id()
+            inp = take_input(index)
+
+            if inp in EXIT_COMMANDS:
+                # Drain the output queue.
+                while pop_from_output_queue():
+                    pass
+                state.finished = True
+                await call.done_writing()
+                return
+
+            try:
+                pbMsg = prepare_message(inp, id, args)
+            except Exception as err:
+                stdoutln("Exception in generator: {0}".format(err))
+                continue
+
+            print_prompt = tn_globals.IsInteractive
+            if pbMsg != None:
+                message_sent(pbMsg)
+                await call.write(pbMsg)
+
+        elif not tn_globals.OutputQueue.empty():
+            pop_from_output_queue()
+            print_prompt = tn_globals.IsInteractive
+
+        else:
+            if print_prompt:
+                sys.stdout.write("tn> ")
+                sys.stdout.flush()
+                print_prompt = False
+
+            Changed.clear()
+            timeout = wait_timeout()
+            if ready_input() is None and \
+                    tn_globals.OutputQueue.empty():
+                try:
+                    await asyncio.wait_for(Changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+
+# Read server responses.
+async def read_responses(call, state):
+    async for msg in call:
+        state.received += 1
+        handle_server_msg(msg)
+
+
+# Run one MessageLoop call until the input ends or the stream fails.
+async def message_loop(call, scheme, secret, args, state):
+    sender = asyncio.ensure_future(send_messages(call, scheme, secret, args, state))
+    try:
+        await read_responses(call, state)
+        if state.finished:
+            await sender
+    finally:
+        if not sender.done():
+            # The stream is closed: input is taken again by the next call.
+            sender.cancel()
+
+
+# Upload large files over gRPC. Reading and hashing the file blocks, so the upload runs in the executor
+# on a channel of its own instead of the grpc.aio channel of the event loop.
+def file_upload(id, cmd, args):
+    channel = open_channel(args)
+    try:
+        for filename in cmd.filename:
+            try:
+                stream = UploadStream(id, filename)
+                commands.upload_result(large_file_receive(channel, stream))
+                stdoutln(stream.summary())
+            except Exception as ex:
+                stdoutln("Failed to upload '{0}':".format(filename), ex)
+    finally:
+        channel.close()
+
+
+# Start file transfer as a task on the event loop. Replaces commands.transfer_thread.
+def transfer_task(id, cmd, args):
+    loop = asyncio.get_running_loop()
+    futures = []
+    if cmd.what == 'up':
+        if cmd.dir:
+            # Directories are uploaded by a pool of threads with their own channel.
+            futures.append(loop.run_in_executor(None, timed('file', upload_dir), id, cmd, args))
+        if cmd.filename:
+            futures.append(loop.run_in_executor(None, timed('file', file_upload), id, cmd, args))
+    else:
+        # Downloads are resumed over HTTP and use a pool of threads.
+        futures.append(loop.run_in_executor(None, timed('file', commands.fileDownload), id, cmd, args))
+    for future in futures:
+        Transfers.add(future)
+        future.add_done_callback(Transfers.discard)
+
+
+async def main(args, schema, secret):
+    global Changed
+
+    failed = False
+    state = LoopState()
+    attempt = 0
+    delay = BACKOFF
+    loop = asyncio.get_running_loop()
+    Changed = asyncio.Event()
+    tn_globals.OnWakeup = lambda: loop.call_soon_threadsafe(Changed.set)
+    commands.set_transfer_runner(transfer_task)
+
+    tasks = []
+    try:
+        if tn_globals.IsInteractive:
+            # prompt_toolkit is slow to load and not used by scripts.
+            from prompt_toolkit import PromptSession
+            tn_globals.Prompt = PromptSession()
+        start_recording(args)
+        if args.replay:
+            # Precompiled script replaces stdin.
+            from precompile import load_frames
+            load_frames(args.replay)
+        else:
+            tasks.append(asyncio.ensure_future(read_input()))
+
+        while True:
+            tn_globals.Connection = open_channel(args, aio)
+            failure = None
+            try:
+                # Call the server
+                call = pbx.NodeStub(tn_globals.Connection).MessageLoop()
+                await message_loop(call, schema, secret, args, state)
+                if state.finished:
+                    break
+                error = "stream closed by server"
+            except grpc.RpcError as err:
+                if state.finished or err.code() not in RECONNECT_ERRORS:
+                    raise
+                failure = err
+                error = "{0}: {1}".format(err.code(), err.details())
+
+            if state.received:
+                # The connection worked for a while: start over.
+                attempt = 0
+                delay = BACKOFF
+            state.close()
+            if attempt >= args.reconnect:
+                if failure:
+                    raise failure
+                break
+            await tn_globals.Connection.close()
+            tn_globals.Connection = None
+            attempt += 1
+            fail_in_flight()
+            # Jitter keeps many clients from reconnecting at the same time.
+            wait = random.uniform(delay / 2, delay)
+            printerr("Connection lost ({0}), reconnecting in {1:.1f}s, attempt {2} of {3}".format(
+                error, wait, attempt, args.reconnect))
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    except grpc.RpcError as err:
+        printerr("gRPC failed with {0}: {1}".format(err.code(), err.details()))
+        failed = True
+    except Exception as ex:
+        printerr("Request failed: {0}".format(ex))
+        failed = True
+    finally:
+        tn_globals.printout('Shutting down...')
+        for task in tasks:
+            task.cancel()
+        if Transfers:
+            await asyncio.gather(*Transfers, return_exceptions=True)
+        await loop.run_in_executor(None, wait_uploads)
+        # Print results of uploads completed after the end of input.
+        while pop_from_output_queue():
+            pass
+        tn_globals.OnWakeup = None
+        if tn_globals.Connection:
+            await tn_globals.Connection.close()
+        stop_recording()
+        write_stats(args)
+
+    return 1 if failed else 0
+
+
+# The main processing loop: send messages to server, receive responses.
+def run(args, schema, secret):
+    return asyncio.run(main(args, schema, secret))
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Microbenchmark of tn-cli command parsing and serialization. Does not connect to the server.
+
+Run it as
+
+    python bench_parse.py [--lines 50000]
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from tinode_grpc import pb
+
+import tn_globals
+import commands
+import macros
+from utils import dotdict
+
+# Representative script lines.
+SAMPLE = [
+    "pub grpAbCdEf 'Hello, world'",
+    ".must sub grpAbCdEf --get-query=desc,sub",
+    ".await $meta get fnd --sub",
+    "set me --fn='Test User' --tags=test,test-user",
+    "note grpAbCdEf kp",
+    "del msg --topic=grpAbCdEf --seq=1,2,9-12",
+    ".must acc --user usrAbCdEf --suspend true --as_root",
+    "leave grpAbCdEf --unsub",
+    ".use --topic grpAbCdEf",
+    ".log $meta.sub[0].topic",
+    "userdel usrAbCdEf --hard",
+    "pub $meta.sub[0].topic $user.params[token]",
+]
+
+# Variable references resolved by templated scripts.
+PATHS = ["$user.params[token]", "$meta.sub[0].topic", "$meta.topic"]
+
+
+def bench(name, func, lines):
+    start = time.time()
+    for line in lines:
+        func(line)
+    elapsed = time.time() - start
+    print("{0}: {1} lines in {2:.3f}s, {3:.0f} lines/s".format(name, len(lines), elapsed, len(lines) / elapsed))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure parsing and serialization speed of tn-cli commands')
+    parser.add_argument('--lines', type=int, default=50000, help='number of lines to process')
+    args = parser.parse_args()
+
+    commands.set_macros_module(macros)
+    tn_globals.IsInteractive = False
+    cli_args = dotdict({'no_cookie': True})
+    lines = [SAMPLE[i % len(SAMPLE)] for i in range(args.lines)]
+
+    # Responses referenced by the sample lines.
+    tn_globals.Variables['$user'] = pb.ServerCtrl(id='1', code=200, params={'token': b'"AbCdEf"'})
+    tn_globals.Variables['$meta'] = pb.ServerMeta(id='2', topic='fnd', sub=[pb.TopicSub(topic='grpAbCdEf')])
+
+    bench("getVar", commands.getVar, [PATHS[i % len(PATHS)] for i in range(args.lines)])
+    bench("parse_input", commands.parse_input, lines)
+    bench("serialize_cmd", lambda line: commands.serialize_cmd(line, 1000, cli_args), lines)
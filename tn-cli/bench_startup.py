@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""Benchmark of tn-cli start-up time. Starts tn-cli.py in a new interpreter with -X importtime
+several times, prints the median wall time of the runs and the modules which took the longest
+to import. Does not connect to the server unless the arguments tell it to.
+
+Run it as
+
+    python bench_startup.py [--runs 10] [--top 15] [-- tn-cli arguments, default --version]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tn-cli.py')
+
+
+# Parse -X importtime output: returns {module: (self time, cumulative time)} in microseconds.
+def parse_importtime(stderr):
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or not parts[0].strip().isdigit():
+            # Header line.
+            continue
+        modules[parts[2].strip()] = (int(parts[0]), int(parts[1]))
+    return modules
+
+
+# Start tn-cli once. Returns (wall time in seconds, modules).
+def run_once(cli_args):
+    start = time.time()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', SCRIPT] + cli_args,
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    return time.time() - start, parse_importtime(proc.stderr)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure tn-cli start-up time')
+    parser.add_argument('--runs', type=int, default=10, help='number of runs, default 10')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest modules to print, default 15')
+    parser.add_argument('cli_args', nargs=argparse.REMAINDER, help='arguments of tn-cli.py after --')
+    args = parser.parse_args()
+
+    cli_args = args.cli_args[1:] if args.cli_args[:1] == ['--'] else args.cli_args
+    cli_args = cli_args or ['--version']
+
+    times = []
+    totals = {}
+    for _ in range(max(1, args.runs)):
+        elapsed, modules = run_once(cli_args)
+        times.append(elapsed)
+        for name, (self_us, _) in modules.items():
+            totals[name] = totals.get(name, 0) + self_us
+        imported = modules
+
+    times.sort()
+    print("tn-cli.py {0}: median {1:.1f} ms, min {2:.1f} ms, max {3:.1f} ms over {4} runs".format(
+        ' '.join(cli_args), times[len(times) // 2] * 1000, times[0] * 1000, times[-1] * 1000, len(times)))
+    print("{0} modules imported, {1:.1f} ms of import time per run".format(
+        len(imported), sum(totals.values()) / 1000.0 / len(times)))
+    for name in ['grpc', 'tinode_grpc', 'google.protobuf', 'PIL', 'requests', 'prompt_toolkit']:
+        if name in imported:
+            print("  {0:<20} cumulative {1:.1f} ms".format(name, imported[name][1] / 1000.0))
+    print("{0:<40}{1:>12}".format('slowest modules (self time)', 'ms per run'))
+    for name in sorted(totals, key=totals.get, reverse=True)[:args.top]:
+        print("{0:<40}{1:>12.2f}".format(name, totals[name] / 1000.0 / len(times)))
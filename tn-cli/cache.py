@@ -0,0 +1,136 @@
+"""Size-bounded on-disk cache of files.
+
+Entries are keyed by an arbitrary string, e.g. a file URI. Content is stored in files named
+after the hash of the key, metadata is kept in an index file. When the total size of the
+content exceeds the limit, the least recently used entries are evicted."""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+INDEX_FILE = 'index.json'
+
+
+class DiskCache:
+    """LRU cache of files in a directory. Safe to use from multiple threads."""
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = self.load_index()
+        self.size = sum(entry['size'] for entry in self.entries.values())
+
+    def load_index(self):
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE), 'r') as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        # Drop entries with missing content.
+        return {key: entry for key, entry in entries.items() if os.path.exists(self.path(entry))}
+
+    def save_index(self):
+        tmp = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, os.path.join(self.directory, INDEX_FILE))
+
+    def path(self, entry):
+        return os.path.join(self.directory, entry['file'])
+
+    def get(self, key):
+        """Returns (path to content, info) or (None, None) if the key is not cached."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or not os.path.exists(self.path(entry)):
+                return None, None
+            return self.path(entry), entry['info']
+
+    def hit(self, key):
+        """Mark the entry as used."""
+        with self.lock:
+            self.hits += 1
+            entry = self.entries.get(key)
+            if entry:
+                entry['used'] = time.time()
+                self.save_index()
+
+    def miss(self):
+        with self.lock:
+            self.misses += 1
+
+    def put(self, key, src, info):
+        """Copy file src into the cache. Returns False if the file is too big to be cached."""
+        size = os.path.getsize(src)
+        if size > self.max_size:
+            return False
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        tmp = os.path.join(self.directory, name + '.tmp')
+        shutil.copyfile(src, tmp)
+        self.add(key, name, size, info)
+        return True
+
+    def put_data(self, key, data, info):
+        """Store bytes in the cache. Returns False if the data is too big to be cached."""
+        if len(data) > self.max_size:
+            return False
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        with open(os.path.join(self.directory, name + '.tmp'), 'wb') as f:
+            f.write(data)
+        self.add(key, name, len(data), info)
+        return True
+
+    def add(self, key, name, size, info):
+        """Add content written to '<name>.tmp' to the cache."""
+        tmp = os.path.join(self.directory, name + '.tmp')
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old:
+                self.size -= old['size']
+            os.replace(tmp, os.path.join(self.directory, name))
+            self.entries[key] = {'file': name, 'size': size, 'used': time.time(), 'info': info}
+            self.size += size
+            self.evict()
+            self.save_index()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits into max_size."""
+        if self.size <= self.max_size:
+            return
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['used']):
+            if self.size <= self.max_size:
+                break
+            entry = self.entries.pop(key)
+            self.size -= entry['size']
+            self.evictions += 1
+            try:
+                os.remove(self.path(entry))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                try:
+                    os.remove(self.path(entry))
+                except OSError:
+                    pass
+            self.entries = {}
+            self.size = 0
+            self.save_index()
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'size': self.size, 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
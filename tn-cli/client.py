@@ -4,6 +4,7 @@ from __future__ import print_function
 
 import grpc
 import json
+import re
 import sys
 import time
 
@@ -11,15 +12,46 @@ from tinode_grpc import pb
 from tinode_grpc import pbx
 
 import tn_globals
+from stats import Collector
 from tn_globals import printerr, stdoutln, to_json
 from utils import dotdict
 
-# 5 seconds timeout for .await/.must commands.
-AWAIT_TIMEOUT = 5
+# Regex to find variable references in the input line.
+RE_VARREF = re.compile(r"\$\w+")
 
+# Commands which terminate the session.
+EXIT_COMMANDS = ['exit', 'quit', '.exit', '.quit']
+
+# Commands which wait for all outstanding synchronous requests to complete.
+BARRIERS = ['.barrier'] + EXIT_COMMANDS
+
+# Delay before the first reconnect attempt in seconds; doubled after every failed attempt, up to MAX_BACKOFF.
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# gRPC errors after which the connection is restored, e.g. the server is restarting.
+RECONNECT_ERRORS = [grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.INTERNAL, grpc.StatusCode.ABORTED]
+
+# Outstanding requests which are safe to send again after reconnect. Others fail with 503.
+REPLAY_COMMANDS = ['sub', 'leave', 'get', 'set']
+
+
+# Handle {ctrl} server response. 'lost' is set for responses made up by the client when the connection is lost.
+def handle_ctrl(ctrl, lost=False):
+    from commands import setVar
+
+    # Keep track of attached topics to restore subscriptions after reconnect.
+    attaching = tn_globals.Attaching.pop(ctrl.id, None)
+    if attaching and ctrl.code >= 200 and ctrl.code < 400:
+        what, topic = attaching
+        if what == 'sub':
+            tn_globals.AttachedTopics.add(ctrl.topic or topic)
+        else:
+            tn_globals.AttachedTopics.discard(ctrl.topic or topic)
+    elif attaching and attaching[0] == 'sub' and ctrl.code >= 400:
+        # E.g. the topic was deleted while the connection was lost.
+        tn_globals.AttachedTopics.discard(attaching[1])
 
-# Handle {ctrl} server response
-def handle_ctrl(ctrl):
     # Run code on command completion
     func = tn_globals.OnCompletion.get(ctrl.id)
     if func:
@@ -27,12 +59,17 @@ def handle_ctrl(ctrl):
         if ctrl.code >= 200 and ctrl.code < 400:
             func(ctrl.params)
 
-    if tn_globals.WaitingFor and tn_globals.WaitingFor.await_id == ctrl.id:
-        if 'varname' in tn_globals.WaitingFor:
-            tn_globals.Variables[tn_globals.WaitingFor.varname] = ctrl
-        if tn_globals.WaitingFor.failOnError and ctrl.code >= 400:
+    waiting = tn_globals.InFlight.pop(ctrl.id, None)
+    if waiting:
+        if 'varname' in waiting:
+            setVar(waiting.varname, ctrl, getattr(waiting, 'projection', None))
+        if 'step' in waiting:
+            waiting.step.respond(ctrl.code, ctrl.text, lost)
+        tn_globals.wakeup()
+        if waiting.failOnError and ctrl.code >= 400:
             raise Exception(str(ctrl.code) + " " + ctrl.text)
-        tn_globals.WaitingFor = None
+        if 'quiet' in waiting:
+            return
 
     topic = " (" + str(ctrl.topic) + ")" if ctrl.topic else ""
     stdoutln("\r<= " + str(ctrl.code) + " " + ctrl.text + topic)
@@ -81,6 +118,86 @@ def read_cookie():
         return None
 
 
+# Check if the input line must wait: input is paused by .sleep, the window of
+# synchronous requests is full, the line is a barrier, or it references a variable
+# which is yet to be assigned by an outstanding request.
+def must_wait(inp):
+    if tn_globals.PausedUntil > time.time():
+        return True
+    if hasattr(inp, 'ready'):
+        # Step of a native macro or a bulk run.
+        return not inp.ready()
+    if not tn_globals.InFlight:
+        return False
+    if len(tn_globals.InFlight) >= tn_globals.SyncWindow:
+        return True
+    if hasattr(inp, 'refs'):
+        # Precompiled frame.
+        refs = inp.refs
+    else:
+        parts = inp.split(None, 1)
+        if parts and parts[0] in BARRIERS:
+            return True
+        refs = RE_VARREF.findall(inp)
+    if refs:
+        for waiting in list(tn_globals.InFlight.values()):
+            if 'varname' in waiting and waiting.varname in refs:
+                return True
+    return False
+
+
+# Index of the first input which can be processed now or None. Steps of a native macro
+# which wait for other steps are overtaken by the following independent steps.
+def ready_input():
+    queue = tn_globals.InputQueue
+    # The stdin thread only appends to the queue.
+    for i in range(len(queue)):
+        inp = queue[i]
+        step = hasattr(inp, 'ready')
+        if i > 0 and not step:
+            break
+        if not must_wait(inp):
+            return i
+        if not step:
+            break
+    return None
+
+
+# Remove and return the input at the given index of the queue.
+def take_input(index):
+    inp = tn_globals.InputQueue[index]
+    del tn_globals.InputQueue[index]
+    return inp
+
+
+# Drop outstanding requests which timed out. Returns the number of seconds
+# until the next request times out or None if nothing is outstanding.
+def expire_in_flight():
+    timeout = None
+    now = time.time()
+    for waiting in list(tn_globals.InFlight.values()):
+        remaining = waiting.await_ts + waiting.await_timeout - now
+        if remaining <= 0:
+            stdoutln("Timeout while waiting for '{0}' response".format(waiting.cmd))
+            tn_globals.InFlight.pop(waiting.await_id, None)
+            Collector.on_lost(waiting.await_id)
+            if 'step' in waiting:
+                waiting.step.respond(504, "timeout", True)
+        elif timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+
+# Seconds until the state must be checked again: the next request times out or
+# the .sleep pause ends. None if there is nothing to wait for.
+def wait_timeout():
+    timeout = expire_in_flight()
+    pause = tn_globals.PausedUntil - time.time()
+    if pause > 0 and (timeout is None or pause < timeout):
+        timeout = pause
+    return timeout
+
+
 def pop_from_output_queue():
     if tn_globals.OutputQueue.empty():
         return False
@@ -89,41 +206,21 @@ def pop_from_output_queue():
     return True
 
 
-# Generator of protobuf messages.
-def gen_message(scheme, secret, args):
-    """Client message generator: reads user input as string,
-    converts to pb.ClientMsg, and yields"""
-    import random
-    import threading
-    from input_handler import stdin
-    from commands import hiMsg, loginMsg, serialize_cmd
-
-    random.seed()
-    id = random.randint(10000,60000)
-
-    # Asynchronous input-output
-    tn_globals.InputThread = threading.Thread(target=stdin, args=(tn_globals.InputQueue,))
-    tn_globals.InputThread.daemon = True
-    tn_globals.InputThread.start()
-
-    try:
-        from importlib.metadata import version
-    except ImportError:
-        from importlib_metadata import version
+# Format User-Agent string for the {hi} message.
+def user_agent():
     import platform
 
-    APP_NAME = "tn-cli"
-    APP_VERSION = "3.0.1"
-    LIB_VERSION = version("tinode_grpc")
-    GRPC_VERSION = version("grpcio")
+    lib_version, grpc_version = tn_globals.lib_versions()
+    return tn_globals.APP_NAME + "/" + tn_globals.APP_VERSION + " (" + \
+        platform.system() + "/" + platform.release() + "); gRPC-python/" + lib_version + "+" + grpc_version, lib_version
 
-    user_agent = APP_NAME + "/" + APP_VERSION + " (" + \
-        platform.system() + "/" + platform.release() + "); gRPC-python/" + LIB_VERSION + "+" + GRPC_VERSION
 
-    msg = hiMsg(id, args.background, user_agent, LIB_VERSION)
-    if tn_globals.Verbose:
-        stdoutln("\r=> " + to_json(msg))
-    yield msg
+# Messages which start the session: {hi} and optional {login}.
+def hello_messages(id, scheme, secret, args):
+    from commands import hiMsg, loginMsg
+
+    agent, lib_version = user_agent()
+    messages = [hiMsg(id, args.background, agent, lib_version)]
 
     if scheme != None:
         id += 1
@@ -131,45 +228,219 @@ def gen_message(scheme, secret, args):
         setattr(login, 'scheme', scheme)
         setattr(login, 'secret', secret)
         setattr(login, 'cred', None)
-        msg = loginMsg(id, login, args)
-        if tn_globals.Verbose:
+        messages.append(loginMsg(id, login, args))
+
+    if tn_globals.Verbose:
+        for msg in messages:
             stdoutln("\r=> " + to_json(msg))
+    return messages
+
+
+# Convert input line or precompiled frame to a protobuf message ready to be sent to the server.
+# Local commands are executed, macros are expanded and pushed back on the input queue.
+# Returns None if there is nothing to send.
+def prepare_message(inp, id, args):
+    from commands import serialize_cmd
+
+    if hasattr(inp, 'build'):
+        pbMsg, cmd = inp.build(id, args)
+    else:
+        pbMsg, cmd = serialize_cmd(inp, id, args)
+    if isinstance(cmd, list):
+        # Push the expanded macro back on the command queue. Text commands
+        # depend on each other: run them in order. Native steps list their dependencies.
+        steps = []
+        for step in cmd:
+            if steps and isinstance(step, str):
+                steps.append('.barrier')
+            steps.append(step)
+        tn_globals.InputQueue.extendleft(reversed(steps))
+        return None
+
+    if pbMsg == None:
+        return None
+
+    if not tn_globals.IsInteractive and 'quiet' not in cmd:
+        sys.stdout.write("=> " + str(inp) + "\n")
+        sys.stdout.flush()
+
+    if cmd.synchronous:
+        cmd.await_ts = time.time()
+        cmd.await_id = str(id)
+        cmd.await_timeout = args.await_timeout
+        tn_globals.InFlight[cmd.await_id] = cmd
+
+    if hasattr(cmd, 'no_yield'):
+        return None
+
+    if cmd.synchronous:
+        # Sent again or failed if the connection is lost before the response.
+        cmd.message = pbMsg
+
+    if tn_globals.Verbose:
+        stdoutln("\r=> " + to_json(pbMsg))
+    return pbMsg
+
+
+class Request:
+    """pb.ClientMsg pushed on the input queue and sent when it is ready, e.g. a step of a native
+    macro. The response is delivered to respond() by the response handlers.
+    * must - fail the script if the response is an error.
+    * quiet - do not print the request and the response."""
+
+    def __init__(self, msg=None, must=False, quiet=False):
+        self.msg = msg
+        self.must = must
+        self.quiet = quiet
+        # Id of the message once sent, response code and text.
+        self.id = None
+        self.code = None
+        self.reason = ''
+        # The response was not received from the server: the request timed out or the connection was lost.
+        self.lost = False
+
+    def ready(self):
+        return True
+
+    def done(self):
+        return self.id is not None and self.id not in tn_globals.InFlight
+
+    def failed(self):
+        return self.code is not None and self.code >= 400
+
+    def respond(self, code, reason, lost=False):
+        self.code = code
+        self.reason = reason
+        self.lost = lost
+
+    def build(self, id, args):
+        """Returns the message with the given id and the command description in the same
+        format as serialize_cmd."""
+        import argparse
+
+        what = self.msg.WhichOneof('Message')
+        self.id = str(id)
+        getattr(self.msg, what).id = self.id
+        cmd = argparse.Namespace(cmd=what, synchronous=True, failOnError=self.must, step=self)
+        if self.quiet:
+            cmd.quiet = True
+        return self.msg, cmd
+
+
+# Account for the message being sent to the server.
+def message_sent(msg):
+    Collector.on_send(msg)
+    what = msg.WhichOneof('Message')
+    if what in ['sub', 'leave'] and not msg.extra.on_behalf_of:
+        tn_globals.Attaching[getattr(msg, what).id] = (what, getattr(msg, what).topic)
+    if tn_globals.Recorder:
+        tn_globals.Recorder.client(msg)
+
+
+class LoopState:
+    """State of the message loop kept across reconnects."""
+
+    def __init__(self):
+        import random
+
+        random.seed()
+        # Last used message id.
+        self.id = random.randint(10000,60000)
+        # Number of closed MessageLoop calls. The generator of a closed call stops taking input.
+        self.calls = 0
+        # Messages received in the current call.
+        self.received = 0
+        # Input ended with an exit command.
+        self.finished = False
+
+    def next_id(self):
+        self.id += 1
+        return self.id
+
+    def close(self):
+        """The call failed: stop taking input until the connection is restored."""
+        self.calls += 1
+        self.received = 0
+        # Responses to requests sent in the failed call will never arrive.
+        tn_globals.Attaching.clear()
+        tn_globals.wakeup()
+
+
+# Messages which restore the session after reconnect: {hi}, {login} with the last obtained token,
+# {sub} to the topics which were attached and outstanding requests which are safe to repeat.
+def resume_messages(state, scheme, secret, args):
+    if tn_globals.AuthToken:
+        scheme, secret = 'token', tn_globals.AuthToken
+    messages = hello_messages(state.next_id(), scheme, secret, args)
+    state.next_id()
+    topics = sorted(tn_globals.AttachedTopics)
+    for topic in topics:
+        messages.append(pb.ClientMsg(sub=pb.ClientSub(id=str(state.next_id()), topic=topic)))
+    replayed = [waiting for waiting in tn_globals.InFlight.values() if 'message' in waiting]
+    for waiting in replayed:
+        waiting.await_ts = time.time()
+        messages.append(waiting.message)
+    printerr("Restoring session: {0} topics to subscribe, {1} requests to send again".format(len(topics), len(replayed)))
+    return messages
+
+
+# Fail outstanding requests which are not safe to repeat after the connection is lost.
+# Raises an exception if any of them was sent with .must.
+def fail_in_flight():
+    for waiting in list(tn_globals.InFlight.values()):
+        if 'message' in waiting and waiting.message.WhichOneof('Message') not in REPLAY_COMMANDS:
+            Collector.on_lost(waiting.await_id)
+            handle_ctrl(pb.ServerCtrl(id=waiting.await_id, code=503, text="connection lost"), True)
+
+
+# Generator of protobuf messages.
+def gen_message(scheme, secret, args, state):
+    """Client message generator: reads user input as string,
+    converts to pb.ClientMsg, and yields"""
+    import threading
+    from input_handler import stdin
+
+    call = state.calls
+    if call == 0:
+        if args.replay:
+            # Precompiled script replaces stdin.
+            from precompile import load_frames
+            load_frames(args.replay)
+        else:
+            # Asynchronous input-output
+            tn_globals.InputThread = threading.Thread(target=stdin, args=(tn_globals.InputQueue,))
+            tn_globals.InputThread.daemon = True
+            tn_globals.InputThread.start()
+        hello = hello_messages(state.next_id(), scheme, secret, args)
+        state.next_id()
+    else:
+        hello = resume_messages(state, scheme, secret, args)
+
+    for msg in hello:
+        message_sent(msg)
         yield msg
 
-    print_prompt = True
+    print_prompt = call == 0 or tn_globals.IsInteractive
 
-    while True:
+    while state.calls == call:
         try:
-            if not tn_globals.WaitingFor and tn_globals.InputQueue:
-                id += 1
-                inp = tn_globals.InputQueue.popleft()
+            index = ready_input()
+            if index is not None:
+                id = state.next_id()
+                inp = take_input(index)
 
-                if inp == 'exit' or inp == 'quit' or inp == '.exit' or inp == '.quit':
+                if inp in EXIT_COMMANDS:
                     # Drain the output queue.
                     while pop_from_output_queue():
                         pass
+                    state.finished = True
                     return
 
-                pbMsg, cmd = serialize_cmd(inp, id, args)
+                pbMsg = prepare_message(inp, id, args)
                 print_prompt = tn_globals.IsInteractive
-                if isinstance(cmd, list):
-                    # Push the expanded macro back on the command queue.
-                    tn_globals.InputQueue.extendleft(reversed(cmd))
-                    continue
                 if pbMsg != None:
-                    if not tn_globals.IsInteractive:
-                        sys.stdout.write("=> " + inp + "\n")
-                        sys.stdout.flush()
-
-                    if cmd.synchronous:
-                        cmd.await_ts = time.time()
-                        cmd.await_id = str(id)
-                        tn_globals.WaitingFor = cmd
-
-                    if not hasattr(cmd, 'no_yield'):
-                        if tn_globals.Verbose:
-                            stdoutln("\r=> " + to_json(pbMsg))
-                        yield pbMsg
+                    message_sent(pbMsg)
+                    yield pbMsg
 
             elif not tn_globals.OutputQueue.empty():
                 pop_from_output_queue()
@@ -180,91 +451,170 @@ def gen_message(scheme, secret, args):
                     sys.stdout.write("tn> ")
                     sys.stdout.flush()
                     print_prompt = False
-                if tn_globals.WaitingFor:
-                    if time.time() - tn_globals.WaitingFor.await_ts > AWAIT_TIMEOUT:
-                        stdoutln("Timeout while waiting for '{0}' response".format(tn_globals.WaitingFor.cmd))
-                        tn_globals.WaitingFor = None
 
-                if tn_globals.IsInteractive:
-                    time.sleep(0.1)
-                else:
-                    time.sleep(0.01)
+                # Block until the stdin thread, the response reader or an upload thread
+                # changes the state. The check is repeated under the lock so a wake-up
+                # issued after the checks above is not lost.
+                with tn_globals.Wakeup:
+                    timeout = wait_timeout()
+                    if ready_input() is None and \
+                            tn_globals.OutputQueue.empty() and state.calls == call:
+                        tn_globals.Wakeup.wait(timeout)
 
         except Exception as err:
             stdoutln("Exception in generator: {0}".format(err))
 
 
+# Print {data} message.
+def print_data(data):
+    stdoutln("\n\rFrom: " + data.from_user_id)
+    stdoutln("Topic: " + data.topic)
+    stdoutln("Seq: " + str(data.seq_id))
+    if data.head:
+        stdoutln("Headers:")
+        for key in data.head:
+            stdoutln("\t" + key + ": "+str(data.head[key]))
+    stdoutln(json.loads(data.content))
+
+
+# Handle one message received from the server.
+def handle_server_msg(msg):
+    if tn_globals.Recorder:
+        tn_globals.Recorder.server(msg)
+
+    if tn_globals.Verbose:
+        stdoutln("\r<= " + to_json(msg))
+
+    if msg.HasField("ctrl"):
+        Collector.on_response(msg.ctrl.id)
+        handle_ctrl(msg.ctrl)
+
+    elif msg.HasField("meta"):
+        from commands import setVar
+
+        Collector.on_response(msg.meta.id)
+        what = []
+        if len(msg.meta.sub) > 0:
+            what.append("sub")
+        if msg.meta.HasField("desc"):
+            what.append("desc")
+        if msg.meta.HasField("del"):
+            what.append("del")
+        if len(msg.meta.tags) > 0:
+            what.append("tags")
+        stdoutln("\r<= meta " + ",".join(what) + " " + msg.meta.topic)
+
+        waiting = tn_globals.InFlight.pop(msg.meta.id, None)
+        if waiting:
+            if 'varname' in waiting:
+                setVar(waiting.varname, msg.meta, getattr(waiting, 'projection', None))
+            if 'on_meta' in waiting:
+                waiting.on_meta(msg.meta)
+            if 'step' in waiting:
+                waiting.step.respond(200, "ok")
+            tn_globals.wakeup()
+
+    elif msg.HasField("data"):
+        # Messages of a topic being exported are written to the file.
+        sink = tn_globals.DataSinks.get(msg.data.topic)
+        if sink is None or not sink(msg.data):
+            print_data(msg.data)
+
+    elif msg.HasField("pres"):
+        # 'ON', 'OFF', 'UA', 'UPD', 'GONE', 'ACS', 'TERM', 'MSG', 'READ', 'RECV', 'DEL', 'TAGS', 'AUX'
+        what = pb.ServerPres.What.Name(msg.pres.what)
+        stdoutln("\r<= pres " + what + " " + msg.pres.topic)
+
+    elif msg.HasField("info"):
+        switcher = {
+            pb.READ: 'READ',
+            pb.RECV: 'RECV',
+            pb.KP: 'KP',
+            pb.CALL: 'CALL'
+        }
+        stdoutln("\rMessage #" + str(msg.info.seq_id) + " " + switcher.get(msg.info.what, "unknown") +
+            " by " + msg.info.from_user_id + "; topic=" + msg.info.topic + " (" + msg.topic + ")")
+
+    else:
+        stdoutln("\rMessage type not handled" + str(msg))
+
+
+# Write statistics summary to the file requested with --stats-json.
+def write_stats(args):
+    if args.stats_json:
+        try:
+            Collector.write_json(args.stats_json)
+        except IOError as err:
+            printerr("Failed to write statistics to '{0}':".format(args.stats_json), err)
+
+
+# Create channel with default credentials. The api is either grpc or grpc.aio.
+def open_channel(args, api=grpc, options=()):
+    if args.ssl:
+        opts = (('grpc.ssl_target_name_override', args.ssl_host),) if args.ssl_host else ()
+        return api.secure_channel(args.host, grpc.ssl_channel_credentials(), (opts + tuple(options)) or None)
+    return api.insecure_channel(args.host, tuple(options) or None)
+
+
 # The main processing loop: send messages to server, receive responses.
 def run(args, schema, secret):
+    from recorder import start_recording, stop_recording
+    from commands import wait_transfers
+    from uploader import wait_uploads
+
+    import random
+
     failed = False
+    state = LoopState()
+    attempt = 0
+    delay = BACKOFF
     try:
-        from prompt_toolkit import PromptSession
-
         if tn_globals.IsInteractive:
+            # prompt_toolkit is slow to load and not used by scripts.
+            from prompt_toolkit import PromptSession
             tn_globals.Prompt = PromptSession()
-        # Create channel with default credentials.
         tn_globals.Connection = None
-        if args.ssl:
-            opts = (('grpc.ssl_target_name_override', args.ssl_host),) if args.ssl_host else None
-            tn_globals.Connection = grpc.secure_channel(args.host, grpc.ssl_channel_credentials(), opts)
-        else:
-            tn_globals.Connection = grpc.insecure_channel(args.host)
-
-        # Call the server
-        stream = pbx.NodeStub(tn_globals.Connection).MessageLoop(gen_message(schema, secret, args))
-
-        # Read server responses
-        for msg in stream:
-            if tn_globals.Verbose:
-                stdoutln("\r<= " + to_json(msg))
-
-            if msg.HasField("ctrl"):
-                handle_ctrl(msg.ctrl)
-
-            elif msg.HasField("meta"):
-                what = []
-                if len(msg.meta.sub) > 0:
-                    what.append("sub")
-                if msg.meta.HasField("desc"):
-                    what.append("desc")
-                if msg.meta.HasField("del"):
-                    what.append("del")
-                if len(msg.meta.tags) > 0:
-                    what.append("tags")
-                stdoutln("\r<= meta " + ",".join(what) + " " + msg.meta.topic)
-
-                if tn_globals.WaitingFor and tn_globals.WaitingFor.await_id == msg.meta.id:
-                    if 'varname' in tn_globals.WaitingFor:
-                        tn_globals.Variables[tn_globals.WaitingFor.varname] = msg.meta
-                    tn_globals.WaitingFor = None
-
-            elif msg.HasField("data"):
-                stdoutln("\n\rFrom: " + msg.data.from_user_id)
-                stdoutln("Topic: " + msg.data.topic)
-                stdoutln("Seq: " + str(msg.data.seq_id))
-                if msg.data.head:
-                    stdoutln("Headers:")
-                    for key in msg.data.head:
-                        stdoutln("\t" + key + ": "+str(msg.data.head[key]))
-                stdoutln(json.loads(msg.data.content))
-
-            elif msg.HasField("pres"):
-                # 'ON', 'OFF', 'UA', 'UPD', 'GONE', 'ACS', 'TERM', 'MSG', 'READ', 'RECV', 'DEL', 'TAGS', 'AUX'
-                what = pb.ServerPres.What.Name(msg.pres.what)
-                stdoutln("\r<= pres " + what + " " + msg.pres.topic)
-
-            elif msg.HasField("info"):
-                switcher = {
-                    pb.READ: 'READ',
-                    pb.RECV: 'RECV',
-                    pb.KP: 'KP',
-                    pb.CALL: 'CALL'
-                }
-                stdoutln("\rMessage #" + str(msg.info.seq_id) + " " + switcher.get(msg.info.what, "unknown") +
-                    " by " + msg.info.from_user_id + "; topic=" + msg.info.topic + " (" + msg.topic + ")")
-
-            else:
-                stdoutln("\rMessage type not handled" + str(msg))
+        start_recording(args)
+
+        while True:
+            # Create channel with default credentials.
+            tn_globals.Connection = open_channel(args)
+            failure = None
+            try:
+                # Call the server
+                stream = pbx.NodeStub(tn_globals.Connection).MessageLoop(gen_message(schema, secret, args, state))
+
+                # Read server responses
+                for msg in stream:
+                    state.received += 1
+                    handle_server_msg(msg)
+                if state.finished:
+                    break
+                error = "stream closed by server"
+            except grpc.RpcError as err:
+                if state.finished or err.code() not in RECONNECT_ERRORS:
+                    raise
+                failure = err
+                error = "{0}: {1}".format(err.code(), err.details())
+
+            if state.received:
+                # The connection worked for a while: start over.
+                attempt = 0
+                delay = BACKOFF
+            state.close()
+            if attempt >= args.reconnect:
+                if failure:
+                    raise failure
+                break
+            tn_globals.Connection.close()
+            attempt += 1
+            fail_in_flight()
+            # Jitter keeps many clients from reconnecting at the same time.
+            wait = random.uniform(delay / 2, delay)
+            printerr("Connection lost ({0}), reconnecting in {1:.1f}s, attempt {2} of {3}".format(
+                error, wait, attempt, args.reconnect))
+            time.sleep(wait)
+            delay = min(delay * 2, MAX_BACKOFF)
 
     except grpc.RpcError as err:
         # print(err)
@@ -276,8 +626,15 @@ def run(args, schema, secret):
     finally:
         from tn_globals import printout
         printout('Shutting down...')
+        wait_transfers()
+        wait_uploads()
+        # Print results of uploads completed after the end of input.
+        while pop_from_output_queue():
+            pass
         tn_globals.Connection.close()
         if tn_globals.InputThread != None:
             tn_globals.InputThread.join(0.3)
+        stop_recording()
+        write_stats(args)
 
     return 1 if failed else 0
@@ -5,26 +5,23 @@ from __future__ import print_function
 import argparse
 import base64
 import json
-import mimetypes
 import os
 import re
-import requests
 import shlex
 import threading
 import time
 
 from tinode_grpc import pb
-from tinode_grpc import pbx
 
 import tn_globals
+from stats import Collector, timed
 from tn_globals import printout, stdoutln
 from utils import (
     makeTheCard, inline_image, attachment, encode_to_bytes,
-    parse_cred, parse_trusted, dotdict, DELETE_MARKER, TINODE_DEL
+    parse_cred, parse_trusted, DELETE_MARKER, TINODE_DEL,
+    MAX_INBAND_ATTACHMENT_SIZE, MAX_EXTERN_ATTACHMENT_SIZE
 )
 
-APP_NAME = "tn-cli"
-APP_VERSION = "3.0.1"
 PROTOCOL_VERSION = "0"
 
 # Regex to match and parse subscripted entries in variable paths.
@@ -38,6 +35,7 @@ def set_macros_module(m):
     """Set the macros module for use in command parsing."""
     global macros
     macros = m
+    Parsers.clear()
 
 
 # Create proto for ClientExtra
@@ -45,42 +43,152 @@ def pack_extra(cmd):
     return pb.ClientExtra(on_behalf_of=tn_globals.DefaultUser, auth_level=pb.ROOT if cmd.as_root else pb.NONE)
 
 
+# Maximum number of compiled variable references kept in VarPaths.
+MAX_VAR_PATHS = 4096
+
+# Compiled variable references: path -> accessor function.
+VarPaths = {}
+
+
+# Compile reference like $meta.sub[1].user into a function which takes variables and returns the value.
+def compile_var_path(path):
+    parts = path.split('.')
+    name = parts[0]
+    # Steps of the path: (attribute, index or None).
+    steps = []
+    for p in parts[1:]:
+        m = RE_INDEX.match(p)
+        if m:
+            steps.append((m.group(1), int(m.group(2)) if m.group(2).isdigit() else m.group(2)))
+        else:
+            steps.append((p, None))
+    steps = tuple(steps)
+
+    def accessor(variables):
+        if name not in variables:
+            return None
+        var = variables[name]
+        for attr, index in steps:
+            var = getattr(var, attr)
+            if index is not None:
+                var = var[index]
+        if isinstance(var, bytes):
+            var = var.decode('utf-8')
+        return var
+
+    return accessor
+
+
 # Read a value in the server response using dot notation, i.e.
 # $user.params.token or $meta.sub[1].user
-def getVar(path):
+def getVar(path, variables=None):
     if not path.startswith("$"):
         return path
 
-    parts = path.split('.')
-    if parts[0] not in tn_globals.Variables:
-        return None
-    var = tn_globals.Variables[parts[0]]
-    if len(parts) > 1:
-        parts = parts[1:]
-        for p in parts:
-            x = None
-            m = RE_INDEX.match(p)
-            if m:
-                p = m.group(1)
-                if m.group(2).isdigit():
-                    x = int(m.group(2))
+    accessor = VarPaths.get(path)
+    if accessor is None:
+        if len(VarPaths) >= MAX_VAR_PATHS:
+            VarPaths.clear()
+        accessor = VarPaths[path] = compile_var_path(path)
+    return accessor(tn_globals.Variables if variables is None else variables)
+
+
+# Compiled projections: text -> list of paths.
+Projections = {}
+
+
+# Parse projection like 'sub[*].topic,desc.public,params[token]' into a list of paths.
+# A path is a list of (field name, index) steps; the index is None for the whole field,
+# '*' for all elements of a repeated field, or a map key.
+def compile_projection(text):
+    paths = Projections.get(text)
+    if paths is None:
+        paths = []
+        for expr in text.split(','):
+            steps = []
+            for p in expr.strip().split('.'):
+                m = RE_INDEX.match(p) or re.match(r"(\w+)\[(\*)\]$", p)
+                if m:
+                    steps.append((m.group(1), m.group(2)))
+                elif re.match(r"\w+$", p):
+                    steps.append((p, None))
                 else:
-                    x = m.group(2)
-            var = getattr(var, p)
-            if x or x == 0:
-                var = var[x]
-    if isinstance(var, bytes):
-      var = var.decode('utf-8')
-    return var
+                    raise ValueError("invalid projection '{0}'".format(expr))
+            paths.append(steps)
+        Projections[text] = paths
+    return paths
+
+
+# Copy fields selected by the path from protobuf message src to dst.
+def copy_fields(src, dst, path):
+    name, index = path[0]
+    rest = path[1:]
+    field = src.DESCRIPTOR.fields_by_name.get(name)
+    if field is None:
+        raise ValueError("{0} has no field '{1}'".format(src.DESCRIPTOR.name, name))
+    value = getattr(src, name)
+    if hasattr(value, 'keys'):
+        # Map.
+        target = getattr(dst, name)
+        for key in (value if index in (None, '*') else [index] if index in value else []):
+            if hasattr(value[key], 'CopyFrom'):
+                target[key].CopyFrom(value[key])
+            else:
+                target[key] = value[key]
+    elif hasattr(value, 'extend'):
+        # Repeated field.
+        if index not in (None, '*'):
+            raise ValueError("use {0}[*] to select elements of '{0}'".format(name))
+        target = getattr(dst, name)
+        if field.message_type is None:
+            if not target:
+                target.extend(value)
+            return
+        for i, item in enumerate(value):
+            while len(target) <= i:
+                target.add()
+            if rest:
+                copy_fields(item, target[i], rest)
+            else:
+                target[i].MergeFrom(item)
+    elif field.message_type is not None:
+        if not src.HasField(name):
+            return
+        if rest:
+            copy_fields(value, getattr(dst, name), rest)
+        else:
+            getattr(dst, name).MergeFrom(value)
+    else:
+        setattr(dst, name, value)
+
+
+# Store value in a variable. If projection is given, only the selected fields of the
+# value are stored, e.g. 'sub[*].topic' keeps the names of topics of all subscriptions.
+def setVar(varname, value, projection=None, variables=None):
+    if variables is None:
+        variables = tn_globals.Variables
+    if projection and hasattr(value, 'DESCRIPTOR'):
+        try:
+            projected = type(value)()
+            for path in compile_projection(projection):
+                copy_fields(value, projected, path)
+            value = projected
+        except ValueError as err:
+            stdoutln("Error in projection of {0}: {1}; storing the whole value".format(varname, err))
+    variables[varname] = value
 
 
 # Dereference values, i.e. cmd.val == $usr => cmd.val == <actual value of usr>
 def derefVals(cmd):
-    for key in dir(cmd):
-        if not key.startswith("__") and key != 'varname':
-            val = getattr(cmd, key)
-            if type(val) is str and val.startswith("$"):
+    # Only the fields of the command, not methods and attributes of the class.
+    for key, val in list(vars(cmd).items()):
+        if key == 'varname' or key == 'projection':
+            continue
+        if type(val) is str:
+            if val.startswith("$"):
                 setattr(cmd, key, getVar(val))
+        elif type(val) is list:
+            setattr(cmd, key, [getVar(v) if type(v) is str and v.startswith("$") else v for v in val])
     return cmd
 
 
@@ -139,17 +247,20 @@ def loginMsg(id, cmd, args):
         # All other schemes: assume secret is a base64-encoded string
         cmd.secret = base64.b64decode(cmd.secret)
 
-    from client import handle_login, save_cookie
     msg = pb.ClientMsg(login=pb.ClientLogin(id=str(id), scheme=cmd.scheme, secret=cmd.secret,
         cred=parse_cred(cmd.cred)))
+    onLogin(id, args)
+    return msg
+
 
+# Save authentication token when {login} with the given id succeeds.
+def onLogin(id, args):
+    from client import handle_login, save_cookie
     if args.no_cookie or not tn_globals.IsInteractive:
         tn_globals.OnCompletion[str(id)] = lambda params: handle_login(params)
     else:
         tn_globals.OnCompletion[str(id)] = lambda params: save_cookie(params)
 
-    return msg
-
 
 # {sub}
 def subMsg(id, cmd, ignored):
@@ -178,8 +289,18 @@ def leaveMsg(id, cmd, ignored):
         extra=pack_extra(cmd))
 
 
+# Check if the {pub} has an attachment which must be uploaded out of band before the message is sent.
+def uploads_attachment(cmd):
+    if cmd.cmd != 'pub' or not cmd.attachment or cmd.drafty or cmd.image:
+        return False
+    try:
+        return MAX_INBAND_ATTACHMENT_SIZE < os.path.getsize(cmd.attachment) <= MAX_EXTERN_ATTACHMENT_SIZE
+    except OSError:
+        return False
+
+
 # {pub}
-def pubMsg(id, cmd, ignored):
+def pubMsg(id, cmd, args):
     if not cmd.topic:
         cmd.topic = tn_globals.DefaultTopic
 
@@ -195,15 +316,20 @@ def pubMsg(id, cmd, ignored):
 
     content = json.loads(cmd.drafty) if cmd.drafty \
         else inline_image(cmd.image) if cmd.image \
-        else attachment(cmd.attachment) if cmd.attachment \
+        else attachment(cmd.attachment, (lambda filename: cmd.uploaded) if 'uploaded' in cmd else None) if cmd.attachment \
         else cmd.content
 
     if not content:
         return None
 
+    extra = pack_extra(cmd)
+    if cmd.attachment and not (cmd.drafty or cmd.image):
+        # Tell the server that the out-of-band file is used by this message.
+        extra.attachments.extend([ent['data']['ref'] for ent in content['ent'] if 'ref' in ent['data']])
+
     return pb.ClientMsg(pub=pb.ClientPub(id=str(id), topic=cmd.topic, no_echo=True,
         head=head, content=encode_to_bytes(content)),
-        extra=pack_extra(cmd))
+        extra=extra)
 
 
 # {get}
@@ -401,91 +527,75 @@ def noteMsg(id, cmd, ignored):
         extra=pack_extra(cmd))
 
 
-# Upload file out of band over HTTP(S) (not gRPC).
+# Upload files out of band over HTTP(S) (not gRPC). Files are queued and uploaded in the background.
 def upload(id, cmd, args):
-    try:
-        from client import handle_ctrl
-        scheme = 'https' if args.ssl else 'http'
-        try:
-            from importlib.metadata import version
-        except ImportError:
-            from importlib_metadata import version
-        LIB_VERSION = version("tinode_grpc")
-
-        result = requests.post(
-            scheme + '://' + args.web_host + '/v' + PROTOCOL_VERSION + '/file/u/',
-            headers = {
-                'X-Tinode-APIKey': args.api_key,
-                'X-Tinode-Auth': 'Token ' + tn_globals.AuthToken,
-                'User-Agent': APP_NAME + " " + APP_VERSION + "/" + LIB_VERSION
-            },
-            data = {'id': id},
-            files = {'file': (cmd.filename, open(cmd.filename, 'rb'))})
-        handle_ctrl(dotdict(json.loads(result.text)['ctrl']))
-
-    except Exception as ex:
-        stdoutln("Failed to upload '{0}'".format(cmd.filename), ex)
-
+    from uploader import get_uploader
+    uploader = get_uploader(args)
+    for filename in cmd.filename:
+        uploader.submit(id, filename)
     return None
 
 
-def fileUpload(id, cmd, args):
-    def iter_file(filepath, size=1024*1024):
-        _, name = os.path.split(filepath)
-        mimeType = mimetypes.guess_type(filepath)[0]
-        with open(filepath, mode='rb') as fd:
-            try:
-                yield pb.FileUpReq(id=str(id), auth=pb.Auth(scheme='token', secret=tn_globals.AuthToken),
-                                   topic="", meta=pb.FileMeta(name=name, mime_type=mimeType, size=0))
-                while True:
-                    chunk = fd.read(size)
-                    if chunk:
-                        yield pb.FileUpReq(content=chunk)
-                    else:  # Finished.
-                        break
-            except Exception as ex:
-                stdoutln("Failed to read '{0}':".format(cmd.filename), ex)
+# Log result of a large file upload.
+def upload_result(response):
+    if response.code == 200:
+        stdoutln("Upload OK: '{0}' ({1}), size={2}"
+                 .format(response.meta.name, response.meta.mime_type, response.meta.size))
+    else:
+        stdoutln("Upload failed: {0} {1}".format(response.code, response.text))
 
-    try:
-        response = pbx.NodeStub(tn_globals.Connection).LargeFileReceive(iter_file(cmd.filename))
-        if response.code == 200:
-            stdoutln("Upload OK: '{0}' ({1}), size={2}"
-                     .format(response.meta.name, response.meta.mime_type, response.meta.size))
-        else:
-            stdoutln("Upload failed: {0} {1}".format(response.code, response.text))
-    except Exception as ex:
-        stdoutln("Failed to upload '{0}':".format(cmd.filename), ex)
+
+def fileUpload(id, cmd, args):
+    from uploader import UploadStream, large_file_receive, upload_dir
+    if cmd.dir:
+        upload_dir(id, cmd, args)
+    for filename in cmd.filename:
+        try:
+            stream = UploadStream(id, filename)
+            upload_result(large_file_receive(tn_globals.Connection, stream))
+            stdoutln(stream.summary())
+        except Exception as ex:
+            stdoutln("Failed to upload '{0}':".format(filename), ex)
 
 
 def fileDownload(id, cmd, args):
-    req = pb.FileDownReq(id=str(id), auth=pb.Auth(scheme='token', secret=tn_globals.AuthToken),
-                         uri=cmd.filename, if_modified="")
-
-    # Call the server
-    stream = pbx.NodeStub(tn_globals.Connection).LargeFileServe(req)
-    # Read file chunks
-    fd = None
-    for chunk in stream:
-        if chunk:
-            if chunk.code >= 400:
-                stdoutln("Failed to download '{0}': {1} {2}".format(cmd.filename, chunk.code, chunk.text))
-                break
-            if chunk.code >= 300:
-                stdoutln("Use HTTP {0} to download from {1}".format(chunk.code, chunk.redir_url))
-                break
-            if not fd:
-                fd = open(chunk.meta.name, mode='wb')
-            fd.write(chunk.content)
-            continue
-    if fd:
-        fd.close()
+    from downloader import download_files
+    download_files(id, cmd, args)
 
 
-# Given an array of parts, parse commands and arguments
-def parse_cmd(parts):
+# Threads running file transfers.
+TransferThreads = []
+
+
+# Start file transfer in a separate thread.
+def transfer_thread(id, cmd, args):
+    target = timed('file', fileUpload if cmd.what == 'up' else fileDownload)
+    upload_thread = threading.Thread(target=target, args=(id, cmd, args), name="file_" + (cmd.filename or [cmd.dir])[0])
+    upload_thread.start()
+    TransferThreads.append(upload_thread)
+
+
+# Wait for file transfers started with transfer_thread to finish.
+def wait_transfers():
+    while TransferThreads:
+        TransferThreads.pop().join()
+
+
+# Function which starts file transfers in the background (may be replaced by the asyncio engine).
+transfer_runner = transfer_thread
+
+
+def set_transfer_runner(runner):
+    """Set the function which starts file transfers: runner(id, cmd, args)."""
+    global transfer_runner
+    transfer_runner = runner
+
+
+# Create parser for the command with the given name.
+def make_cmd_parser(name):
     parser = None
-    if parts[0] == "acc":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Create or alter an account')
+    if name == "acc":
+        parser = argparse.ArgumentParser(prog=name, description='Create or alter an account')
         parser.add_argument('--user', default='new', help='ID of the account to update')
         parser.add_argument('--scheme', default=None, help='authentication scheme, default=basic')
         parser.add_argument('--secret', default=None, help='secret for authentication')
@@ -502,20 +612,35 @@ def parse_cmd(parts):
         parser.add_argument('--anon', default=None, help='default access mode for anonymous users')
         parser.add_argument('--cred', default=None, help='credentials, comma separated list in method:value format, e.g. email:test@example.com,tel:12345')
         parser.add_argument('--suspend', default=None, help='true to suspend the account, false to un-suspend')
-    elif parts[0] == "del":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Delete message(s), subscription, topic, user')
+    elif name == "del":
+        parser = argparse.ArgumentParser(prog=name, description='Delete message(s), subscription, topic, user')
         parser.add_argument('what', default=None, help='what to delete')
         parser.add_argument('--topic', default=None, help='topic being affected')
         parser.add_argument('--user', default=None, help='either delete this user or a subscription with this user')
         parser.add_argument('--seq', default=None, help='"all" or a list of comma- and dash-separated message IDs to delete, e.g. "1,2,9-12"')
         parser.add_argument('--hard', action='store_true', help='request to hard-delete')
         parser.add_argument('--cred', help='credential to delete in method:value format, e.g. email:test@example.com, tel:12345')
-    elif parts[0] == "file":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Download or upload a large file')
+    elif name == "file":
+        parser = argparse.ArgumentParser(prog=name, description='Download or upload a large file')
         parser.add_argument('--what', default='down', choices=['down', 'up'], help='download \'down\' or upload \'up\'')
-        parser.add_argument('filename', help='name of the file to upload')
-    elif parts[0] == "get":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Query topic for messages or metadata')
+        parser.add_argument('filename', nargs='*', help='name of the file to upload or URI of the file to download')
+        parser.add_argument('--parallel', type=int, default=4, help='maximum number of files to transfer at the same time, default 4')
+        parser.add_argument('--dir', default=None, help='upload files in this directory which were not uploaded before')
+        parser.add_argument('--via', default='grpc', choices=['grpc', 'http'], help='upload --dir over gRPC or HTTP, default grpc')
+        parser.add_argument('--index', default=None, help='index of uploaded files for --dir, default <dir>/.tn-uploads.json')
+        parser.add_argument('--max-age', type=int, default=None, help='upload again content uploaded more than this many seconds ago instead of using the deadline reported by the server; 0 to always reuse')
+    elif name == "export":
+        parser = argparse.ArgumentParser(prog=name, description='Export messages of a topic to a file')
+        parser.add_argument('topic', nargs='?', default=argparse.SUPPRESS, help='topic to export')
+        parser.add_argument('--topic', dest='topic', default=None, help='topic to export')
+        parser.add_argument('--file', default=None, help='output file, compressed if the name ends with .gz; default <topic>.jsonl.gz')
+        parser.add_argument('--format', default=None, choices=['jsonl', 'pb'], help='JSON lines or length-delimited protobuf; default pb for .pb and .pb.gz files, jsonl otherwise')
+        parser.add_argument('--page', type=int, default=100, help='number of messages requested at a time, default 100')
+        parser.add_argument('--window', type=int, default=4, help='maximum number of pages requested at the same time, default 4')
+        parser.add_argument('--since', type=int, default=1, help='export messages starting with this seq id')
+        parser.add_argument('--before', type=int, default=None, help='export messages before this seq id; default all')
+    elif name == "get":
+        parser = argparse.ArgumentParser(prog=name, description='Query topic for messages or metadata')
         parser.add_argument('topic', nargs='?', default=argparse.SUPPRESS, help='topic to query')
         parser.add_argument('--topic', dest='topic', default=None, help='topic to query')
         parser.add_argument('--desc', action='store_true', help='query topic description')
@@ -523,39 +648,49 @@ def parse_cmd(parts):
         parser.add_argument('--tags', action='store_true', help='query topic tags')
         parser.add_argument('--data', action='store_true', help='query topic messages')
         parser.add_argument('--cred', action='store_true', help='query account credentials')
-    elif parts[0] == "leave":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Detach or unsubscribe from topic')
+    elif name == "import":
+        parser = argparse.ArgumentParser(prog=name, description='Publish messages from a file to a topic')
+        parser.add_argument('topic', help='topic to publish to')
+        parser.add_argument('file', help='JSONL file, optionally gzipped, with content and head of messages, e.g. written by export')
+        parser.add_argument('--window', type=int, default=32, help='maximum number of messages waiting for acknowledgement, default 32')
+        parser.add_argument('--rate', type=float, default=0, help='maximum number of messages per second, default no limit')
+        parser.add_argument('--retries', type=int, default=5, help='number of times to publish again a message rejected with 429 or 5xx, default 5')
+        parser.add_argument('--retry-lost', action='store_true', help='also publish again messages not acknowledged in time or when the connection is lost; they may be duplicated')
+        parser.add_argument('--checkpoint', default=None, help='file with results of the lines, default <file>.checkpoint')
+        parser.add_argument('--keep-from', action='store_true', help='publish on behalf of the sender given by "from", requires --as_root')
+    elif name == "leave":
+        parser = argparse.ArgumentParser(prog=name, description='Detach or unsubscribe from topic')
         parser.add_argument('topic', nargs='?', default=argparse.SUPPRESS, help='topic to detach from')
         parser.add_argument('--topic', dest='topic', default=None, help='topic to detach from')
         parser.add_argument('--unsub', action='store_true', help='detach and unsubscribe from topic')
-    elif parts[0] == "login":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Authenticate current session')
+    elif name == "login":
+        parser = argparse.ArgumentParser(prog=name, description='Authenticate current session')
         parser.add_argument('secret', nargs='?', default=argparse.SUPPRESS, help='secret for authentication')
         parser.add_argument('--scheme', default='basic', help='authentication schema, default=basic')
         parser.add_argument('--secret', dest='secret', default=None, help='secret for authentication')
         parser.add_argument('--uname', default=None, help='user name in basic authentication scheme')
         parser.add_argument('--password', default=None, help='password in basic authentication scheme')
         parser.add_argument('--cred', default=None, help='credentials, comma separated list in method:value:response format, e.g. email:test@example.com,tel:12345')
-    elif parts[0] == "note":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Send notification to topic, ex "note kp"')
+    elif name == "note":
+        parser = argparse.ArgumentParser(prog=name, description='Send notification to topic, ex "note kp"')
         parser.add_argument('topic', help='topic to notify')
         parser.add_argument('what', nargs='?', default='kp', const='kp', choices=['call', 'kp', 'read', 'recv'],
             help='notification type: kp (key press), recv, read - message received or read receipt')
         parser.add_argument('--seq', help='message ID being reported')
         parser.add_argument('--event', help='video call event', choices=['accept', 'answer', 'ice-candidate', 'hang-up', 'offer', 'ringing'])
         parser.add_argument('--payload', help='video call payload')
-    elif parts[0] == "pub":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Send message to topic')
+    elif name == "pub":
+        parser = argparse.ArgumentParser(prog=name, description='Send message to topic')
         parser.add_argument('topic', nargs='?', default=argparse.SUPPRESS, help='topic to publish to')
         parser.add_argument('--topic', dest='topic', default=None, help='topic to publish to')
         parser.add_argument('content', nargs='?', default=argparse.SUPPRESS, help='message to send')
         parser.add_argument('--head', help='message headers')
         parser.add_argument('--content', dest='content', help='message to send')
         parser.add_argument('--drafty', help='structured message to send, e.g. drafty content')
-        parser.add_argument('--image', help='image file to insert into message (not implemented yet)')
-        parser.add_argument('--attachment', help='file to send as an attachment (not implemented yet)')
-    elif parts[0] == "set":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Update topic metadata')
+        parser.add_argument('--image', help='image file to insert into message')
+        parser.add_argument('--attachment', help='file to send as an attachment, files over 192KB are uploaded out of band')
+    elif name == "set":
+        parser = argparse.ArgumentParser(prog=name, description='Update topic metadata')
         parser.add_argument('topic', help='topic to update')
         parser.add_argument('--fn', help='topic\'s title')
         parser.add_argument('--photo', help='avatar file name')
@@ -569,8 +704,8 @@ def parse_cmd(parts):
         parser.add_argument('--mode', help='new value of access mode')
         parser.add_argument('--tags', help='tags for topic discovery, comma separated list without spaces')
         parser.add_argument('--cred', help='credential to add in method:value format, e.g. email:test@example.com, tel:12345')
-    elif parts[0] == "sub":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Subscribe to topic')
+    elif name == "sub":
+        parser = argparse.ArgumentParser(prog=name, description='Subscribe to topic')
         parser.add_argument('topic', nargs='?', default=argparse.SUPPRESS, help='topic to subscribe to')
         parser.add_argument('--topic', dest='topic', default=None, help='topic to subscribe to')
         parser.add_argument('--fn', default=None, help='topic\'s user-visible name')
@@ -583,11 +718,11 @@ def parse_cmd(parts):
         parser.add_argument('--mode', default=None, help='new value of access mode')
         parser.add_argument('--tags', default=None, help='tags for topic discovery, comma separated list without spaces')
         parser.add_argument('--get-query', default=None, help='query for topic metadata or messages, comma separated list without spaces')
-    elif parts[0] == "upload":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Upload file out of band over HTTP(S)')
-        parser.add_argument('filename', help='name of the file to upload')
+    elif name == "upload":
+        parser = argparse.ArgumentParser(prog=name, description='Upload file out of band over HTTP(S)')
+        parser.add_argument('filename', nargs='+', help='name of the file to upload')
     elif macros:
-        parser = macros.parse_macro(parts)
+        parser = macros.parse_macro([name])
 
     if parser:
         try:
@@ -598,6 +733,70 @@ def parse_cmd(parts):
     return parser
 
 
+# Create parser for the local directive with the given name.
+def make_directive_parser(name):
+    parser = None
+    if name == ".use":
+        parser = argparse.ArgumentParser(prog=name, description='Set default user or topic')
+        parser.add_argument('--user', default="unchanged", help='ID of default (on_behalf_of) user')
+        parser.add_argument('--topic', default="unchanged", help='Name of default topic')
+
+    elif name == ".log":
+        parser = argparse.ArgumentParser(prog=name, description='Write value of a variable to stdout')
+        parser.add_argument('varname', help='name of the variable to print')
+
+    elif name == ".sleep":
+        parser = argparse.ArgumentParser(prog=name, description='Pause execution')
+        parser.add_argument('millis', type=int, help='milliseconds to wait')
+
+    elif name == ".verbose":
+        parser = argparse.ArgumentParser(prog=name, description='Toggle logging verbosity')
+
+    elif name == ".barrier":
+        parser = argparse.ArgumentParser(prog=name, description='Wait for all outstanding .await/.must requests')
+
+    elif name == ".window":
+        parser = argparse.ArgumentParser(prog=name, description='Set maximum number of outstanding .await/.must requests')
+        parser.add_argument('size', type=int, help='number of requests, 1 to wait for each response before the next command')
+
+    elif name == ".cache":
+        parser = argparse.ArgumentParser(prog=name, description='Print statistics of the cache of downloaded files')
+        parser.add_argument('--clear', action='store_true', help='remove all files from the cache')
+
+    elif name == ".vars":
+        parser = argparse.ArgumentParser(prog=name, description='Print variables and their size')
+        parser.add_argument('--clear', action='store_true', help='remove all variables')
+
+    elif name == ".stats":
+        parser = argparse.ArgumentParser(prog=name, description='Print latency and throughput of requests')
+        parser.add_argument('--reset', action='store_true', help='clear statistics after printing')
+
+    elif name == ".delmark":
+        parser = argparse.ArgumentParser(prog=name, description='Use custom delete maker instead of default DEL!')
+        parser.add_argument('delmark', help='marker to use')
+
+    return parser
+
+
+# Parsers of commands and directives, built on first use and reused for every input line.
+Parsers = {}
+
+
+# Find or create a parser using the given factory.
+def cached_parser(name, factory):
+    parser = Parsers.get(name)
+    if parser is None:
+        parser = factory(name)
+        if parser:
+            Parsers[name] = parser
+    return parser
+
+
+# Given an array of parts, parse commands and arguments
+def parse_cmd(parts):
+    return cached_parser(parts[0], make_cmd_parser)
+
+
 # Parses command line into command and parameters.
 def parse_input(cmd):
     # Split line into parts using shell-like syntax.
@@ -611,22 +810,18 @@ def parse_input(cmd):
 
     parser = None
     varname = None
+    projection = None
     synchronous = False
     failOnError = False
 
-    if parts[0] == ".use":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Set default user or topic')
-        parser.add_argument('--user', default="unchanged", help='ID of default (on_behalf_of) user')
-        parser.add_argument('--topic', default="unchanged", help='Name of default topic')
-
-    elif parts[0] == ".await" or parts[0] == ".must":
+    if parts[0] == ".await" or parts[0] == ".must":
         # .await|.must [<$variable_name>] <waitable_command> <params>
         if len(parts) > 1:
             synchronous = True
             failOnError = parts[0] == ".must"
             if len(parts) > 2 and parts[1][0] == '$':
-                # Varname is given
-                varname = parts[1]
+                # Varname is given, optionally with projection: $var=sub[*].topic
+                varname, _, projection = parts[1].partition('=')
                 parts = parts[2:]
                 parser = parse_cmd(parts)
             else:
@@ -634,20 +829,8 @@ def parse_input(cmd):
                 parts = parts[1:]
                 parser = parse_cmd(parts)
 
-    elif parts[0] == ".log":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Write value of a variable to stdout')
-        parser.add_argument('varname', help='name of the variable to print')
-
-    elif parts[0] == ".sleep":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Pause execution')
-        parser.add_argument('millis', type=int, help='milliseconds to wait')
-
-    elif parts[0] == ".verbose":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Toggle logging verbosity')
-
-    elif parts[0] == ".delmark":
-        parser = argparse.ArgumentParser(prog=parts[0], description='Use custom delete maker instead of default DEL!')
-        parser.add_argument('delmark', help='marker to use')
+    elif parts[0].startswith("."):
+        parser = cached_parser(parts[0], make_directive_parser)
 
     else:
         parser = parse_cmd(parts)
@@ -656,17 +839,24 @@ def parse_input(cmd):
         printout("Unrecognized:", parts[0])
         printout("Possible commands:")
         printout("\t.await\t\t- wait for completion of an operation")
+        printout("\t.barrier\t- wait for completion of all outstanding operations")
+        printout("\t.cache\t\t- print statistics of the cache of downloaded files")
         printout("\t.delmark\t- custom delete marker to use instead of default DEL!")
         printout("\t.exit\t\t- exit the program (also .quit)")
         printout("\t.log\t\t- write value of a variable to stdout")
         printout("\t.must\t\t- wait for completion of an operation, terminate on failure")
         printout("\t.sleep\t\t- pause execution")
+        printout("\t.stats\t\t- print latency and throughput of requests")
         printout("\t.use\t\t- set default user (on_behalf_of) or topic")
+        printout("\t.vars\t\t- print variables and their size")
         printout("\t.verbose\t- toggle logging verbosity on/off")
+        printout("\t.window\t\t- set maximum number of outstanding .await/.must operations")
         printout("\tacc\t\t- create or alter an account")
         printout("\tdel\t\t- delete message(s), topic, subscription, or user")
+        printout("\texport\t\t- export messages of a topic to a file")
         printout("\tfile\t\t- download or upload a large file")
         printout("\tget\t\t- query topic for metadata or messages")
+        printout("\timport\t\t- publish messages from a file to a topic")
         printout("\tleave\t\t- detach or unsubscribe from topic")
         printout("\tlogin\t\t- authenticate current session")
         printout("\tnote\t\t- send a notification")
@@ -691,10 +881,30 @@ def parse_input(cmd):
         args.failOnError = failOnError
         if varname:
             args.varname = varname
+        if projection:
+            compile_projection(projection)
+            args.projection = projection
         return args
 
     except SystemExit:
         return None
+    except ValueError as err:
+        printout("Error parsing command:", err)
+        return None
+
+
+# Builders of protobuf messages for remote commands.
+MESSAGES = {
+    "acc": accMsg,
+    "login": loginMsg,
+    "sub": subMsg,
+    "leave": leaveMsg,
+    "pub": pubMsg,
+    "get": getMsg,
+    "set": setMsg,
+    "del": delMsg,
+    "note": noteMsg,
+}
 
 
 # Process command-line input string: execute local commands, generate
@@ -703,17 +913,6 @@ def serialize_cmd(string, id, args):
     """Take string read from the command line, convert in into a protobuf message"""
     global DELETE_MARKER
 
-    messages = {
-        "acc": accMsg,
-        "login": loginMsg,
-        "sub": subMsg,
-        "leave": leaveMsg,
-        "pub": pubMsg,
-        "get": getMsg,
-        "set": setMsg,
-        "del": delMsg,
-        "note": noteMsg,
-    }
     try:
         # Convert string into a dictionary
         cmd = parse_input(string)
@@ -721,10 +920,11 @@ def serialize_cmd(string, id, args):
             return None, None
 
         elif cmd.cmd == "file":
+            if not cmd.filename and not (cmd.what == 'up' and cmd.dir):
+                stdoutln("Error: file name, URI or --dir is required")
+                return None, None
             # Start async upload
-            target = fileUpload if cmd.what == 'up' else fileDownload
-            upload_thread = threading.Thread(target=target, args=(id, derefVals(cmd), args), name="file_"+cmd.filename)
-            upload_thread.start()
+            transfer_runner(id, derefVals(cmd), args)
             cmd.no_yield = True
             return True, cmd
 
@@ -758,7 +958,8 @@ def serialize_cmd(string, id, args):
 
         elif cmd.cmd == ".sleep":
             stdoutln("Pausing for {}ms...".format(cmd.millis))
-            time.sleep(cmd.millis/1000.)
+            # Input is held by the message generator while responses keep being processed.
+            tn_globals.PausedUntil = time.time() + cmd.millis/1000.
             return None, None
 
         elif cmd.cmd == ".verbose":
@@ -766,20 +967,84 @@ def serialize_cmd(string, id, args):
             stdoutln("Logging is {}".format("verbose" if tn_globals.Verbose else "normal"))
             return None, None
 
+        elif cmd.cmd == ".barrier":
+            # The generator holds the barrier until all outstanding requests are completed.
+            return None, None
+
+        elif cmd.cmd == ".window":
+            if cmd.size < 1:
+                stdoutln("Error: window size must be positive")
+            else:
+                tn_globals.SyncWindow = cmd.size
+                stdoutln("Synchronous window={}".format(tn_globals.SyncWindow))
+            return None, None
+
+        elif cmd.cmd == ".cache":
+            if not tn_globals.FileCache:
+                stdoutln("Cache is disabled, use --cache-dir to enable")
+                return None, None
+            if cmd.clear:
+                tn_globals.FileCache.clear()
+            stats = tn_globals.FileCache.stats()
+            stdoutln("Cache: {0} files, {1:.1f} of {2:.1f} MB; {3} hits, {4} misses, {5} evicted".format(
+                stats['entries'], stats['size'] / 1048576., stats['max_size'] / 1048576.,
+                stats['hits'], stats['misses'], stats['evictions']))
+            return None, None
+
+        elif cmd.cmd == ".vars":
+            store = tn_globals.Variables
+            for name, value, size in store.items():
+                stdoutln("{0:<20}{1:<14}{2:>12} bytes".format(name, type(value).__name__, size))
+            stdoutln("Variables: {0}, {1:.1f} of {2:.1f} KB; {3} dropped".format(len(store), store.size / 1024.,
+                store.max_size / 1024., store.evicted))
+            if cmd.clear:
+                store.clear()
+            return None, None
+
+        elif cmd.cmd == ".stats":
+            stdoutln(Collector.report())
+            if cmd.reset:
+                Collector.reset()
+            return None, None
+
         elif cmd.cmd == ".delmark":
             DELETE_MARKER = cmd.delmark
             stdoutln("Using {} as delete marker".format(DELETE_MARKER))
             return None, None
 
+        elif cmd.cmd == "export":
+            from exporter import start_export
+            cmd = derefVals(cmd)
+            if not cmd.topic:
+                cmd.topic = tn_globals.DefaultTopic
+            if not cmd.topic:
+                stdoutln("Error: topic is required")
+                return None, None
+            # Pages are requested by the export, which is pushed back on the input queue.
+            return True, [start_export(cmd, pack_extra(cmd))]
+
+        elif cmd.cmd == "import":
+            from importer import start_import
+            cmd = derefVals(cmd)
+            if not os.path.exists(cmd.file):
+                stdoutln("Error: file '{0}' not found".format(cmd.file))
+                return None, None
+            # Messages are published by the import, which is pushed back on the input queue.
+            return True, [start_import(cmd, pack_extra(cmd))]
+
         elif cmd.cmd == "upload":
-            # Start async upload
-            upload_thread = threading.Thread(target=upload, args=(id, derefVals(cmd), args), name="Uploader_"+cmd.filename)
-            upload_thread.start()
+            # Queue files for upload by the uploader service
+            upload(id, derefVals(cmd), args)
             cmd.no_yield = True
             return True, cmd
 
-        elif cmd.cmd in messages:
-            return messages[cmd.cmd](id, derefVals(cmd), args), cmd
+        elif cmd.cmd in MESSAGES:
+            cmd = derefVals(cmd)
+            if uploads_attachment(cmd):
+                from uploader import AttachmentPub
+                # The message is pushed back on the input queue and sent when the upload completes.
+                return True, [AttachmentPub(string, id, cmd, args)]
+            return MESSAGES[cmd.cmd](id, cmd, args), cmd
         elif macros and cmd.cmd in macros.Macros:
             return True, macros.Macros[cmd.cmd].run(id, derefVals(cmd), args)
 
@@ -796,5 +1061,6 @@ def serialize_cmd(string, id, args):
 def print_server_params(params):
     servParams = []
     for p in params:
-        servParams.append(p + ": " + str(json.loads(params[p])))
+        tn_globals.ServerParams[p] = json.loads(params[p])
+        servParams.append(p + ": " + str(tn_globals.ServerParams[p]))
     stdoutln("\r<= Connected to server: " + "; ".join(servParams))
@@ -0,0 +1,290 @@
+"""Daemon mode: one logged-in MessageLoop stream shared by many short-lived scripts.
+
+'tn-cli --daemon --socket PATH' connects to the server, sends {hi} and {login} once and accepts
+connections on the unix socket. A client connects, writes a script and closes its side of the
+connection, e.g. 'tn-cli --socket PATH < script' or 'nc -U PATH < script'. The script is compiled
+in memory into frames (see precompile.py) and executed with its own $variables, like a load test
+session. Requests get ids which are unique within the daemon, so responses are routed back to the
+script which sent them; {data}, {pres} and {info} are not forwarded. The daemon writes back the
+lines a scripted tn-cli would print, followed by '.exit <code>'. Scripts run concurrently.
+Lines which need the interpreter, such as file transfers, are not supported. Requires Python 3.7+.
+
+The client side is in daemon_client.py."""
+
+from __future__ import print_function
+
+import asyncio
+import io
+import os
+import sys
+
+from grpc import aio
+
+from tinode_grpc import pbx
+
+import precompile
+import tn_globals
+from tn_globals import printerr
+from client import EXIT_COMMANDS, RE_VARREF, hello_messages, open_channel, pop_from_output_queue, write_stats
+from commands import getVar
+from daemon_client import EXIT_LINE
+from loadgen import Session, Stats
+from recorder import response_of
+from stats import Collector, NO_RESPONSE
+
+# Messages which would change the shared session.
+SESSION_COMMANDS = ['hi', 'login']
+
+
+# Line printed for a response, same as in a scripted session.
+def format_response(msg):
+    if msg.HasField('ctrl'):
+        topic = " (" + str(msg.ctrl.topic) + ")" if msg.ctrl.topic else ""
+        return "<= " + str(msg.ctrl.code) + " " + msg.ctrl.text + topic
+    what = []
+    if len(msg.meta.sub) > 0:
+        what.append("sub")
+    if msg.meta.HasField("desc"):
+        what.append("desc")
+    if msg.meta.HasField("del"):
+        what.append("del")
+    if len(msg.meta.tags) > 0:
+        what.append("tags")
+    return "<= meta " + ",".join(what) + " " + msg.meta.topic
+
+
+class Stream:
+    """Shared MessageLoop stream as seen by one job: writes are serialized and routed."""
+
+    def __init__(self, daemon, job):
+        self.daemon = daemon
+        self.job = job
+
+    async def write(self, msg):
+        await self.daemon.write(msg, self.job)
+
+
+class Job(Session):
+    """Script submitted by one client. Executed like a load test session over the shared stream."""
+
+    def __init__(self, daemon, index, writer, frames, args, stats):
+        Session.__init__(self, index, None, ('', ''), frames, args, stats)
+        self.daemon = daemon
+        self.writer = writer
+        self.variables = tn_globals.VariableStore(tn_globals.Variables.max_size)
+        # Ids of requests waiting for any response, synchronous or not.
+        self.outstanding = set()
+        self.settled = asyncio.Event()
+        self.settled.set()
+
+    def next_id(self):
+        return self.daemon.next_id()
+
+    def output(self, text):
+        self.writer.write((text + "\n").encode('utf-8'))
+
+    def sent(self, id):
+        self.outstanding.add(id)
+        self.settled.clear()
+
+    def resolve(self, id, response, code):
+        # Latency is recorded by the daemon for all requests.
+        self.sent_at.pop(id, None)
+        Session.resolve(self, id, response, code)
+
+    def on_response(self, msg):
+        id, code = response_of(msg)
+        self.output(format_response(msg))
+        self.resolve(id, msg.ctrl if msg.HasField('ctrl') else msg.meta, code)
+        self.outstanding.discard(id)
+        if not self.outstanding:
+            self.settled.set()
+
+    async def execute(self, call, frame):
+        if not isinstance(frame, str):
+            if frame.cmd in SESSION_COMMANDS:
+                raise Exception("'{0}' is not allowed in daemon mode".format(frame.src))
+            self.output("=> " + frame.src)
+            return await Session.execute(self, call, frame)
+
+        parts = frame.split(None, 1)
+        if parts[0] == '.log' and len(parts) > 1:
+            for ref in RE_VARREF.findall(parts[1]):
+                future = self.assigning.get(ref)
+                if future:
+                    await self.wait_for(future, frame)
+            self.output("<= " + str(getVar(parts[1].strip(), self.variables)))
+            return True
+        if parts[0] in ['.sleep', '.barrier'] or parts[0] in EXIT_COMMANDS:
+            return await Session.execute(self, call, frame)
+        if parts[0] in ['.use', '.delmark', '.verbose', '.window', '.stats']:
+            # Applied at compile time or not meaningful for a shared session.
+            return True
+        raise Exception("'{0}' is not supported in daemon mode".format(frame))
+
+    async def settle(self):
+        """Wait for responses to all requests, including those not sent with .await/.must."""
+        try:
+            await asyncio.wait_for(self.settled.wait(), self.args.await_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += len(self.outstanding)
+            raise Exception("timeout waiting for {0} responses".format(len(self.outstanding)))
+
+    async def run(self):
+        self.stats.started += 1
+        call = Stream(self.daemon, self)
+        try:
+            for frame in self.frames:
+                if self.error or not await self.execute(call, frame):
+                    break
+            if not self.error:
+                await self.drain()
+                await self.settle()
+            if self.error:
+                raise Exception(self.error)
+            self.stats.completed += 1
+            return 0
+        except Exception as ex:
+            self.stats.failed += 1
+            self.output("Error: {0}".format(ex))
+            return 1
+        finally:
+            self.daemon.forget(self)
+
+
+class Daemon:
+    """Owns the MessageLoop stream and the unix socket."""
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = Stats()
+        self.id = 10000
+        self.jobs = 0
+        # Request id -> job waiting for the response.
+        self.routes = {}
+        # Responses to {hi} and {login}: id -> future.
+        self.hello_pending = {}
+        self.call = None
+        self.lock = None
+
+    def next_id(self):
+        self.id += 1
+        return str(self.id)
+
+    async def write(self, msg, job):
+        what = msg.WhichOneof('Message')
+        if job and what not in NO_RESPONSE:
+            # {note} has no id.
+            id = getattr(msg, what).id
+            self.routes[id] = job
+            job.sent(id)
+        async with self.lock:
+            Collector.on_send(msg)
+            await self.call.write(msg)
+
+    def forget(self, job):
+        """Drop routes of the job: late responses are not delivered."""
+        for id in list(job.outstanding):
+            self.routes.pop(id, None)
+            Collector.on_lost(id)
+
+    async def read_responses(self):
+        async for msg in self.call:
+            id, code = response_of(msg)
+            if id:
+                Collector.on_response(id)
+            job = self.routes.pop(id, None) if id else None
+            if job:
+                job.on_response(msg)
+            elif id in self.hello_pending:
+                self.hello_pending.pop(id).set_result(msg)
+            elif tn_globals.Verbose:
+                print("<= " + tn_globals.to_json(msg))
+
+    async def hello(self, scheme, secret):
+        """Send {hi} and {login}; run their completion handlers, e.g. saving the token."""
+        for msg in hello_messages(int(self.next_id()), scheme, secret, self.args):
+            id = getattr(msg, msg.WhichOneof('Message')).id
+            future = self.hello_pending[id] = asyncio.get_running_loop().create_future()
+            await self.write(msg, None)
+            ctrl = (await asyncio.wait_for(future, self.args.await_timeout)).ctrl
+            if ctrl.code >= 400:
+                raise Exception("{0} failed: {1} {2}".format(msg.WhichOneof('Message'), ctrl.code, ctrl.text))
+            func = tn_globals.OnCompletion.pop(id, None)
+            if func:
+                func(ctrl.params)
+        self.id += 1
+        while pop_from_output_queue():
+            pass
+
+    def compile(self, text, report):
+        """Compile the script in memory. Returns the list of frames or None if it has errors."""
+        out = io.BytesIO()
+        # Each script starts with no default user and topic.
+        tn_globals.DefaultUser = tn_globals.DefaultTopic = None
+        compiler = precompile.compile_lines(io.StringIO(text), out, self.args, report)
+        if compiler.errors:
+            return None
+        return list(precompile.parse_frames(out.getvalue(), self.args.socket))
+
+    async def handle(self, reader, writer):
+        self.jobs += 1
+        index = self.jobs
+        code = 1
+        try:
+            text = (await reader.read()).decode('utf-8')
+            output = lambda line: writer.write((line + "\n").encode('utf-8'))
+            frames = self.compile(text, output)
+            if frames is not None:
+                code = await Job(self, index, writer, frames, self.args, self.stats).run()
+            writer.write("{0} {1}\n".format(EXIT_LINE, code).encode('utf-8'))
+            await writer.drain()
+        except Exception as err:
+            printerr("Job {0}: {1}".format(index, err))
+        finally:
+            writer.close()
+
+    async def run(self, scheme, secret):
+        path = self.args.socket
+        if os.path.exists(path):
+            # Left over from an earlier run.
+            os.remove(path)
+        self.lock = asyncio.Lock()
+        channel = open_channel(self.args, aio)
+        self.call = pbx.NodeStub(channel).MessageLoop()
+        reader = asyncio.ensure_future(self.read_responses())
+        server = None
+        try:
+            await self.hello(scheme, secret)
+            # The session is logged in: only the owner may use it.
+            old_umask = os.umask(0o177)
+            try:
+                server = await asyncio.start_unix_server(self.handle, path)
+            finally:
+                os.umask(old_umask)
+            print("Listening on '{0}'".format(path))
+            sys.stdout.flush()
+            await reader
+            printerr("Server closed the stream")
+            return 1
+        except Exception as ex:
+            printerr("Daemon failed: {0}".format(ex))
+            return 1
+        finally:
+            if server:
+                server.close()
+            if os.path.exists(path):
+                os.remove(path)
+            reader.cancel()
+            self.call.cancel()
+            await channel.close()
+            print("Scripts: {0} completed, {1} failed".format(self.stats.completed, self.stats.failed))
+            write_stats(self.args)
+
+
+# Entry point of daemon mode. Returns process exit code.
+def serve(args, scheme, secret):
+    if not args.socket:
+        printerr("Daemon mode requires --socket")
+        return 1
+    return asyncio.run(Daemon(args).run(scheme, secret))
@@ -0,0 +1,34 @@
+"""Client side of daemon mode: sends a script to the daemon over the unix socket and prints
+the output. Loads neither gRPC nor protobuf, so it starts fast."""
+
+from __future__ import print_function
+
+import socket
+import sys
+
+from tn_globals import printerr
+
+# Last line of the output: '.exit <code>'.
+EXIT_LINE = '.exit'
+
+
+# Send the script from stdin to the daemon and print the output. Returns process exit code.
+def submit(args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(args.socket)
+    except OSError as err:
+        printerr("Failed to connect to '{0}':".format(args.socket), err)
+        return 1
+
+    with sock:
+        sock.sendall(sys.stdin.buffer.read())
+        sock.shutdown(socket.SHUT_WR)
+        code = 1
+        for line in sock.makefile('r', encoding='utf-8'):
+            if line.startswith(EXIT_LINE + ' '):
+                code = int(line.split()[1])
+                break
+            sys.stdout.write(line)
+        sys.stdout.flush()
+    return code
@@ -0,0 +1,310 @@
+"""Resumable download of large files.
+
+The file is first requested with LargeFileServe. Content is written into a preallocated
+'<name>.part' file next to a small '<name>.part.json' file with the number of bytes received.
+If the stream breaks, the download is retried with exponential backoff. FileDownReq has no
+offset, so the download resumes with an HTTP range request to the web server, which serves
+the same URIs. An interrupted download is also resumed by the next 'file' command for the
+same URI. Several URIs are downloaded in parallel by a bounded pool of worker threads.
+
+With --cache-dir, downloaded files are kept in tn_globals.FileCache. The etag of the cached
+copy (or the time it was downloaded) is sent in if_modified and the file is served from the
+cache if the server responds with 304. File URIs are immutable, so the cached copy is also
+used if the server sends the file anyway with the same etag, or the same size and type when
+it provides no etag. In that case the stream is cancelled after the first chunk."""
+
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+
+import grpc
+
+from tinode_grpc import pb, pbx
+
+import tn_globals
+from tn_globals import stdoutln
+
+# Number of attempts to download a file before giving up.
+RETRIES = 5
+
+# Delay before the first retry in seconds; doubled after every failed attempt, up to MAX_BACKOFF.
+BACKOFF = 0.5
+MAX_BACKOFF = 8
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 1.0
+
+# Size of chunks read over HTTP.
+HTTP_CHUNK_SIZE = 1024*1024
+
+# gRPC errors which are not worth retrying.
+PERMANENT_ERRORS = [grpc.StatusCode.NOT_FOUND, grpc.StatusCode.PERMISSION_DENIED,
+    grpc.StatusCode.UNAUTHENTICATED, grpc.StatusCode.INVALID_ARGUMENT, grpc.StatusCode.UNIMPLEMENTED]
+
+
+class DownloadError(Exception):
+    """Download failed and must not be retried."""
+    pass
+
+
+class Download:
+    """State of one file being downloaded."""
+
+    def __init__(self, id, uri, args):
+        self.id = id
+        self.uri = uri
+        self.args = args
+        self.name = os.path.basename(uri.rstrip('/')) or 'download'
+        self.part = self.name + '.part'
+        self.size = 0
+        self.mime = ''
+        self.etag = ''
+        self.offset = 0
+        self.fd = None
+        self.started = time.time()
+        self.reported = self.started
+        self.resumed_at = 0
+        self.redirect = None
+        # Web server is not reachable: resume over gRPC.
+        self.http_failed = False
+        # Cached copy of the file and its metadata.
+        self.cached, self.cached_info = None, None
+        self.not_modified = False
+        self.load_state()
+        if not self.offset and tn_globals.FileCache:
+            self.cached, self.cached_info = tn_globals.FileCache.get(uri)
+
+    def load_state(self):
+        """Resume the download interrupted earlier."""
+        try:
+            with open(self.part + '.json', 'r') as f:
+                state = json.load(f)
+            if state.get('uri') == self.uri and os.path.exists(self.part):
+                self.size = state.get('size', 0)
+                self.offset = self.resumed_at = state.get('offset', 0)
+                self.name = state.get('name', self.name)
+        except (IOError, ValueError):
+            pass
+
+    def save_state(self):
+        with open(self.part + '.json', 'w') as f:
+            json.dump({'uri': self.uri, 'name': self.name, 'size': self.size, 'offset': self.offset}, f)
+
+    def open(self, meta=None):
+        if meta:
+            self.name = meta.name or self.name
+            self.size = meta.size or self.size
+            self.mime = meta.mime_type or self.mime
+            self.etag = meta.etag or self.etag
+        if self.fd:
+            return
+        self.fd = open(self.part, 'r+b' if os.path.exists(self.part) else 'w+b')
+        if self.size and os.fstat(self.fd.fileno()).st_size < self.size:
+            # Reserve disk space to avoid fragmentation and fail early if the disk is full.
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(self.fd.fileno(), 0, self.size)
+            else:
+                self.fd.truncate(self.size)
+
+    def write(self, data, offset):
+        """Write data received at the given offset of the file."""
+        if offset + len(data) <= self.offset:
+            # Already have it.
+            return
+        if offset < self.offset:
+            data = data[self.offset - offset:]
+            offset = self.offset
+        self.fd.seek(offset)
+        self.fd.write(data)
+        self.offset = offset + len(data)
+        now = time.time()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            self.fd.flush()
+            self.save_state()
+            self.progress(now)
+
+    def progress(self, now):
+        rate = (self.offset - self.resumed_at) / max(now - self.started, 0.001) / 1048576
+        if self.size:
+            stdoutln("'{0}': {1:.1f} of {2:.1f} MB ({3:.0f}%), {4:.2f} MB/s".format(self.name,
+                self.offset / 1048576., self.size / 1048576., 100. * self.offset / self.size, rate))
+        else:
+            stdoutln("'{0}': {1:.1f} MB, {2:.2f} MB/s".format(self.name, self.offset / 1048576., rate))
+
+    def finish(self):
+        self.fd.truncate(self.offset)
+        self.fd.close()
+        self.fd = None
+        os.replace(self.part, self.name)
+        if os.path.exists(self.part + '.json'):
+            os.remove(self.part + '.json')
+        elapsed = max(time.time() - self.started, 0.001)
+        stdoutln("Downloaded '{0}': {1} bytes in {2:.2f}s, {3:.2f} MB/s".format(self.name, self.offset,
+            elapsed, (self.offset - self.resumed_at) / elapsed / 1048576))
+        if tn_globals.FileCache:
+            tn_globals.FileCache.miss()
+            tn_globals.FileCache.put(self.uri, self.name, {'name': self.name, 'mime': self.mime,
+                'size': self.offset, 'etag': self.etag, 'stamp': formatdate(usegmt=True)})
+
+    def from_cache(self):
+        """Copy the file from the cache."""
+        self.name = self.cached_info.get('name') or self.name
+        shutil.copyfile(self.cached, self.name)
+        tn_globals.FileCache.hit(self.uri)
+        stdoutln("Not modified '{0}': {1} bytes copied from cache".format(self.name, self.cached_info.get('size')))
+
+    def same_as_cached(self, meta):
+        if not self.cached:
+            return False
+        if meta.etag or self.cached_info.get('etag'):
+            return meta.etag == self.cached_info.get('etag')
+        return meta.size == self.cached_info.get('size') and meta.mime_type == self.cached_info.get('mime')
+
+    def abort(self):
+        if self.fd:
+            self.fd.flush()
+            self.save_state()
+            self.fd.close()
+            self.fd = None
+
+    def complete(self):
+        return self.size and self.offset >= self.size
+
+    def fetch_grpc(self, channel):
+        """Download with LargeFileServe. Chunks before the current offset are skipped."""
+        if_modified = ''
+        if self.cached:
+            if_modified = self.cached_info.get('etag') or self.cached_info.get('stamp', '')
+        stream = pbx.NodeStub(channel).LargeFileServe(pb.FileDownReq(id=str(self.id),
+            auth=pb.Auth(scheme='token', secret=tn_globals.AuthToken), uri=self.uri, if_modified=if_modified))
+        received = 0
+        for chunk in stream:
+            if chunk.code >= 400:
+                raise DownloadError("{0} {1}".format(chunk.code, chunk.text))
+            if chunk.code == 304 or (received == 0 and self.same_as_cached(chunk.meta)):
+                self.not_modified = True
+                stream.cancel()
+                return
+            if chunk.code >= 300:
+                # Content is served by HTTP.
+                self.redirect = chunk.redir_url
+                return
+            self.open(chunk.meta)
+            self.write(chunk.content, received)
+            received += len(chunk.content)
+        if not self.size:
+            self.size = received
+            self.open()
+
+    def url(self):
+        uri = self.redirect or self.uri
+        if '://' in uri:
+            return uri
+        scheme = 'https' if self.args.ssl else 'http'
+        return scheme + '://' + self.args.web_host + ('' if uri.startswith('/') else '/') + uri
+
+    def fetch_http(self):
+        """Download the rest of the file with a range request."""
+        import requests
+
+        headers = {'X-Tinode-APIKey': self.args.api_key, 'X-Tinode-Auth': 'Token ' + tn_globals.AuthToken}
+        if self.offset:
+            headers['Range'] = 'bytes={0}-'.format(self.offset)
+        elif self.cached:
+            if self.cached_info.get('etag'):
+                headers['If-None-Match'] = self.cached_info['etag']
+            if self.cached_info.get('stamp'):
+                headers['If-Modified-Since'] = self.cached_info['stamp']
+        with requests.get(self.url(), headers=headers, stream=True, timeout=30) as resp:
+            if resp.status_code == 304 and self.cached:
+                self.not_modified = True
+                return
+            if resp.status_code == 416 and self.complete():
+                return
+            if resp.status_code >= 400:
+                if resp.status_code < 500:
+                    raise DownloadError("HTTP {0} {1}".format(resp.status_code, resp.reason))
+                resp.raise_for_status()
+            offset = self.offset if resp.status_code == 206 else 0
+            if not self.size:
+                total = resp.headers.get('Content-Range', '').rpartition('/')[2]
+                self.size = int(total) if total.isdigit() else offset + int(resp.headers.get('Content-Length', 0))
+            self.open()
+            for data in resp.iter_content(HTTP_CHUNK_SIZE):
+                self.write(data, offset)
+                offset += len(data)
+
+
+# Download one file. Returns True on success.
+def download(id, uri, args, channel):
+    import requests
+
+    dl = Download(id, uri, args)
+    delay = BACKOFF
+    for attempt in range(RETRIES):
+        try:
+            if attempt > 0:
+                stdoutln("Resuming '{0}' at {1} bytes, attempt {2} of {3}".format(
+                    dl.name, dl.offset, attempt + 1, RETRIES))
+            if dl.redirect or (dl.offset > 0 and not dl.http_failed):
+                dl.fetch_http()
+            else:
+                dl.fetch_grpc(channel)
+                if dl.redirect and not dl.not_modified:
+                    dl.fetch_http()
+            if dl.not_modified:
+                dl.from_cache()
+                return True
+            if dl.complete() or not dl.size:
+                dl.finish()
+                return True
+            raise IOError("connection closed at {0} of {1} bytes".format(dl.offset, dl.size))
+        except DownloadError as err:
+            stdoutln("Failed to download '{0}': {1}".format(uri, err))
+            dl.abort()
+            return False
+        except grpc.RpcError as err:
+            if err.code() in PERMANENT_ERRORS:
+                stdoutln("Failed to download '{0}': {1} {2}".format(uri, err.code(), err.details()))
+                dl.abort()
+                return False
+            error = "{0} {1}".format(err.code(), err.details())
+        except requests.ConnectionError as err:
+            dl.http_failed = True
+            error = str(err)
+        except (requests.RequestException, IOError) as err:
+            error = str(err)
+
+        dl.abort()
+        if attempt + 1 < RETRIES:
+            stdoutln("Download of '{0}' interrupted: {1}; retrying in {2:.1f}s".format(dl.name, error, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_BACKOFF)
+
+    stdoutln("Failed to download '{0}' after {1} attempts, {2} bytes saved in '{3}'".format(
+        uri, RETRIES, dl.offset, dl.part))
+    return False
+
+
+# Download files listed in cmd.filename using up to cmd.parallel worker threads.
+def download_files(id, cmd, args):
+    from client import open_channel
+
+    uris = cmd.filename if isinstance(cmd.filename, list) else [cmd.filename]
+    # Large transfers use their own connection so they do not delay other messages.
+    channel = open_channel(args)
+    try:
+        if len(uris) == 1:
+            download(id, uris[0], args, channel)
+            return
+        with ThreadPoolExecutor(max_workers=max(1, min(cmd.parallel, len(uris)))) as pool:
+            results = list(pool.map(lambda uri: download(id, uri, args, channel), uris))
+        stdoutln("Downloaded {0} of {1} files".format(results.count(True), len(uris)))
+    finally:
+        channel.close()
@@ -0,0 +1,189 @@
+"""Streaming export of the message history of a topic.
+
+'export <topic>' pages backwards through the messages with {get what="data"} requests. Each page
+is a window of seq ids given by since_id and before_id, so several pages are requested at the same
+time. The latest seq id is obtained with {get what="desc"} unless --before is given. Every {data}
+message is written to the file as soon as it is received and is never stored in variables, so
+memory use does not depend on the length of the history. Pages are completed in any order: the
+file is not sorted by seq id.
+
+Formats:
+ * jsonl: one JSON object per message: topic, from, seq, ts (milliseconds since the epoch),
+   deleted (if the message is deleted), head and content. Values of head and content are decoded
+   from JSON. The same format is read by 'import'.
+ * pb: length-delimited (varint length prefix) serialized pb.ServerData messages.
+Files with the .gz extension are compressed with gzip."""
+
+from __future__ import print_function
+
+import gzip
+import json
+import time
+
+from tinode_grpc import pb
+
+import tn_globals
+from client import Request
+from tn_globals import stdoutln
+from utils import encode_varint
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 5.0
+
+
+# Format of the file: 'pb' for .pb and .pb.gz files, 'jsonl' otherwise.
+def guess_format(filename):
+    return 'pb' if filename.endswith('.pb') or filename.endswith('.pb.gz') else 'jsonl'
+
+
+# Open the file for writing, compressed if the name ends with .gz.
+def open_output(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wb')
+    return open(filename, 'wb', buffering=65536)
+
+
+# Decode a JSON-encoded value of a message. Invalid JSON is kept as a string.
+def decode_json(value):
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.decode('utf-8', 'replace')
+
+
+# Convert pb.ServerData to a dictionary written as a line of a JSONL file.
+def data_to_dict(data):
+    result = {'topic': data.topic, 'from': data.from_user_id, 'seq': data.seq_id, 'ts': data.timestamp}
+    if data.deleted_at:
+        result['deleted'] = data.deleted_at
+    if data.head:
+        result['head'] = {key: decode_json(data.head[key]) for key in data.head}
+    result['content'] = decode_json(data.content)
+    return result
+
+
+class Query(Request):
+    """One {get} request of the export."""
+
+    def __init__(self, export, msg):
+        Request.__init__(self, msg, quiet=True)
+        self.export = export
+
+    def __str__(self):
+        return "get " + self.msg.get.query.what + " " + self.msg.get.topic
+
+    def build(self, id, args):
+        msg, cmd = Request.build(self, id, args)
+        if self.msg.get.query.what == 'desc':
+            cmd.on_meta = self.export.on_desc
+        return msg, cmd
+
+
+class Export:
+    """Input which requests pages of messages keeping up to 'window' of them in flight and
+    writes the messages to the file as they arrive."""
+
+    def __init__(self, topic, filename, fmt, page, window, since, before, extra):
+        self.topic = topic
+        self.filename = filename
+        self.format = fmt
+        self.page = page
+        self.window = window
+        self.since = since
+        # Upper bound (exclusive) of the next page; None until the latest seq id is known.
+        self.before = before
+        self.top = before - 1 if before else None
+        self.extra = extra
+        self.out = open_output(filename)
+        self.desc = None
+        # Queries in flight.
+        self.active = []
+        self.error = None
+        self.written = 0
+        self.pages = 0
+        self.started = time.time()
+        self.reported = self.started
+        tn_globals.DataSinks[topic] = self.write
+
+    def __str__(self):
+        return "export " + self.topic
+
+    def on_desc(self, meta):
+        """Response to {get what="desc"}: pages start after the latest message."""
+        self.top = meta.desc.seq_id
+        self.before = self.top + 1
+
+    def write(self, data):
+        """Write {data} to the file. Returns False if the message is not a part of the export."""
+        if self.top is None or data.seq_id < self.since or data.seq_id > self.top:
+            # E.g. a new message published to the topic while it is being exported.
+            return False
+        if self.format == 'pb':
+            body = data.SerializeToString()
+            self.out.write(encode_varint(len(body)) + body)
+        else:
+            self.out.write((json.dumps(data_to_dict(data)) + "\n").encode('utf-8'))
+        self.written += 1
+        now = time.time()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            stdoutln("{0}: {1} messages, {2:.0f} messages/s".format(self, self.written,
+                self.written / (now - self.started)))
+        return True
+
+    def exhausted(self):
+        return self.error is not None or (self.before is not None and self.before <= self.since)
+
+    def ready(self):
+        self.collect()
+        if self.exhausted() or self.before is None:
+            return not self.active
+        return len(self.active) < self.window
+
+    def collect(self):
+        """Drop completed queries, stop on the first failed one."""
+        active = []
+        for query in self.active:
+            if not query.done():
+                active.append(query)
+            elif query.code is not None and query.code >= 400 and self.error is None:
+                self.error = "'{0}' failed: {1} {2}".format(query, query.code, query.reason)
+        self.active = active
+
+    def query(self, what, opts=None):
+        query = Query(self, pb.ClientMsg(get=pb.ClientGet(topic=self.topic,
+            query=pb.GetQuery(what=what, data=opts)), extra=self.extra))
+        self.active.append(query)
+        return query
+
+    def build(self, id, args):
+        """Request the next page. Returns the query followed by self or (None, None) when done."""
+        if self.error is None and self.before is None:
+            if self.desc is None:
+                self.desc = self.query('desc')
+                return None, [self.desc, self]
+            self.error = "no description of the topic"
+        if not self.exhausted():
+            since = max(self.since, self.before - self.page)
+            opts = pb.GetOpts(since_id=since, before_id=self.before, limit=self.before - since)
+            self.before = since
+            self.pages += 1
+            return None, [self.query('data', opts), self]
+
+        tn_globals.DataSinks.pop(self.topic, None)
+        self.out.close()
+        elapsed = max(time.time() - self.started, 0.001)
+        if self.error:
+            stdoutln("{0} failed: {1}; {2} messages written to '{3}'".format(self, self.error, self.written, self.filename))
+        else:
+            stdoutln("{0}: {1} messages in {2} pages written to '{3}' in {4:.2f}s, {5:.0f} messages/s".format(self,
+                self.written, self.pages, self.filename, elapsed, self.written / elapsed))
+        return None, None
+
+
+# Create the export requested by the 'export' command.
+def start_export(cmd, extra):
+    filename = cmd.file or cmd.topic + ('.pb.gz' if cmd.format == 'pb' else '.jsonl.gz')
+    fmt = cmd.format or guess_format(filename)
+    return Export(cmd.topic, filename, fmt, max(1, cmd.page), max(1, cmd.window), max(1, cmd.since),
+        cmd.before, extra)
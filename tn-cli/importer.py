@@ -0,0 +1,254 @@
+"""Bulk import of messages into a topic.
+
+'import <topic> <file>' publishes a message for every line of a JSONL file, optionally gzipped.
+Each line is a JSON object with 'content' (a string or a drafty object) and optional 'head',
+e.g. a file written by 'export'. Other keys are ignored. The file is read line by line.
+
+Up to 'window' {pub} are in flight; a line is complete when its {ctrl} is received. The rate of
+publishing can be capped. Lines rejected by the server with 429 or 5xx are published again after
+a delay which doubles after every attempt. Lines not acknowledged in time or in flight when the
+connection is lost may have been published, so they fail unless --retry-lost is given. The result
+of every line is appended to the checkpoint file. When the import is run again, lines which
+succeeded earlier are skipped, so an interrupted import resumes where it stopped."""
+
+from __future__ import print_function
+
+import gzip
+import json
+import random
+import time
+
+from tinode_grpc import pb
+
+import tn_globals
+from client import Request
+from tn_globals import stdoutln
+
+# Delay before the first retry in seconds; doubled after every failed attempt, up to MAX_BACKOFF.
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 5.0
+
+
+# Open the file for reading, compressed if the name ends with .gz.
+def open_input(filename):
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rt', encoding='utf-8')
+    return open(filename, 'r', encoding='utf-8')
+
+
+# Generator of (row number, text) of non-empty lines of the file.
+def read_lines(filename):
+    with open_input(filename) as f:
+        row = 0
+        for line in f:
+            line = line.strip()
+            if line:
+                row += 1
+                yield row, line
+
+
+# Should the message be published again after the response with this code.
+# Lost messages may have been published: they are published again only if retry_lost is set.
+def retryable(code, lost, retry_lost):
+    return (code == 429 or code >= 500) and (retry_lost or not lost)
+
+
+# Convert a line of the file to {pub}. Raises ValueError if the line is invalid.
+def line_to_pub(topic, text, extra, keep_from):
+    data = json.loads(text)
+    if not isinstance(data, dict) or data.get('content') is None:
+        raise ValueError("no content")
+    head = data.get('head') or {}
+    if isinstance(data['content'], dict) and 'mime' not in head:
+        head['mime'] = 'text/x-drafty'
+    if keep_from and data.get('from'):
+        extra = pb.ClientExtra(on_behalf_of=data['from'], auth_level=extra.auth_level)
+    return pb.ClientMsg(pub=pb.ClientPub(topic=topic, no_echo=True,
+        head={key: json.dumps(val).encode('utf-8') for key, val in head.items()},
+        content=json.dumps(data['content']).encode('utf-8')),
+        extra=extra)
+
+
+class Checkpoint:
+    """Results of rows appended to a file as JSON lines. Only rows after the first row without
+    a result and the failed rows are kept in memory."""
+
+    def __init__(self, filename):
+        # All rows up to this one have a result.
+        self.settled = 0
+        # Rows after 'settled' with a result.
+        self.above = set()
+        # Rows which failed.
+        self.failed = set()
+        try:
+            with open(filename, 'r') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete after a crash.
+                        continue
+                    self.record(result['row'], result.get('code', 500))
+        except IOError:
+            pass
+        self.log = open(filename, 'a')
+
+    def record(self, row, code):
+        if code >= 400:
+            self.failed.add(row)
+        else:
+            self.failed.discard(row)
+        if row > self.settled:
+            self.above.add(row)
+            while self.settled + 1 in self.above:
+                self.settled += 1
+                self.above.remove(self.settled)
+
+    def done(self, row):
+        """The row succeeded earlier."""
+        return (row <= self.settled or row in self.above) and row not in self.failed
+
+    def write(self, row, code, text):
+        self.record(row, code)
+        self.log.write(json.dumps({'row': row, 'code': code, 'text': text}) + "\n")
+        self.log.flush()
+
+    def close(self):
+        self.log.close()
+
+
+class Pub(Request):
+    """{pub} of one row of the file."""
+
+    def __init__(self, row, msg):
+        Request.__init__(self, msg, quiet=True)
+        self.row = row
+        self.attempts = 0
+        # Time when the message may be published again.
+        self.due = 0
+
+    def __str__(self):
+        return "pub row {0}".format(self.row)
+
+    def build(self, id, args):
+        self.code = None
+        self.attempts += 1
+        return Request.build(self, id, args)
+
+
+class Import:
+    """Input which publishes rows of the file keeping up to 'window' of them in flight."""
+
+    def __init__(self, topic, filename, window, rate, retries, retry_lost, checkpoint, extra, keep_from):
+        self.topic = topic
+        self.filename = filename
+        self.window = window
+        self.rate = rate
+        self.retries = retries
+        self.retry_lost = retry_lost
+        self.extra = extra
+        self.keep_from = keep_from
+        self.checkpoint = Checkpoint(checkpoint)
+        self.lines = read_lines(filename)
+        self.exhausted = False
+        # Messages in flight and waiting to be published again.
+        self.active = []
+        self.retrying = []
+        self.published = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retried = 0
+        # Earliest time to publish the next message with the rate cap.
+        self.next_send = 0
+        self.started = time.time()
+        self.reported = self.started
+
+    def __str__(self):
+        return "import " + self.topic
+
+    def ready(self):
+        self.collect()
+        if self.exhausted and not self.retrying:
+            return not self.active
+        return len(self.active) < self.window
+
+    def collect(self):
+        """Record results of acknowledged messages, schedule retries."""
+        active = []
+        for pub in self.active:
+            if not pub.done():
+                active.append(pub)
+                continue
+            if pub.code is None:
+                pub.respond(504, "no response", True)
+            if retryable(pub.code, pub.lost, self.retry_lost) and pub.attempts <= self.retries:
+                delay = min(BACKOFF * (2 ** (pub.attempts - 1)), MAX_BACKOFF)
+                pub.due = time.time() + random.uniform(delay / 2, delay)
+                # The server is overloaded or unavailable: slow down.
+                tn_globals.PausedUntil = max(tn_globals.PausedUntil, pub.due)
+                self.retrying.append(pub)
+                self.retried += 1
+            else:
+                self.finished(pub.row, pub.code, pub.reason)
+        self.active = active
+
+    def finished(self, row, code, text):
+        if code < 400:
+            self.published += 1
+        else:
+            self.failed += 1
+            stdoutln("{0}: row {1} failed: {2} {3}".format(self, row, code, text))
+        self.checkpoint.write(row, code, text)
+        now = time.time()
+        if now - self.reported >= PROGRESS_INTERVAL:
+            self.reported = now
+            stdoutln("{0}: {1} published, {2} failed, {3} retried, {4:.0f} messages/s".format(self,
+                self.published, self.failed, self.retried, self.published / (now - self.started)))
+
+    def next_pub(self):
+        """Message to publish next or None when all rows are read."""
+        now = time.time()
+        for pub in self.retrying:
+            if pub.due <= now:
+                self.retrying.remove(pub)
+                return pub
+        if self.exhausted:
+            return None
+        for row, text in self.lines:
+            if self.checkpoint.done(row):
+                self.skipped += 1
+                continue
+            try:
+                return Pub(row, line_to_pub(self.topic, text, self.extra, self.keep_from))
+            except (ValueError, AttributeError) as err:
+                self.finished(row, 400, "invalid line: {0}".format(err))
+        self.exhausted = True
+        return None
+
+    def build(self, id, args):
+        """Publish the next row. Returns its {pub} followed by self or (None, None) when done."""
+        pub = self.next_pub()
+        if pub:
+            self.active.append(pub)
+            if self.rate:
+                self.next_send = max(self.next_send, time.time()) + 1.0 / self.rate
+                tn_globals.PausedUntil = max(tn_globals.PausedUntil, self.next_send)
+            return None, [pub, self]
+        if self.retrying or self.active:
+            # Wait for retries or acknowledgements.
+            return None, [self]
+
+        self.checkpoint.close()
+        elapsed = max(time.time() - self.started, 0.001)
+        stdoutln("{0}: {1} published, {2} failed, {3} skipped, {4} retried in {5:.2f}s, {6:.0f} messages/s".format(
+            self, self.published, self.failed, self.skipped, self.retried, elapsed, self.published / elapsed))
+        return None, None
+
+
+# Create the import requested by the 'import' command.
+def start_import(cmd, extra):
+    return Import(cmd.topic, cmd.file, max(1, cmd.window), max(0, cmd.rate), max(0, cmd.retries), cmd.retry_lost,
+        cmd.checkpoint or cmd.file + '.checkpoint', extra, cmd.keep_from)
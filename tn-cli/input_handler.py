@@ -24,36 +24,50 @@ def readLinesFromStdin():
             yield cmd
 
 
+# Joins lines which end with the continuation symbol \ into a single command.
+class LineJoiner:
+    def __init__(self):
+        self.partial_input = ""
+
+    def add(self, cmd):
+        """Add a line of input. Returns the complete command or None if more input is expected."""
+        cmd = cmd.strip()
+        # Check for continuation symbol \ in the end of the line.
+        if len(cmd) > 0 and cmd[-1] == "\\":
+            cmd = cmd[:-1].rstrip()
+            if cmd:
+                if self.partial_input:
+                    self.partial_input += " " + cmd
+                else:
+                    self.partial_input = cmd
+
+            if tn_globals.IsInteractive:
+                sys.stdout.write("... ")
+                sys.stdout.flush()
+
+            return None
+
+        # Check if we have cached input from a previous multiline command.
+        if self.partial_input:
+            if cmd:
+                self.partial_input += " " + cmd
+            cmd = self.partial_input
+            self.partial_input = ""
+
+        return cmd
+
+
 # Stdin reads a possibly multiline input from stdin and queues it for asynchronous processing.
 def stdin(InputQueue):
-    partial_input = ""
+    joiner = LineJoiner()
     try:
-        for cmd in readLinesFromStdin():
-            cmd = cmd.strip()
-            # Check for continuation symbol \ in the end of the line.
-            if len(cmd) > 0 and cmd[-1] == "\\":
-                cmd = cmd[:-1].rstrip()
-                if cmd:
-                    if partial_input:
-                        partial_input += " " + cmd
-                    else:
-                        partial_input = cmd
-
-                if tn_globals.IsInteractive:
-                    sys.stdout.write("... ")
-                    sys.stdout.flush()
-
-                continue
-
-            # Check if we have cached input from a previous multiline command.
-            if partial_input:
-                if cmd:
-                    partial_input += " " + cmd
-                InputQueue.append(partial_input)
-                partial_input = ""
+        for line in readLinesFromStdin():
+            cmd = joiner.add(line)
+            if cmd is None:
                 continue
 
             InputQueue.append(cmd)
+            tn_globals.wakeup()
 
             # Stop processing input
             if cmd == 'exit' or cmd == 'quit' or cmd == '.exit' or cmd == '.quit':
@@ -63,3 +77,4 @@ def stdin(InputQueue):
         printerr("Exception in stdin", ex)
 
     InputQueue.append('exit')
+    tn_globals.wakeup()
@@ -0,0 +1,287 @@
+"""Load generator: runs the same script in many concurrent sessions over gRPC.
+
+Each session opens its own MessageLoop stream, sends {hi} and {login} using credentials
+from the accounts CSV file, then executes the script. Streams are multiplexed over a small
+number of channels. The script is precompiled once and the frames are shared by all sessions;
+values of $variables are kept per session. Requires Python 3.7 or newer."""
+
+from __future__ import print_function
+
+import asyncio
+import csv
+import io
+import itertools
+import random
+import time
+
+import grpc
+from grpc import aio
+
+from tinode_grpc import pb, pbx
+
+import precompile
+import tn_globals
+from stats import Collector, NO_RESPONSE
+from tn_globals import printerr
+from client import EXIT_COMMANDS, open_channel, user_agent, write_stats
+from commands import setVar
+
+
+# Read accounts from CSV file with 'username' and 'password' columns, like loadtest/users.csv.
+# Files without a header are read as username,password pairs.
+def read_accounts(filename):
+    with open(filename, 'r') as f:
+        rows = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+    if rows and 'username' in rows[0] and 'password' in rows[0]:
+        uidx, pidx = rows[0].index('username'), rows[0].index('password')
+        rows = rows[1:]
+    else:
+        uidx, pidx = 0, 1
+    return [(row[uidx], row[pidx]) for row in rows if len(row) > max(uidx, pidx)]
+
+
+# Read the script as a list of frames and source lines. Plain text scripts are compiled in memory.
+def load_script(filename, args):
+    if precompile.is_precompiled(filename):
+        return list(precompile.read_frames(filename))
+
+    out = io.BytesIO()
+    with open(filename, 'r') as src:
+        compiler = precompile.compile_lines(src, out, args)
+    if compiler.errors:
+        raise ValueError("{0} errors in '{1}'".format(compiler.errors, filename))
+    return list(precompile.parse_frames(out.getvalue(), filename))
+
+
+class Stats:
+    """Counters shared by all sessions."""
+
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.sent = 0
+        self.responses = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.skipped = set()
+
+
+class Session:
+    """One MessageLoop stream executing the script."""
+
+    def __init__(self, index, channel, account, frames, args, stats):
+        self.index = index
+        self.channel = channel
+        self.uname, self.password = account
+        self.frames = frames
+        self.args = args
+        self.stats = stats
+        self.id = random.randint(10000, 60000)
+        self.variables = {}
+        # Outstanding synchronous requests: id -> future.
+        self.pending = {}
+        # Time of sending of requests: id -> (command, time).
+        self.sent_at = {}
+        # Variables being assigned: name -> future.
+        self.assigning = {}
+        # Reason of failure of a .must request.
+        self.error = None
+
+    def next_id(self):
+        self.id += 1
+        return str(self.id)
+
+    # Resolve pending request with the server response.
+    def resolve(self, id, response, code):
+        future = self.pending.pop(id, None)
+        sent = self.sent_at.pop(id, None)
+        if sent:
+            Collector.record(sent[0], time.time() - sent[1])
+        if future and not future.done():
+            future.set_result((code, response))
+
+    async def read_responses(self, call):
+        async for msg in call:
+            self.stats.responses += 1
+            if msg.HasField('ctrl'):
+                if msg.ctrl.code >= 400:
+                    self.stats.errors += 1
+                self.resolve(msg.ctrl.id, msg.ctrl, msg.ctrl.code)
+            elif msg.HasField('meta'):
+                self.resolve(msg.meta.id, msg.meta, 200)
+        pending, self.pending = self.pending, {}
+        self.sent_at = {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(Exception("stream closed"))
+
+    async def send(self, call, msg, sync, frame=None):
+        """Send message. Returns future resolved with (code, response) if sync is True."""
+        what = msg.WhichOneof('Message')
+        body = getattr(msg, what)
+        if what not in NO_RESPONSE:
+            self.sent_at[body.id] = (what, time.time())
+        future = None
+        if sync:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[body.id] = future
+            if frame:
+                # The response may arrive before write() returns.
+                future.add_done_callback(lambda f: self.completed(f, frame))
+                if frame.varname:
+                    self.assigning[frame.varname] = future
+        await call.write(msg)
+        self.stats.sent += 1
+        return future
+
+    async def wait_for(self, future, src):
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.args.await_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            raise Exception("timeout waiting for response to '{0}'".format(src))
+
+    # Wait until the number of outstanding requests drops below the limit.
+    async def drain(self, limit=1):
+        while len(self.pending) >= limit:
+            done, _ = await asyncio.wait(list(self.pending.values()), timeout=self.args.await_timeout,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                self.stats.timeouts += len(self.pending)
+                raise Exception("timeout waiting for {0} responses".format(len(self.pending)))
+
+    async def hello(self, call):
+        agent, lib_version = user_agent()
+        hi = pb.ClientMsg(hi=pb.ClientHi(id=self.next_id(), user_agent=agent,
+            ver=lib_version, lang="EN", background=True))
+        code, ctrl = await self.wait_for(await self.send(call, hi, True), '{hi}')
+        if code >= 400:
+            raise Exception("{hi} failed: " + str(code) + " " + ctrl.text)
+
+        secret = (self.uname + ":" + self.password).encode('utf-8')
+        login = pb.ClientMsg(login=pb.ClientLogin(id=self.next_id(), scheme='basic', secret=secret))
+        code, ctrl = await self.wait_for(await self.send(call, login, True), '{login}')
+        if code >= 400:
+            raise Exception("{login} as '" + self.uname + "' failed: " + str(code) + " " + ctrl.text)
+
+    # Execute one frame. Returns False if the script is finished.
+    async def execute(self, call, frame):
+        if isinstance(frame, str):
+            parts = frame.split()
+            if parts[0] in EXIT_COMMANDS:
+                return False
+            if parts[0] == '.sleep' and len(parts) > 1:
+                await asyncio.sleep(int(parts[1]) / 1000.)
+            elif parts[0] == '.barrier':
+                await self.drain()
+            elif parts[0] not in ['.use', '.delmark', '.verbose', '.log', '.window', '.stats']:
+                # File transfers and other lines which need the interpreter are not supported.
+                self.stats.skipped.add(frame)
+            return True
+
+        for ref in frame.refs:
+            future = self.assigning.get(ref)
+            if future:
+                await self.wait_for(future, frame.src)
+
+        msg = frame.message(self.next_id(), self.variables)
+        if msg is None:
+            raise Exception("failed to build '{0}'".format(frame.src))
+
+        if await self.send(call, msg, frame.synchronous, frame):
+            await self.drain(tn_globals.SyncWindow)
+        return True
+
+    def completed(self, future, frame):
+        if future.cancelled() or future.exception():
+            return
+        code, response = future.result()
+        if frame.varname:
+            setVar(frame.varname, response, frame.projection, self.variables)
+            if self.assigning.get(frame.varname) is future:
+                del self.assigning[frame.varname]
+        if frame.failOnError and code >= 400:
+            self.error = "'{0}' failed: {1} {2}".format(frame.src, code, response.text)
+
+    async def run(self):
+        self.stats.started += 1
+        call = pbx.NodeStub(self.channel).MessageLoop()
+        reader = asyncio.ensure_future(self.read_responses(call))
+        try:
+            await self.hello(call)
+            for frame in self.frames:
+                if self.error or not await self.execute(call, frame):
+                    break
+            if not self.error:
+                await self.drain()
+            if self.error:
+                raise Exception(self.error)
+            await call.done_writing()
+            await asyncio.wait_for(reader, self.args.await_timeout)
+            self.stats.completed += 1
+        except grpc.RpcError as err:
+            self.stats.failed += 1
+            printerr("Session {0}: gRPC failed with {1}: {2}".format(self.index, err.code(), err.details()))
+        except Exception as ex:
+            self.stats.failed += 1
+            printerr("Session {0}: {1}".format(self.index, ex))
+        finally:
+            reader.cancel()
+            call.cancel()
+
+
+async def main(args, accounts, frames):
+    # Use separate subchannels so each channel gets its own connection.
+    channels = [open_channel(args, aio, (('grpc.use_local_subchannel_pool', 1),))
+        for _ in range(args.load_channels)]
+    stats = Stats()
+    sessions = [Session(i, channels[i % len(channels)], account, frames, args, stats)
+        for i, account in zip(range(args.load_sessions), itertools.cycle(accounts))]
+
+    async def start(session):
+        if args.load_ramp:
+            await asyncio.sleep(args.load_ramp * session.index / len(sessions))
+        await session.run()
+
+    Collector.reset()
+    print("Starting {0} sessions over {1} channels".format(len(sessions), len(channels)))
+    begin = time.time()
+    try:
+        await asyncio.gather(*[start(session) for session in sessions])
+    finally:
+        for channel in channels:
+            await channel.close()
+    elapsed = time.time() - begin
+
+    for line in sorted(stats.skipped):
+        printerr("Skipped unsupported line '{0}'".format(line))
+    print("Sessions: {0} completed, {1} failed".format(stats.completed, stats.failed))
+    print("Messages: {0} sent, {1} received, {2} errors, {3} timeouts".format(
+        stats.sent, stats.responses, stats.errors, stats.timeouts))
+    print("Elapsed {0:.3f}s, {1:.0f} messages/s".format(elapsed, stats.sent / elapsed if elapsed else 0))
+    print(Collector.report())
+    write_stats(args)
+    return 1 if stats.failed else 0
+
+
+# Run the load test. Returns process exit code.
+def run(args):
+    if not args.load_script or not args.accounts:
+        printerr("Load test requires --load-script and --accounts")
+        return 1
+    if args.load_channels < 1:
+        printerr("Invalid --load-channels", args.load_channels)
+        return 1
+    try:
+        accounts = read_accounts(args.accounts)
+        frames = load_script(args.load_script, args)
+    except (IOError, ValueError) as err:
+        printerr("Failed to load test data:", err)
+        return 1
+    if not accounts:
+        printerr("No accounts in '{0}'".format(args.accounts))
+        return 1
+
+    random.seed()
+    return asyncio.run(main(args, accounts, frames))
@@ -1,8 +1,70 @@
-"""Tinode command line macro definitions."""
+"""Tinode command line macro definitions.
+
+A macro either expands to a list of text commands which are parsed and executed one by one
+(expand) or builds the messages directly (steps). Steps of a native macro list the steps they
+depend on: steps which do not depend on each other are sent without waiting for responses,
+up to the synchronous window (--sync-window)."""
 
 import argparse
+import csv
+import json
+import os
+import time
+
+from tinode_grpc import pb
+
 import tn_globals
+from client import Request
 from tn_globals import stdoutln
+from utils import encode_to_bytes, makeTheCard, parse_cred, parse_trusted
+
+
+class Step(Request):
+    """One step of a native macro: a pb.ClientMsg to send or a local action.
+    * text - description of the step; for actions, the equivalent script line.
+    * after - steps which must complete before this one starts. If one of them fails,
+      the step is skipped unless it is a cleanup step, e.g. {leave}.
+    * varname - variable to assign the response to."""
+
+    def __init__(self, text, msg=None, after=None, varname=None, must=True, action=None, cleanup=False):
+        Request.__init__(self, msg, must)
+        self.text = text
+        self.after = after or []
+        self.varname = varname
+        self.action = action
+        self.cleanup = cleanup
+        # Maximum number of requests in flight; tn_globals.SyncWindow by default.
+        self.window = None
+
+    def __str__(self):
+        return self.text
+
+    def ready(self):
+        """All steps this one depends on are completed and the window is not full."""
+        if self.msg is not None and len(tn_globals.InFlight) >= (self.window or tn_globals.SyncWindow):
+            return False
+        return all(step.done() for step in self.after)
+
+    def build(self, id, args):
+        """Returns the message with the given id and the command description in the same
+        format as serialize_cmd. Actions are executed and return (None, None)."""
+        if not self.cleanup:
+            for step in self.after:
+                if step.failed():
+                    # Failed dependency.
+                    self.id = ''
+                    self.respond(424, "skipped: '{0}' failed".format(step.text))
+                    return None, None
+
+        if self.action:
+            self.id = ''
+            self.action()
+            return None, None
+
+        msg, cmd = Request.build(self, id, args)
+        if self.varname:
+            cmd.varname = self.varname
+        return msg, cmd
 
 
 class Macro:
@@ -32,22 +94,81 @@ class Macro:
         """Expands the macro to a list of basic Tinode CLI commands."""
         pass
 
+    def steps(self, id, cmd, args):
+        """Expands the macro to a list of Step objects. Overrides expand when implemented."""
+        pass
+
+    def native(self):
+        return type(self).steps is not Macro.steps
+
     def run(self, id, cmd, args):
-        """Expands the macro and returns the list of commands to actually execute to the caller
-        depending on the presence of the --explain argument.
+        """Expands the macro and returns the list of commands or steps to actually execute
+        to the caller depending on the presence of the --explain argument.
         """
-        cmds = self.expand(id, cmd, args)
+        cmds = self.steps(id, cmd, args) if self.native() else self.expand(id, cmd, args)
         if cmd.explain:
             if cmds is None:
                 return None
-            for item in cmds:
-                stdoutln(item)
+            explain(cmds)
             return []
         return cmds
 
 
+# Print commands or steps of the macro. Steps are numbered to show the dependencies.
+def explain(cmds):
+    numbers = {}
+    for item in cmds:
+        if not isinstance(item, Step):
+            stdoutln(item)
+            continue
+        numbers[item] = len(numbers) + 1
+        after = " (after {0})".format(", ".join([str(numbers[step]) for step in item.after])) \
+            if item.after else ""
+        stdoutln("{0}. {1}{2}".format(numbers[item], item, after))
+
+
+# Extra parameters of a message sent on behalf of the user, by default the one set with .use.
+def on_behalf(user=None, as_root=False):
+    return pb.ClientExtra(on_behalf_of=user if user is not None else tn_globals.DefaultUser,
+        auth_level=pb.ROOT if as_root else pb.NONE)
+
+
+# Variable which holds the response of the macro, one per user when there are several users.
+def var_name(cmd, users, index):
+    varname = cmd.varname if hasattr(cmd, 'varname') and cmd.varname else '$temp'
+    return varname if len(users) == 1 else varname + str(index + 1)
+
+
+# Step which writes the value of a variable to stdout.
+def log_step(path, after):
+    from commands import getVar
+    return Step('.log ' + path, after=[after], action=lambda: stdoutln(getVar(path)))
+
+
+# Steps which subscribe to 'me' on behalf of the user, send the message and leave 'me'.
+# Returns the list of steps and the step which sends the message.
+def as_user(user, text, msg, varname=None):
+    sub = Step('sub me (as %s)' % user,
+        pb.ClientMsg(sub=pb.ClientSub(topic='me'), extra=on_behalf(user)))
+    step = Step(text + ' (as %s)' % user, msg, after=[sub], varname=varname)
+    leave = Step('leave me (as %s)' % user,
+        pb.ClientMsg(leave=pb.ClientLeave(topic='me'), extra=on_behalf(user)), after=[step], cleanup=True)
+    return [sub, step, leave], step
+
+
+# {set} on 'me' which updates theCard, private comment, trusted values, default acs or credentials.
+def set_me(user, fn=None, note=None, photo=None, private=None, trusted=None, auth=None, anon=None, cred=None):
+    query = pb.SetQuery(desc=pb.SetDesc(default_acs=pb.DefaultAcsMode(auth=auth, anon=anon),
+        public=encode_to_bytes(makeTheCard(fn, note, photo)), private=encode_to_bytes(private),
+        trusted=encode_to_bytes(parse_trusted(trusted))))
+    if cred:
+        query.cred.CopyFrom(parse_cred(cred)[0])
+    return pb.ClientMsg(set=pb.ClientSet(topic='me', query=query),
+        extra=on_behalf(user, trusted is not None))
+
+
 class Usermod(Macro):
-    """Modifies user account. The following modes are available:
+    """Modifies user accounts. The following modes are available:
     * suspend/unsuspend account.
     * change user's theCard (public name, description, avatar), private comment, trusted values.
 
@@ -57,10 +178,10 @@ class Usermod(Macro):
         return "usermod"
 
     def description(self):
-        return 'Modify user account (requires root privileges)'
+        return 'Modify user accounts (requires root privileges)'
 
     def add_parser_args(self):
-        self.parser.add_argument('userid', help='user to update')
+        self.parser.add_argument('userid', nargs='+', help='users to update')
         self.parser.add_argument('-L', '--suspend', action='store_true', help='Suspend account')
         self.parser.add_argument('-U', '--unsuspend', action='store_true', help='Unsuspend account')
         self.parser.add_argument('--name', help='Public name')
@@ -69,41 +190,27 @@ class Usermod(Macro):
         self.parser.add_argument('--note', help='Account description')
         self.parser.add_argument('--trusted', help='Add/remove trusted marker: verified, staff, danger')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
 
-        # Suspend/unsuspend user.
+        # Suspend/unsuspend users.
         if cmd.suspend or cmd.unsuspend:
             if cmd.suspend and cmd.unsuspend:
                 stdoutln("Cannot both suspend and unsuspend account")
                 return None
-            new_cmd = 'acc --user %s --as_root' % cmd.userid
-            if cmd.suspend:
-                new_cmd += ' --suspend true'
-            if cmd.unsuspend:
-                new_cmd += ' --suspend false'
-            return [new_cmd]
+            state = 'susp' if cmd.suspend else 'ok'
+            return [Step('acc --user %s --as_root --suspend %s' % (user, 'true' if cmd.suspend else 'false'),
+                pb.ClientMsg(acc=pb.ClientAcc(user_id=user, state=state), extra=on_behalf(as_root=True)))
+                for user in cmd.userid]
 
         # Change theCard.
-        varname = cmd.varname if hasattr(cmd, 'varname') and cmd.varname else '$temp'
-        set_cmd = '.must ' + varname + ' set me'
-        if cmd.name is not None:
-            set_cmd += ' --fn="%s"' % cmd.name
-        if cmd.avatar is not None:
-            set_cmd += ' --photo="%s"' % cmd.avatar
-        if cmd.comment is not None:
-            set_cmd += ' --private="%s"' % cmd.comment
-        if cmd.note is not None:
-            set_cmd += ' --note="%s"' % cmd.note
-        if cmd.trusted is not None:
-            set_cmd += ' --trusted="%s" --as_root' % cmd.trusted
-        old_user = tn_globals.DefaultUser if tn_globals.DefaultUser else ''
-        return ['.use --user %s' % cmd.userid,
-                '.must sub me',
-                set_cmd,
-                '.must leave me',
-                '.use --user "%s"' % old_user]
+        steps = []
+        for i, user in enumerate(cmd.userid):
+            msg = set_me(user, fn=cmd.name, note=cmd.note, photo=cmd.avatar, private=cmd.comment,
+                trusted=cmd.trusted)
+            steps.extend(as_user(user, 'set me', msg, var_name(cmd, cmd.userid, i))[0])
+        return steps
 
 
 class Resolve(Macro):
@@ -118,16 +225,22 @@ class Resolve(Macro):
     def add_parser_args(self):
         self.parser.add_argument('login', help='login to resolve')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.login:
             return None
 
-        varname = cmd.varname if hasattr(cmd, 'varname') and cmd.varname else '$temp'
-        return ['.must sub fnd',
-                '.must set fnd --public=basic:%s' % cmd.login,
-                '.must %s get fnd --sub' % varname,
-                '.must leave fnd',
-                '.log %s.sub[0].topic' % varname]
+        varname = var_name(cmd, [cmd.login], 0)
+        sub = Step('sub fnd', pb.ClientMsg(sub=pb.ClientSub(topic='fnd'), extra=on_behalf()))
+        query = Step('set fnd --public=basic:%s' % cmd.login,
+            pb.ClientMsg(set=pb.ClientSet(topic='fnd',
+                query=pb.SetQuery(desc=pb.SetDesc(public=encode_to_bytes('basic:' + cmd.login)))),
+                extra=on_behalf()),
+            after=[sub])
+        get = Step('get fnd --sub', pb.ClientMsg(get=pb.ClientGet(topic='fnd', query=pb.GetQuery(what='sub')),
+            extra=on_behalf()), after=[query], varname=varname)
+        leave = Step('leave fnd', pb.ClientMsg(leave=pb.ClientLeave(topic='fnd'), extra=on_behalf()), after=[get],
+            cleanup=True)
+        return [sub, query, get, leave, log_step(varname + '.sub[0].topic', get)]
 
 
 class Passwd(Macro):
@@ -143,7 +256,7 @@ class Passwd(Macro):
         self.parser.add_argument('userid', help='Id of the user')
         self.parser.add_argument('-P', '--password', help='New password')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
 
@@ -151,7 +264,9 @@ class Passwd(Macro):
             stdoutln("Password (-P) not specified")
             return None
 
-        return ['acc --user %s --scheme basic --secret :%s' % (cmd.userid, cmd.password)]
+        return [Step('acc --user %s --scheme basic --secret :***' % cmd.userid,
+            pb.ClientMsg(acc=pb.ClientAcc(user_id=cmd.userid, scheme='basic',
+                secret=(':' + cmd.password).encode('utf-8')), extra=on_behalf()))]
 
 
 class Useradd(Macro):
@@ -176,7 +291,7 @@ class Useradd(Macro):
         self.parser.add_argument('--auth', help='Default auth acs')
         self.parser.add_argument('--anon', help='Default anon acs')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.login:
             return None
         if not cmd.password:
@@ -185,79 +300,69 @@ class Useradd(Macro):
         if not cmd.cred:
             stdoutln("Must specify at least one credential: --cred.")
             return None
-        varname = cmd.varname if hasattr(cmd, 'varname') and cmd.varname else '$temp'
-        new_cmd = '.must ' + varname + ' acc --scheme basic --secret="%s:%s" --cred="%s"' % (cmd.login, cmd.password, cmd.cred)
-        if cmd.name:
-            new_cmd += ' --fn="%s"' % cmd.name
-        if cmd.comment:
-            new_cmd += ' --private="%s"' % cmd.comment
-        if cmd.note is not None:
-            set_cmd += ' --note="%s"' % cmd.note
-        if cmd.trusted is not None:
-            set_cmd += ' --trusted="%s" --as_root' % cmd.trusted
-        if cmd.tags:
-            new_cmd += ' --tags="%s"' % cmd.tags
-        if cmd.avatar:
-            new_cmd += ' --photo="%s"' % cmd.avatar
-        if cmd.auth:
-            new_cmd += ' --auth="%s"' % cmd.auth
-        if cmd.anon:
-            new_cmd += ' --anon="%s"' % cmd.anon
-        return [new_cmd]
+        varname = var_name(cmd, [cmd.login], 0)
+        msg = pb.ClientMsg(acc=pb.ClientAcc(user_id='new', scheme='basic',
+            secret=('%s:%s' % (cmd.login, cmd.password)).encode('utf-8'),
+            tags=cmd.tags.split(",") if cmd.tags else None,
+            desc=pb.SetDesc(default_acs=pb.DefaultAcsMode(auth=cmd.auth, anon=cmd.anon),
+                public=encode_to_bytes(makeTheCard(cmd.name, cmd.note, cmd.avatar)),
+                private=encode_to_bytes(cmd.comment),
+                trusted=encode_to_bytes(parse_trusted(cmd.trusted))),
+            cred=parse_cred(cmd.cred)),
+            extra=on_behalf(as_root=cmd.trusted is not None))
+        return [Step('acc --scheme basic --secret="%s:***" --cred="%s"' % (cmd.login, cmd.cred), msg, varname=varname)]
 
 
 class Chacs(Macro):
-    """Modifies default acs (permissions) on a user account."""
+    """Modifies default acs (permissions) on user accounts."""
 
     def name(self):
         return "chacs"
 
     def description(self):
-        return "Change default permissions/acs for a user (requires root privileges)"
+        return "Change default permissions/acs for users (requires root privileges)"
 
     def add_parser_args(self):
-        self.parser.add_argument('userid', help='User id')
+        self.parser.add_argument('userid', nargs='+', help='User ids')
         self.parser.add_argument('--auth', help='New auth acs value')
         self.parser.add_argument('--anon', help='New anon acs value')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
         if not cmd.auth and not cmd.anon:
             stdoutln('Must specify at least either of --auth, --anon')
             return None
-        set_cmd = '.must set me'
-        if cmd.auth:
-            set_cmd += ' --auth=%s' % cmd.auth
-        if cmd.anon:
-            set_cmd += ' --anon=%s' % cmd.anon
-        old_user = tn_globals.DefaultUser if tn_globals.DefaultUser else ''
-        return ['.use --user %s' % cmd.userid,
-                '.must sub me',
-                set_cmd,
-                '.must leave me',
-                '.use --user "%s"' % old_user]
+        steps = []
+        for user in cmd.userid:
+            steps.extend(as_user(user, 'set me --auth=%s --anon=%s' % (cmd.auth, cmd.anon),
+                set_me(user, auth=cmd.auth, anon=cmd.anon))[0])
+        return steps
+
 
 class Userdel(Macro):
-    """Deletes a user account."""
+    """Deletes user accounts."""
 
     def name(self):
         return "userdel"
 
     def description(self):
-        return "Delete user account (requires root privileges)"
+        return "Delete user accounts (requires root privileges)"
 
     def add_parser_args(self):
-        self.parser.add_argument('userid', help='User id')
+        self.parser.add_argument('userid', nargs='+', help='User ids')
         self.parser.add_argument('--hard', action='store_true', help='Hard delete')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
-        del_cmd = 'del user --user %s --as_root' % cmd.userid
-        if cmd.hard:
-            del_cmd += ' --hard'
-        return [del_cmd]
+        steps = []
+        for user in cmd.userid:
+            msg = pb.ClientMsg(extra=on_behalf(as_root=True))
+            # Field named 'del' conflicts with the keyword 'del'.
+            getattr(msg, 'del').CopyFrom(pb.ClientDel(what=pb.ClientDel.USER, user_id=user, hard=cmd.hard))
+            steps.append(Step('del user --user %s --as_root%s' % (user, ' --hard' if cmd.hard else ''), msg))
+        return steps
 
 
 class Chcred(Macro):
@@ -276,7 +381,7 @@ class Chcred(Macro):
         self.parser.add_argument('--rm', action='store_true', help='Delete credential')
         self.parser.add_argument('--validate', action='store_true', help='Validate credential')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
         if not cmd.cred:
@@ -287,44 +392,252 @@ class Chcred(Macro):
         if num_actions == 0 or num_actions > 1:
             stdoutln('Must specify exactly one action: --add, --rm, --validate')
             return None
-        if cmd.add:
-            cred_cmd = '.must set me --cred %s' % cmd.cred
         if cmd.rm:
-            cred_cmd = '.must del --topic me --cred %s cred' % cmd.cred
+            msg = pb.ClientMsg(extra=on_behalf(cmd.userid))
+            getattr(msg, 'del').CopyFrom(pb.ClientDel(topic='me', what=pb.ClientDel.CRED,
+                cred=parse_cred(cmd.cred)[0]))
+            return as_user(cmd.userid, 'del --topic me --cred %s cred' % cmd.cred, msg)[0]
 
-        old_user = tn_globals.DefaultUser if tn_globals.DefaultUser else ''
-        return ['.use --user %s' % cmd.userid,
-                '.must sub me',
-                cred_cmd,
-                '.must leave me',
-                '.use --user "%s"' % old_user]
+        # Credential with the response (method:value:response) validates it.
+        return as_user(cmd.userid, 'set me --cred %s' % cmd.cred, set_me(cmd.userid, cred=cmd.cred))[0]
 
 
 class Thecard(Macro):
-    """Prints user's theCard."""
+    """Prints users' theCards."""
 
     def name(self):
         return "thecard"
 
     def description(self):
-        return "Print theCard for a user (requires root privileges)"
+        return "Print theCard for users (requires root privileges)"
 
     def add_parser_args(self):
-        self.parser.add_argument('userid', help='User id')
+        self.parser.add_argument('userid', nargs='+', help='User ids')
         self.parser.add_argument('--what', choices=['desc', 'cred'], required=True, help='Type of data to print (desc - public/private data, cred - list of credentials.')
 
-    def expand(self, id, cmd, args):
+    def steps(self, id, cmd, args):
         if not cmd.userid:
             return None
 
-        varname = cmd.varname if hasattr(cmd, 'varname') and cmd.varname else '$temp'
-        old_user = tn_globals.DefaultUser if tn_globals.DefaultUser else ''
-        return ['.use --user %s' % cmd.userid,
-                '.must sub me',
-                '.must %s get me --%s' % (varname, cmd.what),
-                '.must leave me',
-                '.use --user "%s"' % old_user,
-                '.log %s' % varname]
+        steps = []
+        for i, user in enumerate(cmd.userid):
+            varname = var_name(cmd, cmd.userid, i)
+            chain, get = as_user(user, 'get me --%s' % cmd.what,
+                pb.ClientMsg(get=pb.ClientGet(topic='me', query=pb.GetQuery(what=cmd.what)),
+                    extra=on_behalf(user)), varname)
+            steps.extend(chain)
+            steps.append(log_step(varname, get))
+        return steps
+
+
+# Macros which can be run by 'bulk'.
+BULK_MACROS = ['useradd', 'usermod', 'userdel', 'passwd', 'chacs', 'chcred']
+
+# Default number of rows in progress.
+BULK_WINDOW = 32
+
+# Seconds between progress reports.
+BULK_PROGRESS_INTERVAL = 5.0
+
+
+# Read rows of a CSV file with a header line or of a file with one JSON object per line.
+# Yields (row number, row): a dictionary or a line of JSON to be converted with parse_row().
+def read_rows(filename):
+    with open(filename, 'r', newline='') as f:
+        if filename.endswith('.jsonl') or filename.endswith('.json'):
+            for n, line in enumerate(f, 1):
+                if line.strip():
+                    yield n, line
+        else:
+            for n, row in enumerate(csv.DictReader(f), 1):
+                yield n, row
+
+
+# Row as a dictionary. Raises ValueError if a line of JSON is not a valid JSON object.
+def parse_row(row):
+    if isinstance(row, dict):
+        return row
+    data = json.loads(row)
+    if not isinstance(data, dict):
+        raise ValueError("not a JSON object")
+    return data
+
+
+# Convert a row into the arguments of the macro. Keys are names of the arguments,
+# e.g. login, password, cred, userid, suspend. Missing keys take the default values.
+def row_args(macro, row):
+    cmd = argparse.Namespace(cmd=macro.name(), explain=False)
+    for action in macro.parser._actions:
+        if action.dest in ('help', 'explain'):
+            continue
+        val = row.get(action.dest, row.get(action.dest.replace('_', '-')))
+        if val is None or val == '':
+            val = action.default
+        elif action.nargs == 0:
+            # Flags like --suspend.
+            val = val if isinstance(val, bool) else str(val).strip().lower() in ('1', 'true', 'yes', 'y')
+        elif action.nargs == '+':
+            val = val if isinstance(val, list) else [str(val)]
+        else:
+            val = str(val)
+        setattr(cmd, action.dest, val)
+    return cmd
+
+
+# Value of the first positional argument which identifies the row in the output, e.g. login.
+def row_key(macro, cmd):
+    for action in macro.parser._actions:
+        if not action.option_strings:
+            key = getattr(cmd, action.dest)
+            return ','.join(key) if isinstance(key, list) else key
+    return None
+
+
+class BulkRun:
+    """Input which runs the macro for the rows of the file one row at a time, keeping up to
+    'window' rows in progress. Rows are completed in any order. The result of each row is
+    appended to the checkpoint file; rows which succeeded earlier are skipped."""
+
+    def __init__(self, macro, filename, window, checkpoint, args):
+        self.macro = macro
+        self.filename = filename
+        self.window = window
+        self.checkpoint = checkpoint
+        self.rows = read_rows(filename)
+        self.done = self.load_checkpoint()
+        self.log = open(checkpoint, 'a')
+        # Rows in progress: (row number, key, steps).
+        self.active = []
+        self.exhausted = False
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.started = time.time()
+        self.reported = self.started
+
+    def __str__(self):
+        return "bulk %s %s" % (self.macro.name(), self.filename)
+
+    def load_checkpoint(self):
+        """Numbers of the rows which succeeded in earlier runs."""
+        done = set()
+        try:
+            with open(self.checkpoint, 'r') as f:
+                for line in f:
+                    try:
+                        result = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete after a crash.
+                        continue
+                    if result.get('code', 500) < 400:
+                        done.add(result['row'])
+        except IOError:
+            pass
+        return done
+
+    def ready(self):
+        self.collect()
+        if self.exhausted:
+            return not self.active
+        return len(self.active) < self.window
+
+    def collect(self):
+        """Report rows with all steps completed."""
+        active = []
+        for row, key, steps in self.active:
+            if all(step.done() for step in steps):
+                failed = [step for step in steps if step.failed()]
+                self.finished(row, key, failed[0].code if failed else 200,
+                    "{0}: {1}".format(failed[0].text, failed[0].reason) if failed else "ok")
+            else:
+                active.append((row, key, steps))
+        self.active = active
+
+    def finished(self, row, key, code, text):
+        if code < 400:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        stdoutln("Row {0} ({1}): {2} {3}".format(row, key, code, text))
+        self.log.write(json.dumps({'row': row, 'key': key, 'code': code, 'text': text}) + "\n")
+        self.log.flush()
+        now = time.time()
+        if now - self.reported >= BULK_PROGRESS_INTERVAL:
+            self.reported = now
+            stdoutln("{0}: {1} rows, {2:.1f} rows/s".format(self, self.succeeded + self.failed,
+                (self.succeeded + self.failed) / (now - self.started)))
+
+    def build(self, id, args):
+        """Start the next row. Returns its steps followed by self or (None, None) when all rows are done."""
+        for row, data in self.rows:
+            if row in self.done:
+                self.skipped += 1
+                continue
+            key = None
+            try:
+                cmd = row_args(self.macro, parse_row(data))
+                key = row_key(self.macro, cmd)
+                steps = self.macro.steps(id, cmd, args)
+            except Exception as err:
+                # One bad row does not stop the run.
+                self.finished(row, key, 400, "invalid row: {0}".format(err))
+                continue
+            if not steps:
+                self.finished(row, key, 400, "invalid row")
+                continue
+            for step in steps:
+                step.must = False
+                step.quiet = True
+                step.window = self.window
+                step.varname = None
+            self.active.append((row, key, steps))
+            return None, steps + [self]
+
+        if not self.exhausted:
+            self.exhausted = True
+            if self.active:
+                return None, [self]
+        self.log.close()
+        elapsed = max(time.time() - self.started, 0.001)
+        stdoutln("{0}: {1} succeeded, {2} failed, {3} skipped in {4:.2f}s, {5:.1f} rows/s".format(self,
+            self.succeeded, self.failed, self.skipped, elapsed, (self.succeeded + self.failed) / elapsed))
+        return None, None
+
+
+class Bulk(Macro):
+    """Runs a macro for every row of a CSV or JSONL file with several rows in progress.
+    Results are appended to the checkpoint file, which also lets an interrupted run resume."""
+
+    # Rows are read when the macro runs, not when a script is precompiled.
+    runtime = True
+
+    def name(self):
+        return "bulk"
+
+    def description(self):
+        return "Run %s for every row of a CSV or JSONL file" % ", ".join(BULK_MACROS)
+
+    def add_parser_args(self):
+        self.parser.add_argument('macro', choices=BULK_MACROS, help='macro to run')
+        self.parser.add_argument('file', help='CSV file with a header line or JSONL file; keys are macro arguments')
+        self.parser.add_argument('--window', type=int, default=BULK_WINDOW, help='maximum number of rows in progress')
+        self.parser.add_argument('--checkpoint', help='file with results of the rows, default <file>.checkpoint')
+
+    def run(self, id, cmd, args):
+        macro = Macros[cmd.macro]
+        if not os.path.exists(cmd.file):
+            stdoutln("File '%s' not found" % cmd.file)
+            return None
+        if cmd.explain:
+            # Steps of the first row.
+            for row, data in read_rows(cmd.file):
+                steps = macro.steps(id, row_args(macro, parse_row(data)), args)
+                if steps is None:
+                    return None
+                explain(steps)
+                break
+            return []
+        return [BulkRun(macro, cmd.file, max(1, cmd.window), cmd.checkpoint or cmd.file + '.checkpoint', args)]
 
 
 def parse_macro(parts):
@@ -337,4 +650,4 @@ def parse_macro(parts):
     return macro.parser
 
 
-Macros = {x.name(): x for x in [Usermod(), Resolve(), Passwd(), Useradd(), Chacs(), Userdel(), Chcred(), Thecard()]}
+Macros = {x.name(): x for x in [Usermod(), Resolve(), Passwd(), Useradd(), Chacs(), Userdel(), Chcred(), Thecard(), Bulk()]}
@@ -0,0 +1,359 @@
+"""Script precompilation to a file of protobuf frames and replay of such files.
+
+The file starts with MAGIC followed by records. Each record is a one byte kind followed
+by length-delimited (varint length prefix) parts:
+ * FRAME_MSG: JSON header, serialized pb.ClientMsg. The header contains the source line,
+   the command name, .await/.must flags, the name of the variable to assign, the projection
+   of the response to store in it and placeholders: paths to string fields to be filled with values of $variables at run time.
+ * FRAME_LINE: source line to be parsed and executed at run time, e.g. a local directive,
+   a file transfer, or a command with $variables which cannot be represented by placeholders.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+
+from tinode_grpc import pb
+
+import commands
+import tn_globals
+from tn_globals import printerr
+from client import EXIT_COMMANDS, RE_VARREF
+from input_handler import LineJoiner
+from utils import encode_varint, prepare_images
+
+MAGIC = b'TNPBS1\n'
+
+FRAME_MSG = b'M'
+FRAME_LINE = b'L'
+
+
+def write_varint(out, value):
+    out.write(encode_varint(value))
+
+
+def read_varint(data, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def write_part(out, data):
+    write_varint(out, len(data))
+    out.write(data)
+
+
+def read_part(data, pos):
+    size, pos = read_varint(data, pos)
+    return data[pos:pos+size], pos + size
+
+
+class Frame:
+    """Precompiled message which is ready to be sent, except for the message id and placeholders."""
+
+    def __init__(self, header, body):
+        self.body = body
+        self.src = header.get('src', '')
+        self.cmd = header.get('cmd')
+        self.synchronous = bool(header.get('sync'))
+        self.failOnError = bool(header.get('must'))
+        self.varname = header.get('var')
+        self.projection = header.get('proj')
+        self.placeholders = header.get('ph', [])
+        # Variables which must be assigned before the frame can be sent.
+        self.refs = [RE_VARREF.match(expr).group(0) for _, expr in self.placeholders]
+
+    def __str__(self):
+        return self.src
+
+    def message(self, id, variables=None):
+        """Returns pb.ClientMsg with the given id and placeholders resolved using the
+        variables (tn_globals.Variables by default) or None if a variable is not assigned."""
+        msg = pb.ClientMsg.FromString(self.body)
+        body = getattr(msg, msg.WhichOneof('Message'))
+        if 'id' in body.DESCRIPTOR.fields_by_name:
+            body.id = str(id)
+
+        for path, expr in self.placeholders:
+            val = commands.getVar(expr, variables)
+            if val is None:
+                tn_globals.stdoutln("Error in '{0}': {1} is not assigned".format(self.src, expr))
+                return None
+            set_field(msg, path, str(val))
+        return msg
+
+    def build(self, id, args):
+        """Returns pb.ClientMsg with the given id and placeholders resolved and the command
+        description in the same format as serialize_cmd."""
+        msg = self.message(id)
+        if msg is None:
+            return None, None
+
+        if self.cmd == 'login':
+            commands.onLogin(id, args)
+
+        cmd = argparse.Namespace(cmd=self.cmd, synchronous=self.synchronous, failOnError=self.failOnError)
+        if self.varname:
+            cmd.varname = self.varname
+        if self.projection:
+            cmd.projection = self.projection
+        return msg, cmd
+
+
+# Set string field of the message given a dot-separated path like 'set.query.sub.user_id'.
+def set_field(msg, path, value):
+    parts = path.split('.')
+    for p in parts[:-1]:
+        msg = getattr(msg, p)
+    setattr(msg, parts[-1], value)
+
+
+# Find singular string fields with values which start with '$'. Returns a list of [path, value].
+def find_placeholders(msg, prefix=''):
+    found = []
+    for field, value in msg.ListFields():
+        path = prefix + field.name
+        # Repeated fields and maps are containers: neither messages nor strings.
+        if hasattr(value, 'ListFields'):
+            found.extend(find_placeholders(value, path + '.'))
+        elif isinstance(value, str) and value.startswith('$'):
+            found.append([path, value])
+    return found
+
+
+class Compiler:
+    """Converts script lines into frames."""
+
+    def __init__(self, out, args, report=printerr):
+        self.out = out
+        self.args = args
+        # Function which prints errors.
+        self.report = report
+        self.id = 0
+        self.lineno = 0
+        self.errors = 0
+        self.frames = 0
+
+    def error(self, line, text):
+        self.report("Line {0}: {1}: '{2}'".format(self.lineno, text, line))
+        self.errors += 1
+
+    def write_line(self, line):
+        self.out.write(FRAME_LINE)
+        write_part(self.out, line.encode('utf-8'))
+        self.frames += 1
+
+    def write_message(self, line, cmd):
+        exprs = [val for key, val in vars(cmd).items()
+            if key != 'varname' and isinstance(val, str) and val.startswith('$')]
+        self.id += 1
+        try:
+            msg = commands.MESSAGES[cmd.cmd](self.id, cmd, self.args)
+        except Exception as err:
+            if exprs:
+                # Values of variables are transformed before being sent, e.g. base64-decoded.
+                self.write_line(line)
+            else:
+                self.error(line, str(err))
+            return
+        if msg is None:
+            if exprs:
+                self.write_line(line)
+            else:
+                self.error(line, "invalid command")
+            return
+
+        placeholders = find_placeholders(msg) if exprs else []
+        if set(exprs) != set([val for _, val in placeholders]):
+            # Some variables are not used as plain strings.
+            self.write_line(line)
+            return
+
+        header = {'src': line, 'cmd': cmd.cmd}
+        if cmd.synchronous:
+            header['sync'] = 1
+            if cmd.failOnError:
+                header['must'] = 1
+            if 'varname' in cmd:
+                header['var'] = cmd.varname
+            if 'projection' in cmd:
+                header['proj'] = cmd.projection
+        if placeholders:
+            header['ph'] = placeholders
+        self.write_frame(header, msg)
+
+    def write_frame(self, header, msg):
+        self.out.write(FRAME_MSG)
+        write_part(self.out, json.dumps(header, separators=(',', ':')).encode('utf-8'))
+        write_part(self.out, msg.SerializeToString())
+        self.frames += 1
+
+    def write_step(self, step):
+        """Write a step of a native macro. Steps which depend on others wait for all outstanding requests."""
+        if step.after:
+            self.write_line('.barrier')
+        if step.action:
+            self.write_line(step.text)
+            return
+        header = {'src': step.text, 'cmd': step.msg.WhichOneof('Message'), 'sync': 1}
+        if step.must:
+            header['must'] = 1
+        if step.varname:
+            header['var'] = step.varname
+        self.write_frame(header, step.msg)
+
+    def compile_line(self, line):
+        """Compile one line. Returns False if the line terminates the script."""
+        stripped = line.strip()
+        if not stripped or stripped.startswith('#'):
+            return True
+        if stripped in EXIT_COMMANDS:
+            self.write_line(stripped)
+            return False
+
+        cmd = commands.parse_input(line)
+        if cmd is None:
+            self.error(line, "failed to parse")
+            return True
+
+        if cmd.cmd.startswith('.'):
+            if cmd.cmd in ['.use', '.delmark']:
+                # Defaults are applied to messages at compile time.
+                if '$' in line:
+                    self.error(line, "variables cannot be used in " + cmd.cmd)
+                    return True
+                commands.serialize_cmd(line, 0, self.args)
+            self.write_line(line)
+
+        elif commands.uploads_attachment(cmd):
+            # The attachment is uploaded at run time, before the message is sent.
+            self.write_line(line)
+
+        elif cmd.cmd in commands.MESSAGES:
+            self.write_message(line, cmd)
+
+        elif commands.macros and cmd.cmd in commands.macros.Macros and '$' not in line and \
+                not getattr(commands.macros.Macros[cmd.cmd], 'runtime', False):
+            # Expand the macro now. Text steps depend on each other: run them in order.
+            self.id += 1
+            steps = commands.macros.Macros[cmd.cmd].run(self.id, cmd, self.args)
+            if steps is None:
+                self.error(line, "invalid macro")
+                return True
+            for i, step in enumerate(steps):
+                if hasattr(step, 'build'):
+                    self.write_step(step)
+                    continue
+                if i > 0:
+                    self.write_line('.barrier')
+                if not self.compile_line(step):
+                    return False
+
+        else:
+            # File transfers, exports, imports, macros with variables and macros expanded at run time.
+            self.write_line(line)
+
+        return True
+
+
+# Compile lines of the script from src file object and write frames to out. Returns the compiler.
+def compile_lines(src, out, args, report=printerr):
+    tn_globals.IsInteractive = False
+    out.write(MAGIC)
+    compiler = Compiler(out, args, report)
+    joiner = LineJoiner()
+    # Complete commands with the number of the last line.
+    lines = []
+    for lineno, line in enumerate(src, 1):
+        cmd = joiner.add(line)
+        if cmd is not None:
+            lines.append((lineno, cmd))
+    prepare_images(image_files(lines))
+    try:
+        for lineno, cmd in lines:
+            compiler.lineno = lineno
+            if not compiler.compile_line(cmd):
+                break
+    finally:
+        # Discard output of local commands executed at compile time.
+        while not tn_globals.OutputQueue.empty():
+            tn_globals.OutputQueue.get()
+        tn_globals.OnCompletion.clear()
+    return compiler
+
+
+# Names of images posted with 'pub --image' by the script.
+def image_files(lines):
+    result = []
+    for lineno, line in lines:
+        if '--image' not in line:
+            continue
+        cmd = commands.parse_input(line)
+        if cmd is not None and cmd.cmd == 'pub' and cmd.image and not cmd.image.startswith('$'):
+            result.append(cmd.image)
+    return result
+
+
+# Compile script file into a file of frames. Returns process exit code.
+def compile_script(infile, outfile, args):
+    try:
+        with open(infile, 'r') as src, open(outfile, 'wb') as out:
+            compiler = compile_lines(src, out, args)
+    except IOError as err:
+        printerr("Failed to compile '{0}':".format(infile), err)
+        return 1
+
+    print("Compiled '{0}' into '{1}': {2} frames, {3} errors".format(infile, outfile, compiler.frames, compiler.errors))
+    return 1 if compiler.errors else 0
+
+
+# Check if the file is a precompiled script.
+def is_precompiled(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+# Generator of frames and source lines stored in the file.
+def read_frames(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    for frame in parse_frames(data, filename):
+        yield frame
+
+
+# Generator of frames and source lines stored in the data buffer.
+def parse_frames(data, filename):
+    if not data.startswith(MAGIC):
+        raise ValueError("'{0}' is not a precompiled tn-cli script".format(filename))
+
+    pos = len(MAGIC)
+    while pos < len(data):
+        kind = data[pos:pos+1]
+        pos += 1
+        if kind == FRAME_MSG:
+            header, pos = read_part(data, pos)
+            body, pos = read_part(data, pos)
+            yield Frame(json.loads(header.decode('utf-8')), body)
+        elif kind == FRAME_LINE:
+            line, pos = read_part(data, pos)
+            yield line.decode('utf-8')
+        else:
+            raise ValueError("Unknown frame type {0} at offset {1}".format(kind, pos - 1))
+
+
+# Queue all frames from the file for sending, followed by the exit command.
+def load_frames(filename):
+    try:
+        for frame in read_frames(filename):
+            tn_globals.InputQueue.append(frame)
+    except Exception as err:
+        printerr("Failed to load '{0}':".format(filename), err)
+    tn_globals.InputQueue.append('exit')
+    tn_globals.wakeup()
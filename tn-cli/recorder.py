@@ -0,0 +1,279 @@
+"""Binary recording of MessageLoop traffic and deterministic replay of recordings.
+
+The file starts with MAGIC followed by records: one byte kind (REC_CLIENT for a pb.ClientMsg
+sent, REC_SERVER for a pb.ServerMsg received), a varint timestamp in microseconds since the
+start of recording (monotonic clock) and the length-delimited serialized message. Messages are
+stored as they are on the wire: recording costs one serialization per message.
+
+The replayer sends the recorded client messages to the server with the original ids. Each
+message is sent after the responses which preceded it in the recording are received, so the
+order of execution is the same at any speed. Responses are compared to the recorded ones."""
+
+from __future__ import print_function
+
+import asyncio
+import threading
+import time
+
+from grpc import aio
+
+from tinode_grpc import pb, pbx
+
+import tn_globals
+from tn_globals import printerr
+from stats import Histogram, NO_RESPONSE
+from precompile import write_varint, read_varint, write_part, read_part
+
+MAGIC = b'TNREC1\n'
+
+REC_CLIENT = b'C'
+REC_SERVER = b'S'
+
+# Maximum number of divergent responses to print.
+MAX_REPORTED = 20
+
+
+class Recorder:
+    """Writes messages to the recording file. Safe to use from multiple threads."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        self.out = open(filename, 'wb', buffering=65536)
+        self.out.write(MAGIC)
+
+    def write(self, kind, msg):
+        data = msg.SerializeToString()
+        ts = int((time.monotonic() - self.start) * 1000000)
+        with self.lock:
+            if self.out:
+                self.out.write(kind)
+                write_varint(self.out, ts)
+                write_part(self.out, data)
+
+    def client(self, msg):
+        self.write(REC_CLIENT, msg)
+
+    def server(self, msg):
+        self.write(REC_SERVER, msg)
+
+    def close(self):
+        with self.lock:
+            if self.out:
+                self.out.close()
+                self.out = None
+
+
+# Start recording to the file requested with --record.
+def start_recording(args):
+    if args.record:
+        tn_globals.Recorder = Recorder(args.record)
+
+
+def stop_recording():
+    if tn_globals.Recorder:
+        tn_globals.Recorder.close()
+        tn_globals.Recorder = None
+
+
+# Generator of (kind, timestamp in seconds, message) read from the recording.
+def read_trace(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError("'{0}' is not a tn-cli recording".format(filename))
+
+    pos = len(MAGIC)
+    while pos < len(data):
+        kind = data[pos:pos+1]
+        ts, pos = read_varint(data, pos + 1)
+        body, pos = read_part(data, pos)
+        if kind == REC_CLIENT:
+            msg = pb.ClientMsg.FromString(body)
+        elif kind == REC_SERVER:
+            msg = pb.ServerMsg.FromString(body)
+        else:
+            raise ValueError("Unknown record type {0}".format(kind))
+        yield kind, ts / 1000000.0, msg
+
+
+# Id of the request and response code if the server message is a response to a request.
+def response_of(msg):
+    if msg.HasField('ctrl'):
+        return msg.ctrl.id, msg.ctrl.code
+    if msg.HasField('meta'):
+        return msg.meta.id, 200
+    return None, None
+
+
+class Trace:
+    """Recording prepared for replay."""
+
+    def __init__(self, filename):
+        # Client messages: (timestamp, message, ids of responses received before it).
+        self.requests = []
+        # First response to each request: id -> (code, timestamp).
+        self.responses = {}
+        # Request kind and timestamp: id -> (command, timestamp).
+        self.sent = {}
+        # Number of messages which are not responses, e.g. {data} and {pres}.
+        self.other = 0
+        self.duration = 0
+
+        deps = []
+        for kind, ts, msg in read_trace(filename):
+            self.duration = ts
+            if kind == REC_CLIENT:
+                what = msg.WhichOneof('Message')
+                if what not in NO_RESPONSE:
+                    # {note} has no id and gets no response.
+                    self.sent[getattr(msg, what).id] = (what, ts)
+                self.requests.append((ts, msg, deps))
+                deps = []
+            else:
+                id, code = response_of(msg)
+                if not id:
+                    self.other += 1
+                elif id not in self.responses:
+                    self.responses[id] = (code, ts)
+                    deps.append(id)
+
+
+class Replayer:
+    """Sends recorded requests and collects responses."""
+
+    def __init__(self, trace, speed, timeout):
+        self.trace = trace
+        self.speed = speed
+        self.timeout = timeout
+        self.responses = {}
+        self.sent = {}
+        # Number of requests sent, {note} included.
+        self.requests = 0
+        self.other = 0
+        self.elapsed = 0
+        self.changed = asyncio.Event()
+
+    async def read(self, call):
+        async for msg in call:
+            id, code = response_of(msg)
+            if not id:
+                self.other += 1
+            elif id not in self.responses:
+                self.responses[id] = (code, time.monotonic() - self.start)
+                self.changed.set()
+
+    async def wait_responses(self, ids):
+        deadline = time.monotonic() + self.timeout
+        while any(id not in self.responses for id in ids):
+            self.changed.clear()
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.changed.wait(), left)
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+    async def run(self, channel):
+        call = pbx.NodeStub(channel).MessageLoop()
+        self.start = time.monotonic()
+        reader = asyncio.ensure_future(self.read(call))
+        try:
+            for ts, msg, deps in self.trace.requests:
+                if self.speed:
+                    delay = self.start + ts / self.speed - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                await self.wait_responses(deps)
+                what = msg.WhichOneof('Message')
+                if what not in NO_RESPONSE:
+                    self.sent[getattr(msg, what).id] = (what, time.monotonic() - self.start)
+                await call.write(msg)
+                self.requests += 1
+            # Collect responses to the remaining requests.
+            await self.wait_responses([id for id in self.sent if id in self.trace.responses])
+            self.elapsed = time.monotonic() - self.start
+            await call.done_writing()
+            await asyncio.wait_for(reader, self.timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if not self.elapsed:
+                self.elapsed = time.monotonic() - self.start
+            reader.cancel()
+            call.cancel()
+
+
+# Print the comparison of the replay to the recording. Returns the number of differences.
+def report(trace, replayer):
+    diverged = []
+    missing = 0
+    recorded = {}
+    replayed = {}
+    for id, (code, ts) in trace.responses.items():
+        what = trace.sent.get(id, ('?', ts))[0]
+        if id not in replayer.responses:
+            missing += 1
+            diverged.append("{0} {1}: recorded {2}, no response".format(what, id, code))
+            continue
+        rcode, rts = replayer.responses[id]
+        if rcode != code:
+            diverged.append("{0} {1}: recorded {2}, replayed {3}".format(what, id, code, rcode))
+        if id in trace.sent and id in replayer.sent:
+            recorded.setdefault(what, Histogram()).record((ts - trace.sent[id][1]) * 1000000)
+            replayed.setdefault(what, Histogram()).record((rts - replayer.sent[id][1]) * 1000000)
+    unexpected = len([id for id in replayer.responses if id not in trace.responses])
+
+    print("Replayed {0} requests in {1:.3f}s, recorded in {2:.3f}s".format(
+        replayer.requests, replayer.elapsed, trace.duration))
+    print("Responses: {0} recorded, {1} diverged, {2} missing, {3} unexpected".format(
+        len(trace.responses), len(diverged) - missing, missing, unexpected))
+    for line in diverged[:MAX_REPORTED]:
+        print("  " + line)
+    if len(diverged) > MAX_REPORTED:
+        print("  ... {0} more".format(len(diverged) - MAX_REPORTED))
+    print("Other messages: {0} recorded, {1} replayed".format(trace.other, replayer.other))
+
+    print("{0:<8}{1:>8}{2:>14}{3:>14}{4:>12}".format('cmd', 'count', 'recorded p50', 'replayed p50', 'delta ms'))
+    for what in sorted(recorded):
+        rec = recorded[what].percentile(50) / 1000.0
+        rep = replayed[what].percentile(50) / 1000.0
+        print("{0:<8}{1:>8}{2:>14.2f}{3:>14.2f}{4:>+12.2f}".format(what, recorded[what].total, rec, rep, rep - rec))
+
+    return len(diverged) + unexpected + (1 if trace.other != replayer.other else 0)
+
+
+async def replay_main(args, trace, speed):
+    from client import open_channel
+
+    channel = open_channel(args, aio)
+    replayer = Replayer(trace, speed, args.await_timeout)
+    try:
+        await replayer.run(channel)
+    finally:
+        await channel.close()
+    return 1 if report(trace, replayer) else 0
+
+
+# Replay recording given by --replay-trace. Returns process exit code.
+def replay(args):
+    if args.speed == 'max':
+        speed = 0
+    else:
+        try:
+            speed = float(args.speed)
+        except ValueError:
+            speed = -1
+        if speed <= 0:
+            printerr("Invalid --speed", args.speed)
+            return 1
+
+    try:
+        trace = Trace(args.replay_trace)
+    except (IOError, ValueError) as err:
+        printerr("Failed to read '{0}':".format(args.replay_trace), err)
+        return 1
+
+    return asyncio.run(replay_main(args, trace, speed))
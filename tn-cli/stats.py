@@ -0,0 +1,149 @@
+"""Client-side latency statistics.
+
+The time of sending is recorded for every outgoing message id and matched to the {ctrl}
+or {meta} response with the same id. Latencies are kept in per-command log-linear
+(HDR-style) histograms: values are grouped into buckets with a relative error under 1%
+regardless of magnitude, so memory and recording cost do not depend on the number of samples."""
+
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+# Number of bits of precision: 2^7 = 128 sub-buckets per power of two, i.e. relative error < 1%.
+SUB_BUCKET_BITS = 7
+
+# The server does not respond to these messages.
+NO_RESPONSE = ['note']
+
+
+class Histogram:
+    """Log-linear histogram of latencies in microseconds."""
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self.sum = 0
+
+    def record(self, value):
+        value = int(value)
+        # Values below 2^SUB_BUCKET_BITS are exact, larger values lose low bits.
+        shift = max(0, value.bit_length() - SUB_BUCKET_BITS)
+        key = (value >> shift) << shift
+        self.counts[key] = self.counts.get(key, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, pct):
+        """Upper bound of the bucket which contains the given percentile."""
+        if not self.total:
+            return 0
+        target = max(1, int(self.total * pct / 100.0 + 0.5))
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= target:
+                shift = max(0, key.bit_length() - SUB_BUCKET_BITS)
+                return min(key + (1 << shift) - 1, self.max)
+        return self.max
+
+
+class Stats:
+    """Per-command counters and latency histograms."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start = time.time()
+            self.histograms = {}
+            self.sent = {}
+            # Outstanding requests: id -> (command, time sent).
+            self.pending = {}
+
+    def on_send(self, msg):
+        """Record the time when the pb.ClientMsg is sent."""
+        cmd = msg.WhichOneof('Message')
+        with self.lock:
+            self.sent[cmd] = self.sent.get(cmd, 0) + 1
+            if cmd not in NO_RESPONSE:
+                # {note} has no id.
+                self.pending[getattr(msg, cmd).id] = (cmd, time.time())
+
+    def on_response(self, id):
+        with self.lock:
+            sent = self.pending.pop(id, None)
+        if sent:
+            self.record(sent[0], time.time() - sent[1])
+
+    def on_lost(self, id):
+        """The request timed out or failed without a response: it is no longer outstanding."""
+        with self.lock:
+            self.pending.pop(id, None)
+
+    def record(self, cmd, seconds):
+        with self.lock:
+            hist = self.histograms.get(cmd)
+            if hist is None:
+                hist = self.histograms[cmd] = Histogram()
+            hist.record(seconds * 1000000)
+
+    def summary(self):
+        """Returns a dictionary with counts, throughput and latency percentiles in milliseconds."""
+        with self.lock:
+            elapsed = time.time() - self.start
+            result = {'elapsed': round(elapsed, 3), 'commands': {}}
+            # Messages (acc, sub, pub, ...) and file transfers (file, upload).
+            for cmd in sorted(set(self.sent) | set(self.histograms)):
+                hist = self.histograms.get(cmd, Histogram())
+                count = max(self.sent.get(cmd, 0), hist.total)
+                result['commands'][cmd] = {
+                    'count': count,
+                    'rate': round(count / elapsed, 1) if elapsed else 0,
+                    'responses': hist.total,
+                    'p50': hist.percentile(50) / 1000.0,
+                    'p90': hist.percentile(90) / 1000.0,
+                    'p99': hist.percentile(99) / 1000.0,
+                    'max': hist.max / 1000.0,
+                }
+            return result
+
+    def report(self):
+        """Returns the summary formatted as a table."""
+        summary = self.summary()
+        lines = ["{0:<8}{1:>8}{2:>10}{3:>10}{4:>10}{5:>10}{6:>10}".format(
+            'cmd', 'count', 'per sec', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')]
+        for cmd, val in summary['commands'].items():
+            if not val['responses']:
+                lines.append("{0:<8}{1:>8}{2:>10}".format(cmd, val['count'], val['rate']))
+                continue
+            lines.append("{0:<8}{1:>8}{2:>10}{3:>10.2f}{4:>10.2f}{5:>10.2f}{6:>10.2f}".format(
+                cmd, val['count'], val['rate'], val['p50'], val['p90'], val['p99'], val['max']))
+        lines.append("Elapsed {0:.3f}s".format(summary['elapsed']))
+        return "\n".join(lines)
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+# Statistics of the current process.
+Collector = Stats()
+
+
+# Call func and record the time it took under the name cmd.
+def timed(cmd, func):
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            Collector.record(cmd, time.time() - start)
+    return wrapper
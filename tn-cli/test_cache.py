@@ -0,0 +1,71 @@
+"""Tests of cache.py: size-bounded LRU cache of files."""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cache import DiskCache
+
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = DiskCache(os.path.join(self.dir, 'cache'), 250)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def put(self, key, size):
+        src = os.path.join(self.dir, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'x' * size)
+        self.assertTrue(self.cache.put(key, src, {'size': size}))
+        # Entries are ordered by the time they were used.
+        time.sleep(0.01)
+
+    def test_get(self):
+        self.put('a', 10)
+        path, info = self.cache.get('a')
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 10)
+        self.assertEqual(info, {'size': 10})
+        self.assertEqual(self.cache.get('b'), (None, None))
+
+    def test_evict_least_recently_used(self):
+        self.put('a', 100)
+        self.put('b', 100)
+        self.cache.hit('a')
+        time.sleep(0.01)
+        self.put('c', 100)
+        self.assertIsNotNone(self.cache.get('a')[0])
+        self.assertIsNone(self.cache.get('b')[0])
+        self.assertIsNotNone(self.cache.get('c')[0])
+        self.assertEqual(self.cache.size, 200)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_replace(self):
+        self.put('a', 100)
+        self.put('a', 50)
+        self.assertEqual(self.cache.size, 50)
+
+    def test_too_big(self):
+        src = os.path.join(self.dir, 'src')
+        with open(src, 'wb') as f:
+            f.write(b'x' * 251)
+        self.assertFalse(self.cache.put('a', src, {}))
+        self.assertEqual(self.cache.size, 0)
+
+    def test_index_is_reloaded(self):
+        self.put('a', 100)
+        self.put('b', 100)
+        os.remove(self.cache.get('b')[0])
+        cache = DiskCache(self.cache.directory, 250)
+        self.assertEqual(sorted(cache.entries), ['a'])
+        self.assertEqual(cache.size, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+"""Tests of downloader.py: resuming an interrupted download from the .part file."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from downloader import Download
+
+URI = '/v0/file/s/abc.bin'
+CONTENT = bytes(bytearray(range(256))) * 40
+
+
+class DownloadResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.dir = tempfile.mkdtemp()
+        os.chdir(self.dir)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def interrupt(self, offset, uri=URI):
+        with open('abc.bin.part', 'wb') as f:
+            f.write(CONTENT[:offset])
+        with open('abc.bin.part.json', 'w') as f:
+            json.dump({'uri': uri, 'name': 'abc.bin', 'size': len(CONTENT), 'offset': offset}, f)
+
+    def test_resume(self):
+        self.interrupt(1000)
+        download = Download(1, URI, None)
+        self.assertEqual((download.offset, download.size), (1000, len(CONTENT)))
+
+        # The stream starts over from the beginning: received bytes are skipped.
+        download.open()
+        download.write(CONTENT[:500], 0)
+        self.assertEqual(download.offset, 1000)
+        download.write(CONTENT[500:3000], 500)
+        download.write(CONTENT[3000:], 3000)
+        self.assertTrue(download.complete())
+        download.finish()
+
+        with open('abc.bin', 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(sorted(os.listdir('.')), ['abc.bin'])
+
+    def test_abort_saves_offset(self):
+        download = Download(1, URI, None)
+        download.size = len(CONTENT)
+        download.open()
+        download.write(CONTENT[:2000], 0)
+        download.abort()
+
+        resumed = Download(2, URI, None)
+        self.assertEqual(resumed.offset, 2000)
+
+    def test_other_uri_starts_over(self):
+        self.interrupt(1000, uri='/v0/file/s/other.bin')
+        self.assertEqual(Download(1, URI, None).offset, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""Tests of exporter.py: paging through the history of a topic."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from tinode_grpc import pb
+
+import tn_globals
+from exporter import Export
+
+TOPIC = 'grpAbCdEf'
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'export.jsonl')
+        self.id = 0
+
+    def tearDown(self):
+        tn_globals.DataSinks.clear()
+        shutil.rmtree(self.dir)
+
+    def export(self, page, window, since=1, before=None):
+        return Export(TOPIC, self.filename, 'jsonl', page, window, since, before, None)
+
+    def send(self, query, code=200):
+        """Send the query and receive the response to it."""
+        self.id += 1
+        query.build(self.id, None)
+        query.respond(code, 'ok' if code < 400 else 'error')
+
+    def describe(self, export, seq):
+        _, items = export.build(0, None)
+        desc = items[0]
+        self.assertEqual(desc.msg.get.query.what, 'desc')
+        self.assertFalse(export.ready())
+        self.send(desc)
+        export.on_desc(pb.ServerMeta(topic=TOPIC, desc=pb.TopicDesc(seq_id=seq)))
+
+    def pages(self, export):
+        """Request pages until the export is done. Returns (since_id, before_id) of every page."""
+        result = []
+        while True:
+            self.assertTrue(export.ready())
+            _, items = export.build(0, None)
+            if items is None:
+                return result
+            query = items[0]
+            opts = query.msg.get.query.data
+            result.append((opts.since_id, opts.before_id))
+            for seq in range(opts.since_id, opts.before_id):
+                tn_globals.DataSinks[TOPIC](pb.ServerData(topic=TOPIC, seq_id=seq, content=b'"hi"'))
+            self.send(query)
+
+    def lines(self):
+        with open(self.filename, 'rb') as f:
+            return [json.loads(line) for line in f]
+
+    def test_pages(self):
+        export = self.export(100, 2)
+        self.describe(export, 250)
+        self.assertEqual(self.pages(export), [(151, 251), (51, 151), (1, 51)])
+        self.assertEqual(sorted(line['seq'] for line in self.lines()), list(range(1, 251)))
+        self.assertNotIn(TOPIC, tn_globals.DataSinks)
+
+    def test_window(self):
+        export = self.export(10, 2)
+        self.describe(export, 100)
+        first, _ = [export.build(0, None)[1][0] for _ in range(2)]
+        self.assertFalse(export.ready())
+        self.send(first)
+        self.assertTrue(export.ready())
+
+    def test_since_and_before(self):
+        export = self.export(5, 4, since=3, before=13)
+        self.assertEqual(self.pages(export), [(8, 13), (3, 8)])
+        self.assertEqual(len(self.lines()), 10)
+
+    def test_empty_topic(self):
+        export = self.export(100, 2)
+        self.describe(export, 0)
+        self.assertEqual(self.pages(export), [])
+        self.assertEqual(self.lines(), [])
+
+    def test_messages_outside_of_export_are_skipped(self):
+        export = self.export(100, 2, before=11)
+        self.assertTrue(export.write(pb.ServerData(topic=TOPIC, seq_id=10, content=b'1')))
+        self.assertFalse(export.write(pb.ServerData(topic=TOPIC, seq_id=11, content=b'1')))
+
+    def test_failed_page_stops_export(self):
+        export = self.export(10, 1)
+        self.describe(export, 100)
+        self.send(export.build(0, None)[1][0], 403)
+        self.assertTrue(export.ready())
+        self.assertEqual(export.build(0, None), (None, None))
+        self.assertIn('403', export.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
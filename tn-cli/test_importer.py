@@ -0,0 +1,59 @@
+"""Tests of importer.py: the checkpoint of imported rows."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from importer import Checkpoint
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'rows.jsonl.checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_record_out_of_order(self):
+        checkpoint = Checkpoint(self.filename)
+        for row in [3, 1, 5]:
+            checkpoint.record(row, 200)
+        self.assertEqual((checkpoint.settled, checkpoint.above), (1, set([3, 5])))
+        checkpoint.record(2, 200)
+        self.assertEqual((checkpoint.settled, checkpoint.above), (3, set([5])))
+        self.assertTrue(checkpoint.done(2))
+        self.assertTrue(checkpoint.done(5))
+        self.assertFalse(checkpoint.done(4))
+        checkpoint.close()
+
+    def test_failed_rows_are_not_done(self):
+        checkpoint = Checkpoint(self.filename)
+        checkpoint.record(1, 200)
+        checkpoint.record(2, 429)
+        self.assertEqual(checkpoint.settled, 2)
+        self.assertFalse(checkpoint.done(2))
+        # Succeeded when published again.
+        checkpoint.record(2, 202)
+        self.assertTrue(checkpoint.done(2))
+        checkpoint.close()
+
+    def test_reload(self):
+        checkpoint = Checkpoint(self.filename)
+        checkpoint.write(1, 200, 'ok')
+        checkpoint.write(2, 500, 'internal error')
+        checkpoint.write(4, 200, 'ok')
+        checkpoint.close()
+        # Line cut short by a crash.
+        with open(self.filename, 'a') as f:
+            f.write('{"row": 3, "co')
+
+        checkpoint = Checkpoint(self.filename)
+        self.assertEqual([checkpoint.done(row) for row in range(1, 6)], [True, False, False, True, False])
+        checkpoint.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
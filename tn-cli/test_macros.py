@@ -0,0 +1,61 @@
+"""Tests of macros.py: the bulk macro runner."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from macros import BulkRun, Macros
+
+
+class BulkRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'users.jsonl')
+        self.checkpoint = self.filename + '.checkpoint'
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_rows(self, lines):
+        """Run userdel for the lines of the file, responding 200 to every step. Returns the checkpoint."""
+        with open(self.filename, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        bulk = BulkRun(Macros['userdel'], self.filename, 2, self.checkpoint, None)
+        id = 0
+        while True:
+            self.assertTrue(bulk.ready())
+            _, items = bulk.build(id, None)
+            if items is None:
+                break
+            for step in items[:-1]:
+                id += 1
+                step.build(id, None)
+                step.respond(200, 'ok')
+        with open(self.checkpoint, 'r') as f:
+            return bulk, {result['row']: result for result in map(json.loads, f)}
+
+    def test_bad_rows_do_not_stop_the_run(self):
+        bulk, results = self.run_rows([
+            '{"userid": "usrA"}',
+            '{"userid": ',
+            '["usrB"]',
+            '{}',
+            '{"userid": "usrC", "hard": true}'])
+        self.assertEqual(sorted(results), [1, 2, 3, 4, 5])
+        self.assertEqual([results[row]['code'] for row in range(1, 6)], [200, 400, 400, 400, 200])
+        self.assertIn('invalid row', results[2]['text'])
+        self.assertEqual(results[3]['text'], 'invalid row: not a JSON object')
+        self.assertEqual(results[5]['key'], 'usrC')
+        self.assertEqual((bulk.succeeded, bulk.failed), (2, 3))
+
+    def test_resume_skips_rows_done(self):
+        self.run_rows(['{"userid": "usrA"}', '{"userid": '])
+        bulk, _ = self.run_rows(['{"userid": "usrA"}', '{"userid": "usrB"}'])
+        self.assertEqual((bulk.skipped, bulk.succeeded), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
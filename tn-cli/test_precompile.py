@@ -0,0 +1,74 @@
+"""Tests of precompile.py: compiling scripts to frames and reading them back."""
+
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+import tn_globals
+from precompile import Frame, compile_script, read_frames
+
+
+class PrecompileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        tn_globals.Variables.clear()
+        shutil.rmtree(self.dir)
+
+    def compile(self, text, errors=0):
+        """Compile the script and return its frames."""
+        src = os.path.join(self.dir, 'script.txt')
+        out = os.path.join(self.dir, 'script.pbs')
+        with open(src, 'w') as f:
+            f.write(text)
+        self.assertEqual(compile_script(src, out, argparse.Namespace()), 1 if errors else 0)
+        return list(read_frames(out))
+
+    def test_round_trip(self):
+        frames = self.compile(
+            "sub grpAbCdEf\n"
+            "# comment\n"
+            ".must pub grpAbCdEf 'hello'\n"
+            "exit\n"
+            "pub grpAbCdEf 'after exit'\n")
+        self.assertEqual(len(frames), 3)
+
+        sub, pub, end = frames
+        self.assertIsInstance(sub, Frame)
+        self.assertEqual(sub.cmd, 'sub')
+        msg, cmd = sub.build(7, None)
+        self.assertEqual((msg.sub.id, msg.sub.topic), ('7', 'grpAbCdEf'))
+        self.assertFalse(cmd.synchronous)
+
+        msg, cmd = pub.build(8, None)
+        self.assertEqual(msg.pub.topic, 'grpAbCdEf')
+        self.assertTrue(cmd.synchronous and cmd.failOnError)
+        self.assertEqual(end, 'exit')
+
+    def test_placeholders(self):
+        frame = self.compile("sub $topic\n")[0]
+        self.assertEqual(frame.refs, ['$topic'])
+        self.assertEqual(frame.build(1, None), (None, None))
+        tn_globals.Variables['$topic'] = 'grpXyZ'
+        self.assertEqual(frame.build(1, None)[0].sub.topic, 'grpXyZ')
+
+    def test_local_directive_is_a_line(self):
+        self.assertEqual(self.compile(".log $topic\n"), ['.log $topic'])
+
+    def test_invalid_command(self):
+        self.assertEqual(self.compile("sub grpAbCdEf\nnosuchcommand\n", errors=1)[0].cmd, 'sub')
+
+    def test_not_precompiled(self):
+        path = os.path.join(self.dir, 'script.txt')
+        with open(path, 'w') as f:
+            f.write("sub grpAbCdEf\n")
+        with self.assertRaises(ValueError):
+            list(read_frames(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+"""Tests of stats.py: latency histograms and outstanding requests."""
+
+import unittest
+
+from tinode_grpc import pb
+
+import client
+import commands
+import tn_globals
+from stats import Collector, Histogram, Stats
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_empty(self):
+        self.assertEqual(Histogram().percentile(50), 0)
+
+    def test_small_values_are_exact(self):
+        hist = Histogram()
+        for value in range(1, 101):
+            hist.record(value)
+        self.assertEqual(hist.percentile(50), 50)
+        self.assertEqual(hist.percentile(90), 90)
+        self.assertEqual(hist.percentile(99), 99)
+        self.assertEqual(hist.percentile(100), 100)
+        self.assertEqual((hist.min, hist.max, hist.total), (1, 100, 100))
+
+    def test_large_values_within_one_percent(self):
+        hist = Histogram()
+        for value in range(1000, 1000001, 1000):
+            hist.record(value)
+        for pct in [50, 90, 99]:
+            expected = 1000000 * pct / 100.0
+            self.assertAlmostEqual(hist.percentile(pct), expected, delta=expected * 0.01)
+        self.assertEqual(hist.percentile(100), 1000000)
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_response_is_recorded(self):
+        stats = Stats()
+        stats.on_send(pb.ClientMsg(sub=pb.ClientSub(id='101', topic='grpAbCdEf')))
+        self.assertIn('101', stats.pending)
+        stats.on_response('101')
+        self.assertEqual(stats.pending, {})
+        self.assertEqual(stats.summary()['commands']['sub']['responses'], 1)
+
+    def test_note_is_not_pending(self):
+        stats = Stats()
+        stats.on_send(pb.ClientMsg(note=pb.ClientNote(topic='grpAbCdEf', what=pb.READ, seq_id=5)))
+        self.assertEqual(stats.pending, {})
+        self.assertEqual(stats.summary()['commands']['note']['count'], 1)
+
+    def test_lost_is_not_pending(self):
+        stats = Stats()
+        stats.on_send(pb.ClientMsg(pub=pb.ClientPub(id='102', topic='grpAbCdEf')))
+        stats.on_lost('102')
+        self.assertEqual(stats.pending, {})
+        self.assertEqual(stats.summary()['commands']['pub']['responses'], 0)
+
+
+class SerializedMessageTest(unittest.TestCase):
+
+    def test_note(self):
+        stats = Stats()
+        msg, _ = commands.serialize_cmd('note grpAbCdEf read --seq 5', '103', None)
+        stats.on_send(msg)
+        self.assertEqual(stats.pending, {})
+        self.assertEqual(stats.sent, {'note': 1})
+
+    def test_sub(self):
+        stats = Stats()
+        msg, _ = commands.serialize_cmd('sub grpAbCdEf', '104', None)
+        stats.on_send(msg)
+        self.assertIn('104', stats.pending)
+
+
+class MessageSentTest(unittest.TestCase):
+
+    def setUp(self):
+        Collector.reset()
+        tn_globals.Attaching.clear()
+
+    def tearDown(self):
+        Collector.reset()
+        tn_globals.Attaching.clear()
+
+    def test_note(self):
+        msg, _ = commands.serialize_cmd('note grpAbCdEf read --seq 5', '103', None)
+        client.message_sent(msg)
+        self.assertEqual(Collector.pending, {})
+        self.assertEqual(Collector.sent, {'note': 1})
+
+    def test_sub(self):
+        msg, _ = commands.serialize_cmd('sub grpAbCdEf', '104', None)
+        client.message_sent(msg)
+        self.assertIn('104', Collector.pending)
+        self.assertEqual(tn_globals.Attaching['104'], ('sub', 'grpAbCdEf'))
+
+
+if __name__ == '__main__':
+    unittest.main()
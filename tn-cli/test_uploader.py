@@ -0,0 +1,80 @@
+"""Tests of uploader.py: the index of uploaded content and its expiry."""
+
+import calendar
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from uploader import EXPIRES_MARGIN, UploadIndex, parse_expires
+
+
+class ParseExpiresTest(unittest.TestCase):
+
+    def test_parse(self):
+        expected = calendar.timegm((2024, 5, 1, 10, 20, 30, 0, 0, 0))
+        self.assertEqual(parse_expires({'expires': '2024-05-01T10:20:30.123Z'}), expected)
+        self.assertEqual(parse_expires({'expires': '2024-05-01T10:20:30Z'}), expected)
+
+    def test_missing_or_invalid(self):
+        self.assertIsNone(parse_expires(None))
+        self.assertIsNone(parse_expires({}))
+        self.assertIsNone(parse_expires({'expires': 'tomorrow'}))
+
+
+class UploadIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, '.tn-uploads.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_deadline(self):
+        index = UploadIndex(self.filename, 'localhost')
+        index.add('aaa', '/v0/file/s/a', time.time() + EXPIRES_MARGIN + 60)
+        index.add('bbb', '/v0/file/s/b', time.time() + EXPIRES_MARGIN - 1)
+        index.add('ccc', '/v0/file/s/c')
+        self.assertEqual(index.uri('aaa'), '/v0/file/s/a')
+        self.assertIsNone(index.uri('bbb'))
+        # The server did not report the deadline.
+        self.assertEqual(index.uri('ccc'), '/v0/file/s/c')
+        self.assertIsNone(index.uri('ddd'))
+
+    def test_max_age_overrides_deadline(self):
+        index = UploadIndex(self.filename, 'localhost', max_age=10)
+        index.add('aaa', '/v0/file/s/a', time.time() - 1000)
+        self.assertEqual(index.uri('aaa'), '/v0/file/s/a')
+        index.uris['aaa'][1] -= 11
+        self.assertIsNone(index.uri('aaa'))
+
+        index.max_age = 0
+        self.assertEqual(index.uri('aaa'), '/v0/file/s/a')
+
+    def test_reload(self):
+        index = UploadIndex(self.filename, 'localhost')
+        index.add('aaa', '/v0/file/s/a', time.time() + 3600)
+        self.assertEqual(UploadIndex(self.filename, 'localhost').uri('aaa'), '/v0/file/s/a')
+        # URIs are valid only on the server they were uploaded to.
+        self.assertIsNone(UploadIndex(self.filename, 'example.com').uri('aaa'))
+
+    def test_old_entries_are_ignored(self):
+        index = UploadIndex(self.filename, 'localhost')
+        index.uris['aaa'] = ['/v0/file/s/a', time.time()]
+        self.assertIsNone(index.uri('aaa'))
+
+    def test_digest_of_unchanged_file_is_remembered(self):
+        path = os.path.join(self.dir, 'a.txt')
+        with open(path, 'w') as f:
+            f.write('hello')
+        index = UploadIndex(self.filename, 'localhost')
+        digest = index.digest(path)
+        self.assertEqual(index.files[path][2], digest)
+        index.files[path][2] = 'remembered'
+        self.assertEqual(index.digest(path), 'remembered')
+
+
+if __name__ == '__main__':
+    unittest.main()
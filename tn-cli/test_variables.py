@@ -0,0 +1,64 @@
+"""Tests of the variable store: eviction of least recently used values and projections."""
+
+import unittest
+
+from tinode_grpc import pb
+
+import commands
+from tn_globals import VariableStore
+
+
+class VariableStoreTest(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        store = VariableStore(25)
+        store['$a'] = 'x' * 10
+        store['$b'] = 'y' * 10
+        self.assertEqual(store['$a'], 'x' * 10)
+        store['$c'] = 'z' * 10
+        self.assertIn('$a', store)
+        self.assertNotIn('$b', store)
+        self.assertIn('$c', store)
+        self.assertEqual((store.size, store.evicted), (20, 1))
+
+    def test_replace(self):
+        store = VariableStore(100)
+        store['$a'] = 'x' * 10
+        store['$a'] = 'x' * 5
+        self.assertEqual((len(store), store.size), (1, 5))
+
+    def test_keep_last_value_over_limit(self):
+        store = VariableStore(10)
+        store['$a'] = 'x' * 5
+        store['$b'] = 'y' * 50
+        self.assertEqual([name for name, _, _ in store.items()], ['$b'])
+
+    def test_message_size(self):
+        store = VariableStore(1000)
+        msg = pb.ServerCtrl(id='1', code=200, text='ok')
+        store['$ctrl'] = msg
+        self.assertEqual(store.size, msg.ByteSize())
+
+
+class ProjectionTest(unittest.TestCase):
+
+    def test_projection(self):
+        meta = pb.ServerMeta(id='1', topic='me', sub=[
+            pb.TopicSub(topic='grpA', updated_at=1), pb.TopicSub(topic='grpB', updated_at=2)])
+        variables = VariableStore(1000)
+        commands.setVar('$meta', meta, 'sub[*].topic', variables)
+        value = variables['$meta']
+        self.assertEqual([sub.topic for sub in value.sub], ['grpA', 'grpB'])
+        self.assertEqual(value.sub[0].updated_at, 0)
+        self.assertEqual(value.topic, '')
+        self.assertEqual(commands.getVar('$meta.sub[1].topic', variables), 'grpB')
+
+    def test_invalid_projection_stores_whole_value(self):
+        ctrl = pb.ServerCtrl(id='1', code=200, text='ok')
+        variables = VariableStore(1000)
+        commands.setVar('$ctrl', ctrl, 'nosuchfield', variables)
+        self.assertEqual(variables['$ctrl'], ctrl)
+
+
+if __name__ == '__main__':
+    unittest.main()
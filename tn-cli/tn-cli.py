@@ -10,21 +10,10 @@ import os
 import platform
 import sys
 
-try:
-    from importlib.metadata import version
-except ImportError:
-    # Fallback for Python < 3.8
-    from importlib_metadata import version
-
+# Modules which load gRPC, protobuf descriptors, PIL or requests are imported after
+# the command line is parsed: --version and --help do not need them.
 import tn_globals
-from tn_globals import printout
-from client import run, read_cookie
-from commands import set_macros_module
-
-APP_NAME = "tn-cli"
-APP_VERSION = "3.1.0"  # format: 1.9.0b1
-LIB_VERSION = version("tinode_grpc")
-GRPC_VERSION = version("grpcio")
+from tn_globals import printout, printerr
 
 # This is needed for gRPC SSL to work correctly.
 os.environ["GRPC_SSL_CIPHER_SUITES"] = "HIGH+ECDSA"
@@ -45,7 +34,8 @@ sys.excepthook = exception_hook
 
 if __name__ == '__main__':
     """Parse command-line arguments. Extract host name and authentication scheme, if one is provided"""
-    version_str = APP_VERSION + "/" + LIB_VERSION + "; gRPC/" + GRPC_VERSION + "; Python " + platform.python_version()
+    lib_version, grpc_version = tn_globals.lib_versions()
+    version_str = tn_globals.APP_VERSION + "/" + lib_version + "; gRPC/" + grpc_version + "; Python " + platform.python_version()
     purpose = "Tinode command line client. Version " + version_str + "."
 
     parser = argparse.ArgumentParser(description=purpose)
@@ -63,16 +53,67 @@ if __name__ == '__main__':
     parser.add_argument('--version', action='store_true', help='print version')
     parser.add_argument('--verbose', action='store_true', help='log full JSON representation of all messages')
     parser.add_argument('--background', action='store_const', const=True, help='start interactive sessionin background (non-intractive is always in background)')
+    parser.add_argument('--sync-window', type=int, default=1, help='maximum number of outstanding .await/.must requests, default 1')
+    parser.add_argument('--compile', help='precompile script file into protobuf frames and exit; use with -o')
+    parser.add_argument('-o', '--output', help='name of the file with precompiled frames')
+    parser.add_argument('--replay', help='execute precompiled script instead of reading commands from stdin')
+    parser.add_argument('--asyncio', action='store_true', help='use asyncio engine instead of threads (Python 3.7+)')
+    parser.add_argument('--reconnect', type=int, default=5, help='number of attempts to restore the connection when the stream fails, 0 to exit instead; default 5')
+    parser.add_argument('--await-timeout', type=float, default=tn_globals.AWAIT_TIMEOUT, help='seconds to wait for response to .await/.must request')
+    parser.add_argument('--stats-json', help='write latency and throughput summary to this JSON file on exit')
+    parser.add_argument('--upload-workers', type=int, default=4, help='maximum number of files uploaded over HTTP at the same time, default 4')
+    parser.add_argument('--cache-dir', help='keep downloaded files in this directory and download them again only if changed')
+    parser.add_argument('--avatar-dim', type=int, default=tn_globals.AvatarDim, help='scale avatars down to this size in pixels and re-encode them, 0 to send as is; default 384')
+    parser.add_argument('--vars-size', type=int, default=tn_globals.MAX_VARIABLES_SIZE // 1048576, help='maximum total size of values of variables in MB, least recently used are dropped; default 64')
+    parser.add_argument('--cache-size', type=int, default=512, help='maximum size of the download cache in MB, default 512')
+    parser.add_argument('--record', help='record all messages sent and received to this file')
+    parser.add_argument('--replay-trace', help='send client messages from a recording to the server and compare responses')
+    parser.add_argument('--speed', default='1', help='speed of --replay-trace: 1 for real time, N times faster, or max')
+    parser.add_argument('--load-sessions', type=int, help='run load test: execute --load-script in this many concurrent sessions')
+    parser.add_argument('--load-script', help='script (plain or precompiled) to execute in each load test session')
+    parser.add_argument('--accounts', help='CSV file with username,password of accounts for load test sessions')
+    parser.add_argument('--load-channels', type=int, default=4, help='number of gRPC channels to share between load test sessions, default 4')
+    parser.add_argument('--load-ramp', type=float, default=0, help='seconds to spread the start of load test sessions over')
+    parser.add_argument('--daemon', action='store_true', help='keep one logged-in session and execute scripts submitted over --socket')
+    parser.add_argument('--socket', help='unix socket of the daemon; without --daemon, send the script from stdin to the daemon')
 
     args = parser.parse_args()
 
     if args.version:
-        printout(version_str)
+        # Printed in scripts too: the version was requested explicitly.
+        print(version_str)
         exit()
 
+    if args.socket and not args.daemon:
+        # The script is executed by the daemon: no need to load gRPC.
+        from daemon_client import submit
+        sys.exit(submit(args))
+
+    from client import run, read_cookie
+    from commands import set_macros_module
+
     if args.verbose:
         tn_globals.Verbose = True
 
+    if args.compile or args.replay or args.load_sessions:
+        # Precompiled scripts are never interactive.
+        tn_globals.IsInteractive = False
+
+    if args.sync_window < 1:
+        printerr("Invalid --sync-window", args.sync_window)
+        exit(1)
+    tn_globals.SyncWindow = args.sync_window
+    tn_globals.AvatarDim = max(0, args.avatar_dim)
+    tn_globals.Variables.max_size = args.vars_size * 1048576
+
+    if args.cache_dir:
+        from cache import DiskCache
+        try:
+            tn_globals.FileCache = DiskCache(args.cache_dir, args.cache_size * 1048576)
+        except OSError as err:
+            printerr("Failed to open cache '{0}':".format(args.cache_dir), err)
+            exit(1)
+
     printout(purpose)
     printout("Secure server" if args.ssl else "Server", "at '"+args.host+"'",
         "SNI="+args.ssl_host if args.ssl_host else "")
@@ -108,9 +149,32 @@ if __name__ == '__main__':
         macros = importlib.import_module('macros', args.load_macros) if args.load_macros else None
         set_macros_module(macros)
 
+    if args.compile:
+        if not args.output:
+            printerr("Output file must be specified with -o")
+            exit(1)
+        from precompile import compile_script
+        sys.exit(compile_script(args.compile, args.output, args))
+
+    if args.replay_trace:
+        from recorder import replay
+        sys.exit(replay(args))
+
+    if args.load_sessions:
+        from loadgen import run as run_load
+        sys.exit(run_load(args))
+
     # Check if background session is specified explicitly. If not set it to
     # True for non-interactive sessions.
     if args.background is None and not tn_globals.IsInteractive:
         args.background = True
 
+    if args.daemon:
+        from daemon import serve
+        sys.exit(serve(args, schema, secret))
+
+    if args.asyncio:
+        from aio_client import run as run_async
+        sys.exit(run_async(args, schema, secret))
+
     sys.exit(run(args, schema, secret))
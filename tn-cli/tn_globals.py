@@ -4,8 +4,8 @@ from __future__ import print_function
 
 import json
 import sys
-from collections import deque
-from google.protobuf.json_format import MessageToDict
+import threading
+from collections import deque, OrderedDict
 try:
     import Queue as queue
 except ImportError:
@@ -15,21 +15,60 @@ if sys.version_info[0] >= 3:
     # for compatibility with python2
     unicode = str
 
+APP_NAME = "tn-cli"
+APP_VERSION = "3.1.0"  # format: 1.9.0b1
+
+# Versions of tinode_grpc and grpcio, resolved once by lib_versions().
+LibVersions = None
+
+# 5 seconds timeout for .await/.must commands.
+AWAIT_TIMEOUT = 5
+
 # Dictionary wich contains lambdas to be executed when server {ctrl} response is received.
 OnCompletion = {}
 
-# Outstanding request for a synchronous message.
-WaitingFor = None
+# Outstanding synchronous (.await/.must) requests keyed by message id.
+InFlight = {}
+
+# Topics the session is attached to. Subscribed again after reconnect.
+AttachedTopics = set()
+
+# Outstanding {sub} and {leave} requests: id -> (what, topic).
+Attaching = {}
+
+# Consumers of {data} messages of topics being exported: topic -> function(data) which returns
+# False if the message was not consumed.
+DataSinks = {}
+
+# Maximum number of outstanding synchronous requests. The default 1 means every
+# .await/.must blocks the input until the response is received.
+SyncWindow = 1
+
+# Avatars are scaled down to fit into AvatarDim x AvatarDim pixels; 0 to send them as is.
+AvatarDim = 384
+
+# Input is paused by .sleep until this time (seconds since the epoch).
+PausedUntil = 0
 
 # Last obtained authentication token
 AuthToken = ''
 
+# Server parameters received in response to {hi}, e.g. maxMessageSize
+ServerParams = {}
+
 # IO queues and a thread for asynchronous input/output
 #InputQueue = queue.Queue()
 InputQueue = deque()
 OutputQueue = queue.Queue()
 InputThread = None
 
+# Condition variable which wakes up the message generator when there is new input,
+# new output, or a response to an outstanding synchronous request.
+Wakeup = threading.Condition()
+
+# Optional callback invoked on every wakeup(). Used by the asyncio engine to wake up its event loop.
+OnWakeup = None
+
 # Detect if the tn-cli is running interactively or being piped.
 IsInteractive = sys.stdin.isatty()
 Prompt = None
@@ -38,15 +77,88 @@ Prompt = None
 DefaultUser = None
 DefaultTopic = None
 
+# Default limit on the total size of values of variables.
+MAX_VARIABLES_SIZE = 64 * 1024 * 1024
+
+
+class VariableStore:
+    """Values of variables. When the total size of values exceeds max_size bytes, the least
+    recently used variables are dropped. The size of a protobuf message is its serialized size."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.evicted = 0
+
+    def __contains__(self, name):
+        return name in self.values
+
+    def __getitem__(self, name):
+        with self.lock:
+            value = self.values[name]
+            self.values.move_to_end(name)
+            return value
+
+    def __setitem__(self, name, value):
+        size = value.ByteSize() if hasattr(value, 'ByteSize') else len(str(value))
+        with self.lock:
+            self.pop(name)
+            self.values[name] = value
+            self.sizes[name] = size
+            self.size += size
+            # The variable just assigned is kept even if it alone is over the limit.
+            while self.size > self.max_size and len(self.values) > 1:
+                self.pop(next(iter(self.values)))
+                self.evicted += 1
+
+    def pop(self, name):
+        if name in self.values:
+            del self.values[name]
+            self.size -= self.sizes.pop(name)
+
+    def get(self, name, default=None):
+        return self[name] if name in self.values else default
+
+    def items(self):
+        """List of (name, value, size) from the least to the most recently used."""
+        with self.lock:
+            return [(name, value, self.sizes[name]) for name, value in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+            self.sizes.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.values)
+
+
 # Variables: results of command execution
-Variables = {}
+Variables = VariableStore(MAX_VARIABLES_SIZE)
 
 # Connection to the server
 Connection = None
 
+# Recorder of MessageLoop traffic (--record)
+Recorder = None
+
+# Cache of downloaded files (--cache-dir)
+FileCache = None
+
 # Flag to enable extended logging. Useful for debugging.
 Verbose = False
 
+# Wake up the message generator: the state of input, output or InFlight has changed.
+def wakeup():
+    with Wakeup:
+        Wakeup.notify_all()
+    if OnWakeup:
+        OnWakeup()
+
 # Print prompts in interactive mode only.
 def printout(*args):
     if IsInteractive:
@@ -72,6 +184,7 @@ def stdout(*args):
     text = text.strip(" ")
     if text:
         OutputQueue.put(text)
+        wakeup()
 
 # Stdoutln asynchronously writes to sys.stdout and adds a new line to input.
 def stdoutln(*args):
@@ -91,10 +204,24 @@ def clip_long_string(obj):
     else:
         return obj
 
+# Returns versions of tinode_grpc and grpcio. Package metadata is read on the first call only.
+def lib_versions():
+    global LibVersions
+    if LibVersions is None:
+        try:
+            from importlib.metadata import version
+        except ImportError:
+            # Fallback for Python < 3.8
+            from importlib_metadata import version
+        LibVersions = (version("tinode_grpc"), version("grpcio"))
+    return LibVersions
+
+
 # Convert protobuff message to json. Shorten very long strings.
 def to_json(msg):
     if not msg:
         return 'null'
+    from google.protobuf.json_format import MessageToDict
     try:
         return json.dumps(clip_long_string(MessageToDict(msg)))
     except Exception as err:
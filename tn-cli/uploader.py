@@ -0,0 +1,490 @@
+"""Out of band file uploads.
+
+HTTP(S): files are queued and uploaded by a fixed number of worker threads which share one
+requests.Session, so connections to the web server are kept alive and reused. Request
+bodies are streamed from disk instead of being read into memory.
+
+gRPC (LargeFileReceive): the file is memory-mapped and FileUpReq messages are serialized
+directly from memoryview slices of the mapping, so file content is copied once, into the
+serialized message. The size of chunks adapts to the observed throughput and never
+exceeds the maximum message size accepted by the server.
+
+Directories are uploaded with content-addressed deduplication: every file is hashed and
+files with content uploaded earlier are skipped. Hashes and URIs of uploaded content are
+kept in an index file, so re-running an import sends only new or changed files."""
+
+from __future__ import print_function
+
+import calendar
+import hashlib
+import json
+import mimetypes
+import mmap
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+from tinode_grpc import pb
+
+import tn_globals
+from tn_globals import stdoutln
+from stats import Collector
+from utils import encode_varint, file_digest
+
+# Size of blocks read from the file being uploaded.
+BLOCK_SIZE = 256*1024
+
+# Smallest and initial size of gRPC upload chunks.
+MIN_CHUNK_SIZE = 16*1024
+INITIAL_CHUNK_SIZE = 64*1024
+
+# Chunk size is adjusted to make sending one chunk take about this many seconds.
+CHUNK_TARGET_TIME = 0.1
+
+# Limit on the size of a gRPC message if the server did not report one in {hi}.
+DEFAULT_MAX_MESSAGE_SIZE = 1 << 19
+
+# Space reserved in FileUpReq for the field tag and length of the content.
+CHUNK_OVERHEAD = 16
+
+# Seconds between progress reports.
+PROGRESS_INTERVAL = 1.0
+
+# Default name of the index of uploaded content, created in the uploaded directory.
+INDEX_FILE = '.tn-uploads.json'
+
+# Seconds before the deadline reported by the server when an uploaded file is no longer reused:
+# the server deletes uploads which are not attached to a message by the deadline.
+EXPIRES_MARGIN = 60
+
+# Tag of FileUpReq.content: field number and wire type 2 (length-delimited).
+CONTENT_TAG = encode_varint(pb.FileUpReq.DESCRIPTOR.fields_by_name['content'].number << 3 | 2)
+
+
+class MultipartBody:
+    """Read-only file-like multipart/form-data body with an 'id' field and a file.
+    The length is known upfront, so the request is sent with Content-Length."""
+
+    def __init__(self, id, filename):
+        self.boundary = uuid.uuid4().hex
+        name = os.path.basename(filename).replace('"', '')
+        mime = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.head = ("--{0}\r\nContent-Disposition: form-data; name=\"id\"\r\n\r\n{1}\r\n"
+            "--{0}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{2}\"\r\n"
+            "Content-Type: {3}\r\n\r\n").format(self.boundary, id, name, mime).encode('utf-8')
+        self.tail = "\r\n--{0}--\r\n".format(self.boundary).encode('utf-8')
+        self.fd = open(filename, 'rb')
+        self.size = os.fstat(self.fd.fileno()).st_size
+        self.parts = [self.head, self.fd, self.tail]
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=' + self.boundary
+
+    def __len__(self):
+        return len(self.head) + self.size + len(self.tail)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = BLOCK_SIZE
+        while self.parts:
+            part = self.parts[0]
+            if part is self.fd:
+                data = self.fd.read(size)
+                if data:
+                    return data
+            elif part:
+                self.parts[0] = part[size:]
+                return part[:size]
+            self.parts.pop(0)
+        return b''
+
+    def close(self):
+        self.fd.close()
+
+
+class Uploader:
+    """Queue of files and a pool of workers uploading them."""
+
+    def __init__(self, args, workers):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.args = args
+        self.url = ('https' if args.ssl else 'http') + '://' + args.web_host + '/v0/file/u/'
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # Resolve the version once instead of on every upload.
+        self.session.headers.update({'X-Tinode-APIKey': args.api_key,
+            'User-Agent': tn_globals.APP_NAME + " " + tn_globals.APP_VERSION + "/" + tn_globals.lib_versions()[0]})
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # Files queued or being uploaded.
+        self.pending = 0
+        self.batch_start = 0
+        self.batch_files = 0
+        self.batch_bytes = 0
+        for i in range(workers):
+            worker = threading.Thread(target=self.worker, name="Uploader_" + str(i))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, id, filename, done=None):
+        """Queue the file for upload. done(result) is called by the worker with the result of upload()."""
+        with self.lock:
+            if not self.pending:
+                self.batch_start = time.time()
+                self.batch_files = self.batch_bytes = 0
+            self.pending += 1
+        self.queue.put((id, filename, done))
+
+    def worker(self):
+        while True:
+            id, filename, done_cb = self.queue.get()
+            result = self.upload(id, filename)
+            with self.lock:
+                self.pending -= 1
+                if result:
+                    self.batch_files += 1
+                    self.batch_bytes += result[0]
+                done = not self.pending
+            if done and self.batch_files > 1:
+                elapsed = max(time.time() - self.batch_start, 0.001)
+                stdoutln("Uploaded {0} files, {1:.1f} MB in {2:.2f}s, {3:.2f} MB/s".format(self.batch_files,
+                    self.batch_bytes / 1048576., elapsed, self.batch_bytes / elapsed / 1048576))
+            if done_cb:
+                done_cb(result)
+            self.queue.task_done()
+
+    def upload(self, id, filename):
+        """Upload one file. Returns (number of bytes uploaded, URL of the file, deadline to attach it
+        or None) or None on failure."""
+        from client import handle_ctrl
+        from utils import dotdict
+
+        start = time.time()
+        body = None
+        try:
+            body = MultipartBody(id, filename)
+            result = self.session.post(self.url, data=body,
+                headers={'Content-Type': body.content_type, 'X-Tinode-Auth': 'Token ' + tn_globals.AuthToken})
+            elapsed = max(time.time() - start, 0.001)
+            Collector.record('upload', elapsed)
+            ctrl = dotdict(json.loads(result.text)['ctrl'])
+            handle_ctrl(ctrl)
+            if ctrl.code >= 300:
+                return None
+            stdoutln("Uploaded '{0}': {1} bytes in {2:.2f}s, {3:.2f} MB/s".format(filename, body.size,
+                elapsed, body.size / elapsed / 1048576))
+            return body.size, (ctrl.params or {}).get('url'), parse_expires(ctrl.params)
+        except Exception as ex:
+            stdoutln("Failed to upload '{0}'".format(filename), ex)
+            return None
+        finally:
+            if body:
+                body.close()
+
+    def wait(self):
+        """Wait for all queued files to be uploaded."""
+        self.queue.join()
+
+
+class AttachmentPub:
+    """{pub} with an attachment which is too large to be sent in-band. The file is uploaded by
+    the uploader service; the message is ready to be sent when the upload completes."""
+
+    def __init__(self, line, id, cmd, args):
+        self.line = line
+        self.cmd = cmd
+        self.url = None
+        self.uploaded = False
+        # Response to the upload must not be taken for the response to {pub} with the same id.
+        get_uploader(args).submit(str(id) + 'a', cmd.attachment, self.on_upload)
+
+    def __str__(self):
+        return self.line
+
+    def on_upload(self, result):
+        self.url = result[1] if result else None
+        self.uploaded = True
+        tn_globals.wakeup()
+
+    def ready(self):
+        return self.uploaded
+
+    def build(self, id, args):
+        """Returns the {pub} referencing the uploaded file or (None, None) if the upload failed."""
+        from commands import pubMsg
+
+        if not self.url:
+            stdoutln("Error in '{0}': failed to upload the attachment".format(self.line))
+            return None, None
+        self.cmd.uploaded = self.url
+        return pubMsg(id, self.cmd, args), self.cmd
+
+
+class UploadStream:
+    """Iterable of serialized FileUpReq messages: metadata followed by file content."""
+
+    def __init__(self, id, filepath):
+        self.id = id
+        self.filepath = filepath
+        self.name = os.path.basename(filepath)
+        self.size = os.path.getsize(filepath)
+        self.sent = 0
+        self.checksum = hashlib.sha256()
+        limit = tn_globals.ServerParams.get('maxMessageSize') or DEFAULT_MAX_MESSAGE_SIZE
+        self.max_chunk = max(MIN_CHUNK_SIZE, int(limit) - CHUNK_OVERHEAD)
+        self.chunk = min(INITIAL_CHUNK_SIZE, self.max_chunk)
+        self.started = time.time()
+
+    def __iter__(self):
+        mime = mimetypes.guess_type(self.filepath)[0]
+        yield pb.FileUpReq(id=str(self.id), auth=pb.Auth(scheme='token', secret=tn_globals.AuthToken),
+            topic="", meta=pb.FileMeta(name=self.name, mime_type=mime, size=self.size)).SerializeToString()
+        if not self.size:
+            # Empty files cannot be mapped.
+            return
+
+        with open(self.filepath, 'rb') as fd:
+            mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            view = memoryview(mapped)
+            try:
+                reported = last = time.time()
+                while self.sent < self.size:
+                    part = view[self.sent:self.sent + self.chunk]
+                    self.checksum.update(part)
+                    data = b''.join([CONTENT_TAG, encode_varint(len(part)), part])
+                    self.sent += len(part)
+                    part.release()
+                    yield data
+
+                    # The iterator is resumed when the message is handed over to the transport.
+                    now = time.time()
+                    self.adapt(now - last)
+                    last = now
+                    if now - reported >= PROGRESS_INTERVAL:
+                        reported = now
+                        self.progress(now)
+            finally:
+                view.release()
+                mapped.close()
+
+    def adapt(self, elapsed):
+        """Grow the chunk if sending is fast, shrink it if it is slow."""
+        if elapsed < CHUNK_TARGET_TIME / 2:
+            self.chunk = min(self.chunk * 2, self.max_chunk)
+        elif elapsed > CHUNK_TARGET_TIME * 2:
+            self.chunk = max(self.chunk // 2, MIN_CHUNK_SIZE)
+
+    def rate(self, now):
+        return self.sent / max(now - self.started, 0.001) / 1048576
+
+    def progress(self, now):
+        stdoutln("'{0}': {1:.1f} of {2:.1f} MB ({3:.0f}%), {4:.2f} MB/s".format(self.name,
+            self.sent / 1048576., self.size / 1048576., 100. * self.sent / self.size, self.rate(now)))
+
+    def summary(self):
+        now = time.time()
+        return "Sent '{0}': {1} bytes in {2:.2f}s, {3:.2f} MB/s, sha256={4}".format(self.filepath,
+            self.sent, now - self.started, self.rate(now), self.checksum.hexdigest())
+
+
+# Upload file over gRPC. The channel is either grpc or grpc.aio channel; the result must be awaited with grpc.aio.
+def large_file_receive(channel, stream):
+    # Messages are already serialized.
+    call = channel.stream_unary('/pbx.Node/LargeFileReceive',
+        request_serializer=None, response_deserializer=pb.FileUpResp.FromString)
+    return call(iter(stream))
+
+
+# Deadline of an upload from the 'expires' parameter of the response, e.g. "2024-05-01T10:20:30.123Z".
+# Returns seconds since the epoch or None if the server did not report it.
+def parse_expires(params):
+    value = (params or {}).get('expires')
+    if not value:
+        return None
+    try:
+        # The time is in UTC; fractions of a second are ignored.
+        return calendar.timegm(time.strptime(value[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return None
+
+
+class UploadIndex:
+    """Content hash -> URI of uploaded files. Hashes of local files are remembered by path,
+    size and modification time, so unchanged files are not read again. URIs are not used
+    after the deadline reported by the server or, if max_age is given, max_age seconds after
+    the upload. Safe to use from multiple threads."""
+
+    def __init__(self, filename, host, max_age=None):
+        self.filename = filename
+        self.host = host
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Uploaded content: sha256 -> [URI, upload time, deadline or None].
+        self.uris = {}
+        # Local files: path -> [size, mtime, sha256].
+        self.files = {}
+        try:
+            with open(filename, 'r') as f:
+                data = json.load(f)
+            self.files = data.get('files', {})
+            # URIs are valid only on the server they were uploaded to.
+            if data.get('host') == host:
+                self.uris = data.get('uris', {})
+        except (IOError, ValueError):
+            pass
+
+    def digest(self, filepath):
+        st = os.stat(filepath)
+        with self.lock:
+            known = self.files.get(filepath)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime:
+            return known[2]
+        digest = file_digest(filepath)
+        with self.lock:
+            self.files[filepath] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def uri(self, digest):
+        """URI of the content or None if it was not uploaded or may have been deleted by the server."""
+        with self.lock:
+            known = self.uris.get(digest)
+        if not isinstance(known, list) or len(known) < 3:
+            return None
+        uri, uploaded, expires = known[:3]
+        if self.max_age is not None:
+            # 0: always reuse.
+            if self.max_age and time.time() - uploaded > self.max_age:
+                return None
+        elif expires is not None and time.time() > expires - EXPIRES_MARGIN:
+            return None
+        return uri
+
+    def add(self, digest, uri, expires=None):
+        """Record uploaded content and save the index, so an interrupted upload is not repeated."""
+        with self.lock:
+            self.uris[digest] = [uri, time.time(), expires]
+            self.write()
+
+    def save(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        """Write the index to the file. The caller holds the lock."""
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'host': self.host, 'uris': self.uris, 'files': self.files}, f)
+        os.replace(tmp, self.filename)
+
+
+# List of files in the directory and its subdirectories, except indexes.
+def list_files(directory, index_file):
+    result = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.startswith(INDEX_FILE) or os.path.abspath(path).startswith(os.path.abspath(index_file)):
+                continue
+            if os.path.isfile(path):
+                result.append(path)
+    return result
+
+
+# Upload files in directory cmd.dir which are not in the index, up to cmd.parallel at the same time.
+def upload_dir(id, cmd, args):
+    from client import open_channel
+    from commands import upload_result
+
+    max_age = max(0, cmd.max_age) if cmd.max_age is not None else None
+    index = UploadIndex(cmd.index or os.path.join(cmd.dir, INDEX_FILE), args.host, max_age)
+    files = list_files(cmd.dir, index.filename)
+    parallel = max(1, cmd.parallel if cmd.via == 'grpc' else min(cmd.parallel, args.upload_workers))
+    start = time.time()
+
+    with ThreadPoolExecutor(max_workers=parallel) as pool:
+        digests = list(pool.map(index.digest, files))
+    index.save()
+
+    # Files with the same content are uploaded once.
+    pending = {}
+    skipped = skipped_bytes = 0
+    for filepath, digest in zip(files, digests):
+        if index.uri(digest) or digest in pending:
+            skipped += 1
+            skipped_bytes += os.path.getsize(filepath)
+        else:
+            pending[digest] = filepath
+    stdoutln("'{0}': {1} files, {2} unchanged, {3} to upload".format(cmd.dir, len(files), skipped, len(pending)))
+
+    channel = open_channel(args) if cmd.via == 'grpc' and pending else None
+
+    def upload_one(digest):
+        filepath = pending[digest]
+        if channel:
+            stream = UploadStream(id, filepath)
+            response = large_file_receive(channel, stream)
+            upload_result(response)
+            stdoutln(stream.summary())
+            if response.code != 200:
+                return None
+            # The file may have changed after it was hashed.
+            # LargeFileReceive does not report the deadline.
+            size, uri, digest, expires = stream.sent, response.meta.name, stream.checksum.hexdigest(), None
+        else:
+            result = get_uploader(args).upload(id, filepath)
+            if not result:
+                return None
+            size, uri, expires = result
+        index.add(digest, uri, expires)
+        return size
+
+    def safe_upload(digest):
+        try:
+            return upload_one(digest)
+        except Exception as ex:
+            stdoutln("Failed to upload '{0}':".format(pending[digest]), ex)
+            return None
+
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as pool:
+            sizes = list(pool.map(safe_upload, list(pending)))
+    finally:
+        if channel:
+            channel.close()
+
+    uploaded = [size for size in sizes if size is not None]
+    elapsed = max(time.time() - start, 0.001)
+    stdoutln("'{0}': uploaded {1} files, {2:.1f} MB; skipped {3} files, {4:.1f} MB; failed {5}; {6:.2f}s".format(
+        cmd.dir, len(uploaded), sum(uploaded) / 1048576., skipped, skipped_bytes / 1048576.,
+        len(sizes) - len(uploaded), elapsed))
+
+
+# Uploader service, created on first use.
+Service = None
+
+
+def get_uploader(args):
+    global Service
+    if Service is None:
+        Service = Uploader(args, max(1, args.upload_workers))
+    return Service
+
+
+# Wait for queued uploads to finish.
+def wait_uploads():
+    if Service:
+        Service.wait()
@@ -3,8 +3,10 @@
 from __future__ import print_function
 
 import base64
+import collections
+import hashlib
 import json
-from PIL import Image
+import threading
 try:
     from io import BytesIO as memory_io
 except ImportError:
@@ -12,6 +14,7 @@ except ImportError:
 import mimetypes
 import os
 
+import tn_globals
 from tn_globals import stdoutln
 
 # Maximum in-band (included directly into the message) attachment size which fits into
@@ -22,9 +25,19 @@ MAX_INBAND_ATTACHMENT_SIZE = 195840
 # Absolute maximum attachment size to be used with the server = 8MB.
 MAX_EXTERN_ATTACHMENT_SIZE = 1 << 23
 
+# Size of blocks of a file encoded with base64 at a time, a multiple of 3 bytes so blocks
+# can be encoded separately.
+BASE64_BLOCK_SIZE = 3 * 64 * 1024
+
 # Maximum allowed linear dimension of an inline image in pixels.
 MAX_IMAGE_DIM = 768
 
+# Quality of JPEG encoding of avatars.
+AVATAR_QUALITY = 85
+
+# Number of encoded inline images and avatars kept in memory.
+MAX_CACHED_IMAGES = 64
+
 # String used as a delete marker. I.e. when a value needs to be deleted, use this string
 DELETE_MARKER = 'DEL!'
 
@@ -62,86 +75,235 @@ def makeTheCard(fn, note, photofile):
                 }
             else:
                 try:
-                    f = open(photofile, 'rb')
-                    # File extension is used as a file type
-                    mimetype = mimetypes.guess_type(photofile)
-                    if mimetype[0]:
-                        mimetype = mimetype[0].split("/")[1]
+                    if tn_globals.AvatarDim:
+                        data, mimetype = avatar(photofile, tn_globals.AvatarDim)
                     else:
-                        mimetype = 'jpeg'
-                    data = base64.b64encode(f.read())
-                    # python3 fix.
-                    if type(data) is not str:
-                        data = data.decode()
+                        # File extension is used as a file type
+                        mimetype = mimetypes.guess_type(photofile)[0] or 'image/jpeg'
+                        data = None
+                    size = len(data) * 3 // 4 if data else os.path.getsize(photofile)
+                    if size > MAX_INBAND_ATTACHMENT_SIZE:
+                        raise IOError("avatar is too large: {0} bytes, maximum {1}".format(size,
+                            MAX_INBAND_ATTACHMENT_SIZE))
                     card['photo'] = {
-                        'data': data,
-                        'type': mimetype
+                        'data': data or encode_file(photofile),
+                        'type': mimetype.split("/")[1]
                     }
-                    f.close()
-                except IOError as err:
+                except (IOError, OSError) as err:
                     stdoutln("Error opening '" + photofile + "':", err)
 
     return card
 
 
-# Create drafty representation of a message with an inline image.
-def inline_image(filename):
+# Encoded inline images: (path, mtime, size, dim) -> (base64 data, mime type, width, height).
+ImageCache = collections.OrderedDict()
+ImageCacheLock = threading.Lock()
+
+
+# Key of the encoded image in caches.
+def image_key(filename, dim):
+    st = os.stat(filename)
+    return (os.path.abspath(filename), st.st_mtime, st.st_size, dim)
+
+
+def cached_image(key):
+    with ImageCacheLock:
+        image = ImageCache.get(key)
+        if image:
+            ImageCache.move_to_end(key)
+            return image
+    if tn_globals.FileCache:
+        path, info = tn_globals.FileCache.get(repr(key))
+        if path:
+            tn_globals.FileCache.hit(repr(key))
+            with open(path, 'rb') as f:
+                image = (f.read().decode('ascii'), info['mime'], info['width'], info['height'])
+            remember_image(key, image, False)
+            return image
+    return None
+
+
+def remember_image(key, image, persist=True):
+    with ImageCacheLock:
+        ImageCache[key] = image
+        while len(ImageCache) > MAX_CACHED_IMAGES:
+            ImageCache.popitem(last=False)
+    if persist and tn_globals.FileCache:
+        tn_globals.FileCache.put_data(repr(key), image[0].encode('ascii'),
+            {'mime': image[1], 'width': image[2], 'height': image[3]})
+
+
+# Scale image down to fit into dim x dim and base64-encode it.
+# Returns (base64 data, mime type, width, height).
+def encode_image(filename, dim):
+    # PIL is loaded only when an image is sent.
+    from PIL import Image
+
+    im = Image.open(filename, 'r')
     try:
-        im = Image.open(filename, 'r')
         width = im.width
         height = im.height
         format = im.format if im.format else "JPEG"
-        if width > MAX_IMAGE_DIM or height > MAX_IMAGE_DIM:
-            # Scale the image
-            scale = min(min(width, MAX_IMAGE_DIM) / width, min(height, MAX_IMAGE_DIM) / height)
-            width = int(width * scale)
-            height = int(height * scale)
-            resized = im.resize((width, height))
-            im.close()
-            im = resized
-
         mimetype = 'image/' + format.lower()
+        if width <= dim and height <= dim:
+            # Small enough, send as is without decoding.
+            return encode_file(filename), mimetype, width, height
+
+        # Scale the image
+        scale = min(min(width, dim) / width, min(height, dim) / height)
+        width = int(width * scale)
+        height = int(height * scale)
+        if format == 'JPEG':
+            # Let the JPEG decoder downscale by a power of 2 while decoding.
+            im.draft(im.mode, (width, height))
+        resized = im.resize((width, height))
+
         bitbuffer = memory_io()
-        im.save(bitbuffer, format=format)
-        data = base64.b64encode(bitbuffer.getvalue())
+        resized.save(bitbuffer, format=format)
+        resized.close()
+        return base64.b64encode(bitbuffer.getvalue()).decode('ascii'), mimetype, width, height
+    finally:
+        im.close()
 
-        # python3 fix.
-        if type(data) is not str:
-            data = data.decode()
 
-        result = {
+# Scale avatar down to fit into dim x dim and re-encode it as JPEG, or PNG if it is transparent.
+# Returns (base64 data, mime type, width, height).
+def encode_avatar(filename, dim):
+    from PIL import Image
+
+    with Image.open(filename, 'r') as im:
+        original, size = im.format, im.size
+        if original == 'JPEG':
+            # Let the JPEG decoder downscale by a power of 2 while decoding.
+            im.draft('RGB', (dim, dim))
+        im.thumbnail((dim, dim))
+        if im.mode in ('RGBA', 'LA') or (im.mode == 'P' and 'transparency' in im.info):
+            format, options, converted = 'PNG', {'optimize': True}, im.convert('RGBA')
+        else:
+            format, options, converted = 'JPEG', {'quality': AVATAR_QUALITY, 'optimize': True}, im.convert('RGB')
+        bitbuffer = memory_io()
+        converted.save(bitbuffer, format=format, **options)
+        width, height = converted.size
+        converted.close()
+    data = bitbuffer.getvalue()
+
+    if (width, height) == size and original in ('JPEG', 'PNG') and os.path.getsize(filename) <= len(data):
+        # Re-encoding did not make it smaller.
+        return encode_file(filename), 'image/' + original.lower(), width, height
+    return base64.b64encode(data).decode('ascii'), 'image/' + format.lower(), width, height
+
+
+# Normalized avatar: (base64 data, mime type). Encoded avatars are cached by hash of the
+# content of the file, so the same image is encoded once whatever its name.
+def avatar(filename, dim):
+    key = ('avatar', file_digest(filename), dim)
+    image = cached_image(key)
+    if not image:
+        image = encode_avatar(filename, dim)
+        remember_image(key, image)
+    return image[0], image[1]
+
+
+# Encode images which are not cached yet in a pool of processes.
+def prepare_images(filenames, workers=None):
+    from concurrent.futures import ProcessPoolExecutor
+
+    todo = {}
+    for filename in set(filenames):
+        try:
+            key = image_key(filename, MAX_IMAGE_DIM)
+        except OSError:
+            # Reported when the image is used.
+            continue
+        if not cached_image(key):
+            todo[key] = filename
+    if len(todo) < 2:
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {key: pool.submit(encode_image, filename, MAX_IMAGE_DIM) for key, filename in todo.items()}
+        for key, future in futures.items():
+            try:
+                remember_image(key, future.result())
+            except Exception:
+                # Reported when the image is used.
+                pass
+
+
+# Create drafty representation of a message with an inline image.
+def inline_image(filename):
+    try:
+        key = image_key(filename, MAX_IMAGE_DIM)
+        image = cached_image(key)
+        if not image:
+            image = encode_image(filename, MAX_IMAGE_DIM)
+            remember_image(key, image)
+        data, mimetype, width, height = image
+
+        return {
             'txt': ' ',
             'fmt': [{'len': 1}],
             'ent': [{'tp': 'IM', 'data':
                 {'val': data, 'mime': mimetype, 'width': width, 'height': height,
                     'name': os.path.basename(filename)}}]
         }
-        im.close()
-        return result
-    except IOError as err:
+    except (IOError, OSError) as err:
         stdoutln("Failed processing image '" + filename + "':", err)
         return None
 
 
-# Create a drafty message with an *in-band* attachment.
-def attachment(filename):
+# Base64-encode content of the file block by block.
+def encode_file(filename):
+    parts = []
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(BASE64_BLOCK_SIZE)
+            if not block:
+                break
+            parts.append(base64.b64encode(block))
+    return b''.join(parts).decode('ascii')
+
+
+# SHA-256 of the file content.
+def file_digest(filepath):
+    checksum = hashlib.sha256()
+    buf = bytearray(BASE64_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(filepath, 'rb', buffering=0) as fd:
+        while True:
+            n = fd.readinto(buf)
+            if not n:
+                break
+            checksum.update(view[:n])
+    return checksum.hexdigest()
+
+
+# Create a drafty message with an attachment. Files up to MAX_INBAND_ATTACHMENT_SIZE are
+# included into the message, larger files are uploaded out of band with upload(filename),
+# which returns the URL of the uploaded file, and referenced from the message.
+def attachment(filename, upload=None):
     try:
-        f = open(filename, 'rb')
+        size = os.path.getsize(filename)
+        if size > MAX_EXTERN_ATTACHMENT_SIZE:
+            stdoutln("Attachment '{0}' is too large: {1} bytes, maximum {2}".format(filename, size,
+                MAX_EXTERN_ATTACHMENT_SIZE))
+            return None
         # Try to guess the mime type.
-        mimetype = mimetypes.guess_type(filename)[0]
-        data = base64.b64encode(f.read())
-        # python3 fix.
-        if type(data) is not str:
-            data = data.decode()
-        result = {
+        data = {'mime': mimetypes.guess_type(filename)[0], 'name': os.path.basename(filename), 'size': size}
+        if size <= MAX_INBAND_ATTACHMENT_SIZE:
+            data['val'] = encode_file(filename)
+        elif upload:
+            data['ref'] = upload(filename)
+            if not data['ref']:
+                return None
+        else:
+            stdoutln("Attachment '{0}' is too large to be sent in-band: {1} bytes, maximum {2}".format(
+                filename, size, MAX_INBAND_ATTACHMENT_SIZE))
+            return None
+        return {
             'fmt': [{'at': -1}],
-            'ent': [{'tp': 'EX', 'data':{
-                'val': data, 'mime': mimetype, 'name':os.path.basename(filename)
-            }}]
+            'ent': [{'tp': 'EX', 'data': data}]
         }
-        f.close()
-        return result
-    except IOError as err:
+    except (IOError, OSError) as err:
         stdoutln("Error processing attachment '" + filename + "':", err)
         return None
 
@@ -157,6 +319,19 @@ def encode_to_bytes(src):
     return json.dumps(src).encode('utf-8')
 
 
+# Encode non-negative integer as protobuf varint.
+def encode_varint(value):
+    buf = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            buf.append(bits | 0x80)
+        else:
+            buf.append(bits)
+            return bytes(buf)
+
+
 # Parse credentials
 def parse_cred(cred):
     result = None